@@ -1,113 +1,737 @@
-
 import os
+import io
+import json
+import argparse
+import math
+import numpy as np
 import pandas as pd
 from sqlalchemy import create_engine, text
 from dotenv import load_dotenv
 import time
 import datetime
 
+try:
+    # Opcional: só o modo 'cache' e o CLI de reconstrução precisam do pyarrow
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.csv as pa_csv
+except ImportError:
+    pa = None
+
 load_dotenv()
 db_url = os.getenv("DATABASE_URL").replace("postgresql://", "postgresql+pg8000://")
 engine = create_engine(db_url)
 
-def calcular_metricas():
-    print(f"\niniciodos graficos {datetime.datetime.now()}...")
+ANALYTICS_MODO = os.getenv("ANALYTICS_MODO", "completo")
+ANALYTICS_ESTADO = os.getenv("ANALYTICS_ESTADO", "analytics_estado.json")
+JANELA_DIAS = 30
+ANALYTICS_BLOCO = int(os.getenv("ANALYTICS_BLOCO", 50000))
+PRECISAO_SKETCH = float(os.getenv("ANALYTICS_PRECISAO_SKETCH", 0.01))
+COLUNAS_METRICAS = ['id_regra', 'total_execucoes', 'total_erros', 'tempo_medio_execucao_ms', 'mtta_minutos', 'mttr_minutos', 'incidentes_abertos']
+
+COLUNAS_INTEIRAS = ['total_execucoes', 'total_erros', 'incidentes_abertos']
+ANALYTICS_CACHE_DIR = os.getenv("ANALYTICS_CACHE_DIR", "analytics_cache")
+ANALYTICS_CACHE_CARENCIA_H = float(os.getenv("ANALYTICS_CACHE_CARENCIA_H", 1))
+
+SCHEMA_ANALYTICS = [
+    f"ALTER TABLE metricas_diarias ADD COLUMN IF NOT EXISTS {coluna} double precision"
+    for prefixo, unidade in (('exec', 'ms'), ('mtta', 'minutos'), ('mttr', 'minutos'))
+    for coluna in (f"{prefixo}_p50_{unidade}", f"{prefixo}_p95_{unidade}", f"{prefixo}_p99_{unidade}")
+] + [
+    """DELETE FROM metricas_diarias a USING metricas_diarias b
+       WHERE a.data_referencia = b.data_referencia AND a.id_regra = b.id_regra AND a.id < b.id""",
+    "CREATE UNIQUE INDEX IF NOT EXISTS metricas_diarias_dia_regra_uk ON metricas_diarias (data_referencia, id_regra)",
+]
+
+def garantir_schema():
+    with engine.connect() as conn:
+        for ddl in SCHEMA_ANALYTICS:
+            conn.execute(text(ddl))
+        conn.commit()
+
+def metricas_completas():
+    print(" try ler")
+
+    df_exec = pd.read_sql("""
+        SELECT id_regra, data_inicio, data_fim, sucesso 
+        FROM execucoes_regras 
+        WHERE data_inicio >= CURRENT_DATE - INTERVAL '30 days'
+    """, engine)
     
-    try:
-        print(" try ler")
-        
-        df_exec = pd.read_sql("""
-            SELECT id_regra, data_inicio, data_fim, sucesso 
-            FROM execucoes_regras 
-            WHERE data_inicio >= CURRENT_DATE - INTERVAL '30 days'
-        """, engine)
-        
-        df_inc = pd.read_sql("""
-            SELECT id_incidente, id_regra, data_abertura, status 
-            FROM incidentes 
-            WHERE data_abertura >= CURRENT_DATE - INTERVAL '30 days'
-        """, engine)
-        
+    df_inc = pd.read_sql("""
+        SELECT id_incidente, id_regra, data_abertura, status 
+        FROM incidentes 
+        WHERE data_abertura >= CURRENT_DATE - INTERVAL '30 days'
+    """, engine)
+    
+
+    df_evt = pd.read_sql("""
+        SELECT id_incidente, tipo, timestamp 
+        FROM eventos_incidente
+    """, engine)
+
     
-        df_evt = pd.read_sql("""
-            SELECT id_incidente, tipo, timestamp 
-            FROM eventos_incidente
-        """, engine)
+    if df_exec.empty:
+        print("    Sem dados de execução para processar.")
 
+        return None
+
+    return agregar_metricas(df_exec, df_inc, df_evt)
+
+def agregar_metricas(df_exec, df_inc, df_evt):
+    df_exec['data_inicio'] = pd.to_datetime(df_exec['data_inicio'], errors='coerce')
+    df_exec['data_fim'] = pd.to_datetime(df_exec['data_fim'], errors='coerce')
+    df_exec['duracao_ms'] = (df_exec['data_fim'] - df_exec['data_inicio']).dt.total_seconds() * 1000
+    
+ 
+    metrics_exec = df_exec.groupby('id_regra').agg(
+        total_execucoes=('id_regra', 'count'),
+        total_erros=('sucesso', lambda x: (~x).sum()),
+        tempo_medio_execucao_ms=('duracao_ms', 'mean')
+    ).reset_index()
+
+    
+    mtta_por_regra = pd.DataFrame(columns=['id_regra', 'mtta_minutos'])
+    mttr_por_regra = pd.DataFrame(columns=['id_regra', 'mttr_minutos'])
+    incidentes_abertos = pd.DataFrame(columns=['id_regra', 'incidentes_abertos'])
+
+    if not df_inc.empty:
+    
+        incidentes_abertos = df_inc[df_inc['status'] == 'OPEN'].groupby('id_regra').size().reset_index(name='incidentes_abertos')
+
+        if not df_evt.empty:
+            full_inc = df_inc.merge(df_evt, on='id_incidente', how='left')
+            
+            
+            acks = full_inc[full_inc['tipo'] == 'ACK'].copy()
+            if not acks.empty:
+                acks['data_abertura'] = pd.to_datetime(acks['data_abertura'])
+                acks['timestamp'] = pd.to_datetime(acks['timestamp'])
+                acks['tempo_ack_min'] = (acks['timestamp'] - acks['data_abertura']).dt.total_seconds() / 60
+                mtta_por_regra = acks.groupby('id_regra')['tempo_ack_min'].mean().reset_index().rename(columns={'tempo_ack_min': 'mtta_minutos'})
+            
         
-        if df_exec.empty:
-            print("    Sem dados de execução para processar.")
+            closes = full_inc[full_inc['tipo'] == 'CLOSE'].copy()
+            if not closes.empty:
+                closes['data_abertura'] = pd.to_datetime(closes['data_abertura'])
+                closes['timestamp'] = pd.to_datetime(closes['timestamp'])
+                closes['tempo_resolve_min'] = (closes['timestamp'] - closes['data_abertura']).dt.total_seconds() / 60
+                mttr_por_regra = closes.groupby('id_regra')['tempo_resolve_min'].mean().reset_index().rename(columns={'tempo_resolve_min': 'mttr_minutos'})
+
+    
+    final_df = metrics_exec
+    final_df = final_df.merge(mtta_por_regra, on='id_regra', how='left')
+    final_df = final_df.merge(mttr_por_regra, on='id_regra', how='left')
+    final_df = final_df.merge(incidentes_abertos, on='id_regra', how='left')
+    return final_df
 
+def ler_ids_regras():
+    return pd.read_sql("SELECT id FROM regras", engine)['id'].tolist()
+
+def filtrar_regras_validas(final_df, valid_ids=None):
+    if valid_ids is None:
+        valid_ids = ler_ids_regras()
+    if valid_ids:
+        final_df = final_df[final_df['id_regra'].isin(valid_ids)]
+    else:
+        print(" nesse caso n tem regra no banco ")
+        return None
+
+    if final_df.empty:
+        return None
+
+    return final_df.fillna(0)
+
+class EstadoIncremental:
+    # Agregados por (dia, regra) dos últimos JANELA_DIAS. A cada ciclo só as linhas com id acima
+    # do watermark (ou em lacunas ainda não commitadas) são lidas, e os dias fora da janela saem.
+    # Eventos chegam já com id_regra e data_abertura do incidente (JOIN), sem depender de o
+    # incidente ter sido lido num ciclo anterior.
+    TABELAS = ('execucoes', 'eventos')
+    LACUNAS_MAX = 1000
+    LACUNA_CICLOS = 10
+
+    def __init__(self):
+        self.watermarks = {t: 0 for t in self.TABELAS}
+        self.lacunas = {t: {} for t in self.TABELAS}
+        self.execucoes = {}
+        self.respostas = {}
+
+    @classmethod
+    def carregar(cls, caminho):
+        estado = cls()
+        if caminho and os.path.exists(caminho):
+            try:
+                with open(caminho) as f:
+                    dados = json.load(f)
+                # Estados antigos guardavam os incidentes para casar com os eventos
+                dados.pop('incidentes', None)
+                for chave in ('watermarks', 'lacunas'):
+                    dados.get(chave, {}).pop('incidentes', None)
+                estado.__dict__.update(dados)
+            except Exception as e:
+                print(f"Estado incremental inválido ({e}), recalculando do zero.")
+                estado = cls()
+        return estado
+
+    def salvar(self, caminho):
+        if not caminho:
             return
+        tmp = caminho + ".tmp"
+        with open(tmp, 'w') as f:
+            json.dump(self.__dict__, f)
+        os.replace(tmp, caminho)
 
-     
-        df_exec['data_inicio'] = pd.to_datetime(df_exec['data_inicio'], errors='coerce')
-        df_exec['data_fim'] = pd.to_datetime(df_exec['data_fim'], errors='coerce')
-        df_exec['duracao_ms'] = (df_exec['data_fim'] - df_exec['data_inicio']).dt.total_seconds() * 1000
-        
-     
-        metrics_exec = df_exec.groupby('id_regra').agg(
-            total_execucoes=('id_regra', 'count'),
-            total_erros=('sucesso', lambda x: (~x).sum()),
-            tempo_medio_execucao_ms=('duracao_ms', 'mean')
-        ).reset_index()
+    def ler_novos(self, tabela, sql, coluna_id, params):
+        lacunas = [int(i) for i in self.lacunas[tabela]]
+        df = pd.read_sql(text(f"""
+            {sql} AND ({coluna_id} > :watermark OR {coluna_id} = ANY(CAST(:lacunas AS bigint[])))
+        """), engine, params={**params, 'watermark': self.watermarks[tabela], 'lacunas': lacunas})
+        self._atualizar_watermark(tabela, df[coluna_id.split('.')[-1]].tolist() if not df.empty else [])
+        return df
 
-        
-        mtta_por_regra = pd.DataFrame(columns=['id_regra', 'mtta_minutos'])
-        mttr_por_regra = pd.DataFrame(columns=['id_regra', 'mttr_minutos'])
-        incidentes_abertos = pd.DataFrame(columns=['id_regra', 'incidentes_abertos'])
+    def _atualizar_watermark(self, tabela, ids):
+        # Ids pulados podem ser transações ainda abertas: ficam como lacunas por alguns ciclos
+        watermark = self.watermarks[tabela]
+        lidos = set(ids)
+        lacunas = {i: n - 1 for i, n in self.lacunas[tabela].items() if int(i) not in lidos and n > 1}
+        if ids:
+            maior = max(ids)
+            if maior > watermark:
+                faltando = set(range(watermark + 1, maior + 1)) - lidos if maior - watermark - len(lidos) <= self.LACUNAS_MAX else set()
+                for i in faltando:
+                    lacunas[str(i)] = self.LACUNA_CICLOS
+                self.watermarks[tabela] = maior
+        self.lacunas[tabela] = lacunas
 
-        if not df_inc.empty:
-        
-            incidentes_abertos = df_inc[df_inc['status'] == 'OPEN'].groupby('id_regra').size().reset_index(name='incidentes_abertos')
-
-            if not df_evt.empty:
-                full_inc = df_inc.merge(df_evt, on='id_incidente', how='left')
-                
-                
-                acks = full_inc[full_inc['tipo'] == 'ACK'].copy()
-                if not acks.empty:
-                    acks['data_abertura'] = pd.to_datetime(acks['data_abertura'])
-                    acks['timestamp'] = pd.to_datetime(acks['timestamp'])
-                    acks['tempo_ack_min'] = (acks['timestamp'] - acks['data_abertura']).dt.total_seconds() / 60
-                    mtta_por_regra = acks.groupby('id_regra')['tempo_ack_min'].mean().reset_index().rename(columns={'tempo_ack_min': 'mtta_minutos'})
-                
-            
-                closes = full_inc[full_inc['tipo'] == 'CLOSE'].copy()
-                if not closes.empty:
-                    closes['data_abertura'] = pd.to_datetime(closes['data_abertura'])
-                    closes['timestamp'] = pd.to_datetime(closes['timestamp'])
-                    closes['tempo_resolve_min'] = (closes['timestamp'] - closes['data_abertura']).dt.total_seconds() / 60
-                    mttr_por_regra = closes.groupby('id_regra')['tempo_resolve_min'].mean().reset_index().rename(columns={'tempo_resolve_min': 'mttr_minutos'})
+    def somar_execucoes(self, df):
+        if df.empty:
+            return
+        df = df.copy()
+        df['data_inicio'] = pd.to_datetime(df['data_inicio'], errors='coerce')
+        df['data_fim'] = pd.to_datetime(df['data_fim'], errors='coerce')
+        df['dia'] = df['data_inicio'].dt.strftime('%Y-%m-%d')
+        df['duracao_ms'] = (df['data_fim'] - df['data_inicio']).dt.total_seconds() * 1000
+        df['erro'] = ~df['sucesso'].astype(bool)
+        grupos = df.groupby(['dia', 'id_regra']).agg(
+            total=('id_regra', 'count'), erros=('erro', 'sum'),
+            soma_ms=('duracao_ms', 'sum'), n_ms=('duracao_ms', 'count'),
+        )
+        for (dia, id_regra), g in grupos.iterrows():
+            acc = self.execucoes.setdefault(f"{dia}|{id_regra}", [0, 0, 0.0, 0])
+            acc[0] += int(g['total'])
+            acc[1] += int(g['erros'])
+            acc[2] += float(g['soma_ms'])
+            acc[3] += int(g['n_ms'])
 
-        
-        final_df = metrics_exec
-        final_df = final_df.merge(mtta_por_regra, on='id_regra', how='left')
-        final_df = final_df.merge(mttr_por_regra, on='id_regra', how='left')
-        final_df = final_df.merge(incidentes_abertos, on='id_regra', how='left')
-        
-      
-        valid_ids_df = pd.read_sql("SELECT id FROM regras", engine)
-        if not valid_ids_df.empty:
-            valid_ids = valid_ids_df['id'].tolist()
-            final_df = final_df[final_df['id_regra'].isin(valid_ids)]
-        else:
-            print(" nesse caso n tem regra no banco ")
+    def somar_eventos(self, df):
+        for row in df.itertuples(index=False):
+            abertura = pd.Timestamp(row.data_abertura)
+            momento = pd.Timestamp(row.timestamp)
+            if pd.isna(abertura) or pd.isna(momento) or pd.isna(row.id_regra):
+                continue
+            acc = self.respostas.setdefault(f"{abertura.strftime('%Y-%m-%d')}|{int(row.id_regra)}|{row.tipo}", [0.0, 0])
+            acc[0] += (momento.value - abertura.value) / 1e9 / 60
+            acc[1] += 1
+
+    def expirar(self, corte):
+        self.execucoes = {k: v for k, v in self.execucoes.items() if k.split('|')[0] >= corte}
+        self.respostas = {k: v for k, v in self.respostas.items() if k.split('|')[0] >= corte}
+
+    def para_dataframe(self):
+        if not self.execucoes:
+            return None
+
+        por_regra = {}
+        for chave, (total, erros, soma_ms, n_ms) in self.execucoes.items():
+            acc = por_regra.setdefault(int(chave.split('|')[1]), [0, 0, 0.0, 0])
+            acc[0] += total
+            acc[1] += erros
+            acc[2] += soma_ms
+            acc[3] += n_ms
+
+        respostas = {}
+        for chave, (soma, n) in self.respostas.items():
+            _, id_regra, tipo = chave.split('|')
+            acc = respostas.setdefault((int(id_regra), tipo), [0.0, 0])
+            acc[0] += soma
+            acc[1] += n
+
+        def media(id_regra, tipo):
+            soma, n = respostas.get((id_regra, tipo), (0.0, 0))
+            return soma / n if n else float('nan')
+
+        return pd.DataFrame([{
+            'id_regra': id_regra,
+            'total_execucoes': total,
+            'total_erros': erros,
+            'tempo_medio_execucao_ms': soma_ms / n_ms if n_ms else float('nan'),
+            'mtta_minutos': media(id_regra, 'ACK'),
+            'mttr_minutos': media(id_regra, 'CLOSE'),
+        } for id_regra, (total, erros, soma_ms, n_ms) in sorted(por_regra.items())])
+
+_estado_incremental = None
+
+def metricas_incrementais():
+    global _estado_incremental
+    if _estado_incremental is None:
+        _estado_incremental = EstadoIncremental.carregar(ANALYTICS_ESTADO)
+    estado = _estado_incremental
+
+    with engine.connect() as conn:
+        corte = conn.execute(text(f"SELECT (CURRENT_DATE - INTERVAL '{JANELA_DIAS} days')::date")).scalar()
+    params = {'corte': corte}
+
+    df_exec = estado.ler_novos('execucoes', """
+        SELECT id_execucao, id_regra, data_inicio, data_fim, sucesso
+        FROM execucoes_regras
+        WHERE data_inicio >= :corte
+    """, 'id_execucao', params)
+    df_evt = estado.ler_novos('eventos', """
+        SELECT e.id, e.tipo, e.timestamp, i.id_regra, i.data_abertura
+        FROM eventos_incidente e
+        JOIN incidentes i ON i.id_incidente = e.id_incidente
+        WHERE e.tipo IN ('ACK', 'CLOSE') AND i.data_abertura >= :corte
+    """, 'e.id', params)
+    print(f"    Incremental: {len(df_exec)} execuções, {len(df_evt)} eventos novos")
+
+    estado.expirar(corte.isoformat())
+    estado.somar_execucoes(df_exec)
+    estado.somar_eventos(df_evt)
+    estado.salvar(ANALYTICS_ESTADO)
+
+    final_df = estado.para_dataframe()
+    if final_df is None:
+        print("    Sem dados de execução para processar.")
+        return None
+
+    incidentes_abertos = pd.read_sql(text("""
+        SELECT id_regra, COUNT(*) AS incidentes_abertos
+        FROM incidentes
+        WHERE status = 'OPEN' AND data_abertura >= :corte
+        GROUP BY id_regra
+    """), engine, params=params)
+    return final_df.merge(incidentes_abertos, on='id_regra', how='left')
+
+class SketchQuantis:
+    # Histograma logarítmico (estilo DDSketch): erro relativo <= precisao, memória proporcional
+    # ao log da faixa de valores e mesclável somando os contadores.
+    def __init__(self, precisao=PRECISAO_SKETCH):
+        self.gamma = (1 + precisao) / (1 - precisao)
+        self._log_gamma = math.log(self.gamma)
+        self.buckets = {}
+        self.zeros = 0
+        self.n = 0
+
+    def adicionar(self, valores):
+        valores = np.asarray(valores, dtype='float64')
+        valores = valores[~np.isnan(valores)]
+        if not len(valores):
             return
+        positivos = valores[valores > 1e-9]
+        self.zeros += len(valores) - len(positivos)
+        self.n += len(valores)
+        indices, contagens = np.unique(np.ceil(np.log(positivos) / self._log_gamma).astype('int64'), return_counts=True)
+        for i, c in zip(indices.tolist(), contagens.tolist()):
+            self.buckets[i] = self.buckets.get(i, 0) + c
+
+    def mesclar(self, outro):
+        self.zeros += outro.zeros
+        self.n += outro.n
+        for i, c in outro.buckets.items():
+            self.buckets[i] = self.buckets.get(i, 0) + c
 
-        if final_df.empty:
+    def quantil(self, q):
+        if not self.n:
+            return float('nan')
+        posicao = q * (self.n - 1)
+        acumulado = self.zeros
+        if posicao < acumulado:
+            return 0.0
+        for i in sorted(self.buckets):
+            acumulado += self.buckets[i]
+            if posicao < acumulado:
+                return 2 * self.gamma ** i / (self.gamma + 1)
+        return 2 * self.gamma ** max(self.buckets) / (self.gamma + 1)
+
+def ler_em_blocos(sql, coluna_id, params, **kwargs):
+    # Paginação por chave: a memória fica limitada a ANALYTICS_BLOCO linhas, qualquer que seja o driver
+    ultimo = 0
+    while True:
+        bloco = pd.read_sql_query(
+            text(f"{sql} AND {coluna_id} > :ultimo ORDER BY {coluna_id} LIMIT :limite"),
+            engine, params={**params, 'ultimo': ultimo, 'limite': ANALYTICS_BLOCO}, **kwargs,
+        )
+        if bloco.empty:
             return
-            
-        final_df = final_df.fillna(0)
-        
-        final_df['data_referencia'] = pd.Timestamp.now().date()
-        
-        with engine.connect() as conn:
-            conn.execute(text("DELETE FROM metricas_diarias WHERE data_referencia = CURRENT_DATE"))
+        yield bloco
+        ultimo = int(bloco[coluna_id.split('.')[-1]].iloc[-1])
+        if len(bloco) < ANALYTICS_BLOCO:
+            return
+
+def _somar_por_regra(acumulado, df, colunas):
+    grupos = df.groupby('id_regra', observed=True)[colunas].agg(['sum', 'count'])
+    for id_regra, g in grupos.iterrows():
+        acc = acumulado.setdefault(int(id_regra), {})
+        for coluna in colunas:
+            soma, n = acc.get(coluna, (0.0, 0))
+            acc[coluna] = (soma + float(g[(coluna, 'sum')]), n + int(g[(coluna, 'count')]))
+
+def _alimentar_sketches(sketches, df, coluna):
+    for id_regra, valores in df.groupby('id_regra', observed=True)[coluna]:
+        sketches.setdefault(int(id_regra), SketchQuantis()).adicionar(valores.to_numpy())
+
+def metricas_streaming():
+    with engine.connect() as conn:
+        corte = conn.execute(text(f"SELECT (CURRENT_DATE - INTERVAL '{JANELA_DIAS} days')::date")).scalar()
+    params = {'corte': corte}
+
+    execucoes, sk_exec = {}, {}
+    for bloco in ler_em_blocos("""
+        SELECT id_execucao, id_regra, data_inicio, data_fim, sucesso
+        FROM execucoes_regras
+        WHERE data_inicio >= :corte AND id_regra IS NOT NULL
+    """, 'id_execucao', params, dtype={'id_regra': 'int32', 'sucesso': 'bool'}, parse_dates=['data_inicio', 'data_fim']):
+        bloco['erro'] = (~bloco['sucesso']).astype('int32')
+        bloco['execucao'] = np.int32(1)
+        bloco['duracao_ms'] = (bloco['data_fim'] - bloco['data_inicio']).dt.total_seconds() * 1000
+        _somar_por_regra(execucoes, bloco, ['execucao', 'erro', 'duracao_ms'])
+        _alimentar_sketches(sk_exec, bloco, 'duracao_ms')
+
+    if not execucoes:
+        print("    Sem dados de execução para processar.")
+        return None
+
+    abertos = {}
+    for bloco in ler_em_blocos("""
+        SELECT id_incidente, id_regra, status
+        FROM incidentes
+        WHERE data_abertura >= :corte AND id_regra IS NOT NULL
+    """, 'id_incidente', params, dtype={'id_regra': 'int32', 'status': 'category'}):
+        for id_regra, n in bloco[bloco['status'] == 'OPEN'].groupby('id_regra', observed=True).size().items():
+            abertos[int(id_regra)] = abertos.get(int(id_regra), 0) + int(n)
+
+    respostas, sketches = {}, {'ACK': {}, 'CLOSE': {}}
+    for bloco in ler_em_blocos("""
+        SELECT e.id, i.id_regra, e.tipo, e.timestamp, i.data_abertura
+        FROM eventos_incidente e
+        JOIN incidentes i ON i.id_incidente = e.id_incidente
+        WHERE i.data_abertura >= :corte AND e.tipo IN ('ACK', 'CLOSE') AND i.id_regra IS NOT NULL
+    """, 'e.id', params, dtype={'id_regra': 'int32', 'tipo': 'category'}, parse_dates=['timestamp', 'data_abertura']):
+        bloco['minutos'] = (bloco['timestamp'] - bloco['data_abertura']).dt.total_seconds() / 60
+        for tipo in ('ACK', 'CLOSE'):
+            do_tipo = bloco[bloco['tipo'] == tipo]
+            _somar_por_regra(respostas.setdefault(tipo, {}), do_tipo, ['minutos'])
+            _alimentar_sketches(sketches[tipo], do_tipo, 'minutos')
+
+    def media(acc, coluna):
+        soma, n = acc.get(coluna, (0.0, 0))
+        return soma / n if n else float('nan')
+
+    def quantil(sketch, q):
+        return sketch.quantil(q) if sketch else float('nan')
+
+    linhas = []
+    for id_regra, acc in sorted(execucoes.items()):
+        linha = {
+            'id_regra': id_regra,
+            'total_execucoes': acc['execucao'][0],
+            'total_erros': acc['erro'][0],
+            'tempo_medio_execucao_ms': media(acc, 'duracao_ms'),
+            'mtta_minutos': media(respostas.get('ACK', {}).get(id_regra, {}), 'minutos'),
+            'mttr_minutos': media(respostas.get('CLOSE', {}).get(id_regra, {}), 'minutos'),
+            'incidentes_abertos': abertos.get(id_regra),
+        }
+        for prefixo, unidade, sketch in (
+            ('exec', 'ms', sk_exec.get(id_regra)),
+            ('mtta', 'minutos', sketches['ACK'].get(id_regra)),
+            ('mttr', 'minutos', sketches['CLOSE'].get(id_regra)),
+        ):
+            for q in (50, 95, 99):
+                linha[f"{prefixo}_p{q}_{unidade}"] = quantil(sketch, q / 100)
+        linhas.append(linha)
+    return pd.DataFrame(linhas)
+
+def metricas_sql():
+    # Mesmo resultado de metricas_completas, agregado dentro do Postgres: só uma linha por regra trafega
+    final_df = pd.read_sql(text(f"""
+        WITH exec AS (
+            SELECT id_regra,
+                   COUNT(*) AS total_execucoes,
+                   COUNT(*) FILTER (WHERE NOT sucesso) AS total_erros,
+                   AVG(EXTRACT(EPOCH FROM (data_fim - data_inicio))::double precision * 1000) AS tempo_medio_execucao_ms
+            FROM execucoes_regras
+            WHERE data_inicio >= CURRENT_DATE - INTERVAL '{JANELA_DIAS} days'
+              AND id_regra IS NOT NULL
+            GROUP BY id_regra
+        ), inc AS (
+            SELECT id_incidente, id_regra, data_abertura, status
+            FROM incidentes
+            WHERE data_abertura >= CURRENT_DATE - INTERVAL '{JANELA_DIAS} days'
+        ), respostas AS (
+            SELECT inc.id_regra,
+                   AVG(EXTRACT(EPOCH FROM (e.timestamp - inc.data_abertura))::double precision / 60)
+                       FILTER (WHERE e.tipo = 'ACK') AS mtta_minutos,
+                   AVG(EXTRACT(EPOCH FROM (e.timestamp - inc.data_abertura))::double precision / 60)
+                       FILTER (WHERE e.tipo = 'CLOSE') AS mttr_minutos
+            FROM inc
+            JOIN eventos_incidente e ON e.id_incidente = inc.id_incidente
+            WHERE e.tipo IN ('ACK', 'CLOSE')
+            GROUP BY inc.id_regra
+        ), abertos AS (
+            SELECT id_regra, COUNT(*) AS incidentes_abertos
+            FROM inc
+            WHERE status = 'OPEN'
+            GROUP BY id_regra
+        )
+        SELECT exec.id_regra, exec.total_execucoes, exec.total_erros, exec.tempo_medio_execucao_ms,
+               respostas.mtta_minutos, respostas.mttr_minutos, abertos.incidentes_abertos
+        FROM exec
+        LEFT JOIN respostas USING (id_regra)
+        LEFT JOIN abertos USING (id_regra)
+        ORDER BY exec.id_regra
+    """), engine)
+
+    if final_df.empty:
+        print("    Sem dados de execução para processar.")
+        return None
+    return final_df
+
+class CacheColunar:
+    # Cópia local de execucoes_regras, incidentes e eventos_incidente (ACK/CLOSE) em arquivos Arrow IPC,
+    # um por tabela e dia. Dias encerrados há mais de ANALYTICS_CACHE_CARENCIA_H são gravados uma vez
+    # (<dia>.arrow) e nunca relidos do banco; o dia atual (e os ainda na carência) ficam em
+    # <dia>.parcial.arrow e são regravados a cada sincronização. A partição de hoje é aberta à direita,
+    # como as queries de metricas_completas. A leitura é por memory map, sem cópia até o pandas.
+    TABELAS = {
+        'execucoes': ('data_inicio', """
+            SELECT id_regra, data_inicio, data_fim, sucesso FROM execucoes_regras
+            WHERE data_inicio >= '{inicio}' {ate}
+        """, [('id_regra', 'int64'), ('data_inicio', 'ts'), ('data_fim', 'ts'), ('sucesso', 'bool')]),
+        'incidentes': ('data_abertura', """
+            SELECT id_incidente, id_regra, data_abertura FROM incidentes
+            WHERE data_abertura >= '{inicio}' {ate}
+        """, [('id_incidente', 'int64'), ('id_regra', 'int64'), ('data_abertura', 'ts')]),
+        'eventos': ('timestamp', """
+            SELECT id_incidente, tipo, timestamp FROM eventos_incidente
+            WHERE tipo IN ('ACK', 'CLOSE') AND timestamp >= '{inicio}' {ate}
+        """, [('id_incidente', 'int64'), ('tipo', 'str'), ('timestamp', 'ts')]),
+    }
+
+    def __init__(self, diretorio):
+        if pa is None:
+            raise RuntimeError("Cache colunar requer pyarrow (pip install pyarrow)")
+        self.diretorio = diretorio
+        tipos = {'int64': pa.int64(), 'ts': pa.timestamp('us'), 'bool': pa.bool_(), 'str': pa.string()}
+        self.schemas = {t: pa.schema([(c, tipos[tp]) for c, tp in colunas]) for t, (_, _, colunas) in self.TABELAS.items()}
+        self.hoje = None
+
+    def _caminho(self, tabela, dia, parcial=False):
+        return os.path.join(self.diretorio, tabela, f"{dia.isoformat()}{'.parcial' if parcial else ''}.arrow")
+
+    def _gravar(self, tabela, dia, tabela_arrow, selado):
+        os.makedirs(os.path.join(self.diretorio, tabela), exist_ok=True)
+        destino = self._caminho(tabela, dia, parcial=not selado)
+        tmp = destino + ".tmp"
+        with pa.OSFile(tmp, 'wb') as f, pa.ipc.new_file(f, tabela_arrow.schema) as escritor:
+            escritor.write_table(tabela_arrow)
+        os.replace(tmp, destino)
+        if selado and os.path.exists(self._caminho(tabela, dia, parcial=True)):
+            os.remove(self._caminho(tabela, dia, parcial=True))
+
+    def _baixar(self, conn, tabela, inicio, fim):
+        # COPY em CSV direto para o parser do Arrow: evita a conversão linha a linha do pg8000
+        coluna_dia, sql, _ = self.TABELAS[tabela]
+        ate = f"AND {coluna_dia} < '{fim.isoformat()}'" if fim else ""
+        buffer = io.BytesIO()
+        conn.cursor().execute(f"COPY ({sql.format(inicio=inicio.isoformat(), ate=ate)}) TO STDOUT WITH (FORMAT csv, HEADER)", stream=buffer)
+        schema = self.schemas[tabela]
+        return pa_csv.read_csv(io.BytesIO(buffer.getvalue()), convert_options=pa_csv.ConvertOptions(
+            column_types=schema, true_values=['t'], false_values=['f'], strings_can_be_null=True,
+        )).select(schema.names).cast(schema)
+
+    def sincronizar(self, inicio=None, fim=None):
+        # Baixa só os dias sem partição selada entre inicio e fim (padrão: janela do dashboard até hoje)
+        conn = engine.raw_connection()
+        try:
+            cur = conn.cursor()
+            cur.execute("SELECT CURRENT_DATE, LOCALTIMESTAMP")
+            hoje, agora = cur.fetchone()
+            inicio = inicio or hoje - datetime.timedelta(days=JANELA_DIAS)
+            fim = min(fim or hoje, hoje)
+            carencia = datetime.timedelta(hours=ANALYTICS_CACHE_CARENCIA_H)
+            dias = [inicio + datetime.timedelta(days=i) for i in range((fim - inicio).days + 1)]
+            baixados = 0
+            for tabela, (coluna_dia, _, _) in self.TABELAS.items():
+                faltando = [d for d in dias if not os.path.exists(self._caminho(tabela, d))]
+                for bloco in self._intervalos(faltando):
+                    ultimo = bloco[-1] + datetime.timedelta(days=1)
+                    dados = self._baixar(conn, tabela, bloco[0], None if bloco[-1] == hoje else ultimo)
+                    baixados += len(dados)
+                    # Linhas com data futura entram na partição de hoje
+                    dia_linha = pc.min_element_wise(pc.cast(dados[coluna_dia], pa.date32()), pa.scalar(hoje, pa.date32()))
+                    for dia in bloco:
+                        selado = datetime.datetime.combine(dia + datetime.timedelta(days=1), datetime.time()) + carencia <= agora
+                        self._gravar(tabela, dia, dados.filter(pc.equal(dia_linha, pa.scalar(dia, pa.date32()))), selado)
             conn.commit()
+        finally:
+            conn.close()
+        self.hoje = hoje
+        print(f"    Cache: {len(dias)} dias verificados, {baixados} linhas baixadas")
+        return hoje
+
+    @staticmethod
+    def _intervalos(dias):
+        blocos = []
+        for dia in dias:
+            if blocos and dia - blocos[-1][-1] == datetime.timedelta(days=1):
+                blocos[-1].append(dia)
+            else:
+                blocos.append([dia])
+        return blocos
+
+    def ler(self, tabela, inicio, fim):
+        partes, faltando = [], 0
+        for i in range((fim - inicio).days + 1):
+            dia = inicio + datetime.timedelta(days=i)
+            for caminho in (self._caminho(tabela, dia), self._caminho(tabela, dia, parcial=True)):
+                if os.path.exists(caminho):
+                    partes.append(pa.ipc.open_file(pa.memory_map(caminho, 'r')).read_all())
+                    break
+            else:
+                faltando += 1
+        if faltando:
+            print(f"    Cache: {faltando} dias de {tabela} sem partição entre {inicio} e {fim}")
+        return pa.concat_tables(partes).to_pandas() if partes else self.schemas[tabela].empty_table().to_pandas()
+
+    def carregar(self, inicio, fim):
+        return tuple(self.ler(tabela, inicio, fim) for tabela in ('execucoes', 'incidentes', 'eventos'))
+
+_cache_colunar = None
+
+def get_cache():
+    global _cache_colunar
+    if _cache_colunar is None:
+        _cache_colunar = CacheColunar(ANALYTICS_CACHE_DIR)
+    return _cache_colunar
+
+def metricas_do_cache(dados, data_referencia, hoje):
+    # Métricas de data_referencia com a mesma conta de metricas_completas, só com o que está no cache.
+    # Incidente aberto = sem ACK/CLOSE até o fim do dia (o status atual não vale para dias passados).
+    df_exec, df_inc, df_evt = dados
+    inicio = pd.Timestamp(data_referencia - datetime.timedelta(days=JANELA_DIAS))
+    fim = None if data_referencia >= hoje else pd.Timestamp(data_referencia + datetime.timedelta(days=1))
+
+    def janela(df, coluna, desde=None):
+        mascara = df[coluna] >= desde if desde is not None else pd.Series(True, index=df.index)
+        return df[mascara & (df[coluna] < fim)] if fim is not None else df[mascara]
+
+    df_exec = janela(df_exec, 'data_inicio', inicio).copy()
+    if df_exec.empty:
+        return None
+    df_inc = janela(df_inc, 'data_abertura', inicio).copy()
+    df_evt = janela(df_evt, 'timestamp')
+    df_inc['status'] = np.where(df_inc['id_incidente'].isin(df_evt['id_incidente']), 'RESPONDIDO', 'OPEN')
+    return agregar_metricas(df_exec, df_inc, df_evt.copy())
+
+def metricas_cache():
+    cache = get_cache()
+    hoje = cache.sincronizar()
+    dados = cache.carregar(hoje - datetime.timedelta(days=JANELA_DIAS), hoje)
+    final_df = metricas_do_cache(dados, hoje, hoje)
+    if final_df is None:
+        print("    Sem dados de execução para processar.")
+        return None
+    # No ciclo ao vivo os abertos vêm do status atual, como nos outros modos
+    abertos = pd.read_sql(text(f"""
+        SELECT id_regra, COUNT(*) AS incidentes_abertos
+        FROM incidentes
+        WHERE status = 'OPEN' AND data_abertura >= CURRENT_DATE - INTERVAL '{JANELA_DIAS} days'
+        GROUP BY id_regra
+    """), engine)
+    return final_df.drop(columns='incidentes_abertos').merge(abertos, on='id_regra', how='left')
+
+def reconstruir_metricas(de, ate, somente_cache=False):
+    # Recalcula metricas_diarias de cada dia entre de e ate; o banco só é lido para completar o cache
+    cache = get_cache()
+    inicio = de - datetime.timedelta(days=JANELA_DIAS)
+    hoje = datetime.date.today() if somente_cache else cache.sincronizar(inicio, ate)
+    ate = min(ate, hoje)
+    dados = cache.carregar(inicio, ate)
+    ids_regras = ler_ids_regras()
+    dias = 0
+    while de <= ate:
+        final_df = metricas_do_cache(dados, de, hoje)
+        final_df = filtrar_regras_validas(final_df, ids_regras) if final_df is not None else None
+        if final_df is not None:
+            publicar_metricas(final_df, de)
+            dias += 1
+        de += datetime.timedelta(days=1)
+    print(f" {dias} dias reconstruídos em metricas_diarias")
+
+def publicar_metricas(final_df, data_referencia=None):
+    # COPY para uma tabela temporária e upsert em metricas_diarias na mesma transação:
+    # o dashboard nunca vê o dia vazio nem pela metade.
+    final_df = final_df.copy()
+    data_referencia = data_referencia or pd.Timestamp.now().date()
+    final_df['data_referencia'] = data_referencia
+    for coluna in COLUNAS_INTEIRAS:
+        if coluna in final_df:
+            final_df[coluna] = final_df[coluna].round().astype('int64')
+
+    colunas = list(final_df.columns)
+    lista_colunas = ", ".join(colunas)
+    atualizacoes = ", ".join(f"{c} = EXCLUDED.{c}" for c in colunas if c not in ('data_referencia', 'id_regra'))
+    csv = io.StringIO()
+    final_df.to_csv(csv, index=False, header=False, columns=colunas)
+    csv.seek(0)
+
+    conn = engine.raw_connection()
+    try:
+        cur = conn.cursor()
+        cur.execute("CREATE TEMP TABLE metricas_staging (LIKE metricas_diarias INCLUDING DEFAULTS) ON COMMIT DROP")
+        cur.execute(f"COPY metricas_staging ({lista_colunas}) FROM STDIN WITH (FORMAT csv)", stream=csv)
+        cur.execute(f"""
+            INSERT INTO metricas_diarias ({lista_colunas}, updated_at)
+            SELECT {lista_colunas}, NOW() FROM metricas_staging
+            ON CONFLICT (data_referencia, id_regra) DO UPDATE SET {atualizacoes}, updated_at = NOW()
+        """)
+        cur.execute("""
+            DELETE FROM metricas_diarias m
+            WHERE m.data_referencia = %s
+              AND NOT EXISTS (SELECT 1 FROM metricas_staging s WHERE s.id_regra = m.id_regra)
+        """, (data_referencia,))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+def calcular_metricas(modo=None):
+    modo = modo or ANALYTICS_MODO
+    print(f"\niniciodos graficos {datetime.datetime.now()} (modo {modo})...")
+
+    try:
+        if modo == 'incremental':
+            final_df = metricas_incrementais()
+        elif modo == 'streaming':
+            final_df = metricas_streaming()
+        elif modo == 'sql':
+            final_df = metricas_sql()
+        elif modo == 'cache':
+            final_df = metricas_cache()
+        else:
+            final_df = metricas_completas()
+        if final_df is None:
+            return
+
+        final_df = filtrar_regras_validas(final_df)
+        if final_df is None:
+            return
+
+        publicar_metricas(final_df)
 
-        final_df.to_sql('metricas_diarias', engine, if_exists='append', index=False, method='multi')
-        
         print(" Análise concluída com sucesso!")
 
     except Exception as e:
@@ -116,7 +740,24 @@ def calcular_metricas():
         traceback.print_exc()
 
 if __name__ == "__main__":
-    print(" iniciou ")
-    while True:
-        calcular_metricas()
-        time.sleep(60)
+    parser = argparse.ArgumentParser()
+    comandos = parser.add_subparsers(dest='comando')
+    sub = comandos.add_parser('cache', help="sincroniza o cache colunar local")
+    sub.add_argument('--dias', type=int, default=JANELA_DIAS)
+    sub = comandos.add_parser('reconstruir', help="recalcula metricas_diarias de um intervalo a partir do cache")
+    sub.add_argument('--de', type=datetime.date.fromisoformat, required=True)
+    sub.add_argument('--ate', type=datetime.date.fromisoformat, required=True)
+    sub.add_argument('--somente-cache', action='store_true', help="não completa o cache com o banco")
+    args = parser.parse_args()
+
+    if args.comando == 'cache':
+        get_cache().sincronizar(datetime.date.today() - datetime.timedelta(days=args.dias))
+    elif args.comando == 'reconstruir':
+        garantir_schema()
+        reconstruir_metricas(args.de, args.ate, args.somente_cache)
+    else:
+        print(" iniciou ")
+        garantir_schema()
+        while True:
+            calcular_metricas()
+            time.sleep(60)
@@ -0,0 +1,91 @@
+# Compara os backends de calcular_metricas (tempo, pico de memória e paridade com o pandas completo).
+# Uso: DATABASE_URL=postgresql://localhost/plantao_bench python -m benchmarks.bench_analytics --repeticoes 3
+import argparse
+import json
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+import analytics
+
+BACKENDS = {
+    'completo': analytics.metricas_completas,
+    'incremental_frio': None,
+    'incremental_quente': analytics.metricas_incrementais,
+    'streaming': analytics.metricas_streaming,
+    'sql': analytics.metricas_sql,
+}
+if analytics.pa is not None:
+    BACKENDS['cache'] = analytics.metricas_cache
+
+
+def incremental_frio():
+    analytics._estado_incremental = analytics.EstadoIncremental()
+    return analytics.metricas_incrementais()
+
+
+def calcular(backend):
+    funcao = BACKENDS[backend] or incremental_frio
+    df = funcao()
+    if df is None:
+        return None
+    df = analytics.filtrar_regras_validas(df)
+    return None if df is None else df.sort_values('id_regra').reset_index(drop=True)
+
+
+def comparar(referencia, df, tolerancia=1e-6):
+    if referencia is None or df is None:
+        return referencia is None and df is None
+    if list(referencia['id_regra']) != list(df['id_regra']):
+        return False
+    colunas = analytics.COLUNAS_METRICAS
+    return bool(np.allclose(
+        referencia[colunas].astype(float).to_numpy(), df[colunas].astype(float).to_numpy(),
+        rtol=tolerancia, atol=tolerancia,
+    ))
+
+
+def medir(backend, repeticoes):
+    tempos, picos, df = [], [], None
+    for _ in range(repeticoes):
+        tracemalloc.start()
+        inicio = time.perf_counter()
+        df = calcular(backend)
+        tempos.append(time.perf_counter() - inicio)
+        picos.append(tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+    return df, {
+        'backend': backend,
+        'tempo_mediano_s': round(float(np.median(tempos)), 4),
+        'tempo_min_s': round(min(tempos), 4),
+        'pico_memoria_mb': round(max(picos) / 2 ** 20, 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--repeticoes', type=int, default=3)
+    parser.add_argument('--backends', nargs='+', default=list(BACKENDS))
+    args = parser.parse_args()
+
+    analytics.ANALYTICS_ESTADO = None
+    analytics.garantir_schema()
+
+    referencia, resultado = medir('completo', args.repeticoes)
+    resultados = [dict(resultado, paridade=True)]
+    for backend in args.backends:
+        if backend == 'completo':
+            continue
+        df, resultado = medir(backend, args.repeticoes)
+        resultado['paridade'] = comparar(referencia, df)
+        resultados.append(resultado)
+
+    print(json.dumps(resultados, indent=2))
+    if not all(r['paridade'] for r in resultados):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
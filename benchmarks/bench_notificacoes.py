@@ -0,0 +1,77 @@
+# Throughput da fila de notificações (reserva com SKIP LOCKED) contra um Postgres local.
+# Uso: DATABASE_URL=postgresql://localhost/plantao_bench python -m benchmarks.bench_notificacoes --linhas 5000
+import argparse
+import collections
+import json
+import threading
+import time
+
+import runner
+
+TITULO_BENCH = 'BENCH_NOTIFICACOES'
+
+
+def semear(linhas):
+    with runner.conexao_db() as conn:
+        cur = conn.cursor()
+        cur.execute("DELETE FROM notificacoes WHERE titulo = %s", (TITULO_BENCH,))
+        cur.execute("""
+            INSERT INTO notificacoes (canal, destinatario, mensagem, status, titulo)
+            SELECT 'PUSH', 'bench' || g || '@local', 'Mensagem de benchmark', 'PENDING', %s
+            FROM generate_series(1, %s) g
+        """, (TITULO_BENCH, linhas))
+        conn.commit()
+
+
+def contar_enviadas():
+    with runner.conexao_db() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT COUNT(*) AS total FROM notificacoes WHERE titulo = %s AND status = 'enviado'", (TITULO_BENCH,))
+        total = cur.fetchone()['total']
+        cur.execute("DELETE FROM notificacoes WHERE titulo = %s", (TITULO_BENCH,))
+        conn.commit()
+        return total
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--linhas', type=int, default=2000)
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--latencia-ms', type=float, default=5, help="latência simulada de cada envio")
+    args = parser.parse_args()
+
+    runner.garantir_schema()
+    envios = collections.Counter()
+    lock = threading.Lock()
+
+    def envio_simulado(notif):
+        time.sleep(args.latencia_ms / 1000)
+        with lock:
+            envios[notif['id']] += 1
+        return True, None
+
+    runner._enviar_notificacao = envio_simulado
+    # Sem janela de digest: mede a vazão da reserva, não o tempo que a fila fica retida
+    runner.NOTIF_JANELA_S = 0
+
+    resultados = []
+    for workers in args.workers:
+        envios.clear()
+        semear(args.linhas)
+        inicio = time.perf_counter()
+        runner.processar_notificacoes(workers=workers)
+        duracao = time.perf_counter() - inicio
+        resultados.append({
+            'workers': workers,
+            'linhas': args.linhas,
+            'duracao_s': round(duracao, 3),
+            'notificacoes_por_s': round(args.linhas / duracao, 1),
+            'marcadas_enviado': contar_enviadas(),
+            'envios_duplicados': sum(n - 1 for n in envios.values() if n > 1),
+        })
+
+    print(json.dumps(resultados, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,229 @@
+# Suíte de benchmarks do runner e do analytics em vários tamanhos de base, com resultado em JSON.
+# APAGA as tabelas do banco apontado: use um banco descartável.
+# Uso: DATABASE_URL=postgresql://postgres@127.0.0.1/plantao_bench python -m benchmarks.bench_suite \
+#          --tamanhos 1 5 20 --saida bench.json [--comparar bench_anterior.json]
+import argparse
+import datetime
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import time
+from urllib.parse import urlparse
+
+from benchmarks import dados, servicos
+
+
+def commit_atual():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], text=True, stderr=subprocess.DEVNULL).strip()
+    except Exception:
+        return None
+
+
+def contar(runner, sql, params=None):
+    with runner.conexao_db() as conn:
+        cur = conn.cursor()
+        cur.execute(sql, params)
+        total = list(cur.fetchone().values())[0]
+        conn.commit()
+        return total
+
+
+def aguardar(condicao, limite_s=300, passo_s=0.005):
+    fim = time.monotonic() + limite_s
+    while not condicao():
+        if time.monotonic() > fim:
+            raise TimeoutError("Benchmark não terminou dentro do limite")
+        time.sleep(passo_s)
+
+
+def aguardar_estavel(leitura, janela_s=0.5, limite_s=30):
+    # Espera os envios em background (push) pararem de chegar
+    fim = time.monotonic() + limite_s
+    anterior = leitura()
+    while time.monotonic() < fim:
+        time.sleep(janela_s)
+        atual = leitura()
+        if atual == anterior:
+            return atual
+        anterior = atual
+    return anterior
+
+
+def medir_ciclo_regras(runner):
+    # Agenda nova, sem jitter: todas as regras vencem no primeiro tick (as execuções semeadas terminam 1h atrás)
+    runner.JITTER_REGRA = 0
+    runner.agendador_regras = runner.AgendadorRegras()
+    runner.indice_incidentes.invalidar()
+    runner.indice_escalas.invalidar()
+    incidentes_antes = contar(runner, "SELECT COUNT(*) FROM incidentes")
+
+    inicio = time.perf_counter()
+    runner.check_rules()
+    aguardar(lambda: runner.agendador_regras.ultimo_ciclo is not None)
+    duracao = time.perf_counter() - inicio
+    runner.buffer_execucoes.flush()
+    runner.buffer_recorrencias.flush()
+
+    ciclo = runner.agendador_regras.ultimo_ciclo
+    return {
+        'duracao_s': round(duracao, 4),
+        'regras': ciclo['regras'],
+        'falhas': ciclo['falhas'],
+        'duracao_max_regra_s': ciclo['duracao_max_s'],
+        'incidentes_novos': contar(runner, "SELECT COUNT(*) FROM incidentes") - incidentes_antes,
+    }
+
+
+def medir_escalonamento(runner):
+    notificacoes_antes = contar(runner, "SELECT COUNT(*) FROM notificacoes")
+    with runner.conexao_db() as conn:
+        inicio = time.perf_counter()
+        runner._escalonar(conn)
+        escalonamento = time.perf_counter() - inicio
+        inicio = time.perf_counter()
+        runner._verificar_acks_escalas(conn)
+        acks = time.perf_counter() - inicio
+    return {
+        'escalonamento_s': round(escalonamento, 4),
+        'acks_escalas_s': round(acks, 4),
+        'incidentes_escalados': contar(runner, "SELECT COUNT(*) FROM incidentes WHERE nivel_escalonamento > 0"),
+        'escalas_reatribuidas': contar(runner, "SELECT COUNT(*) FROM escalas WHERE id_usuario_original IS NOT NULL"),
+        'notificacoes_geradas': contar(runner, "SELECT COUNT(*) FROM notificacoes") - notificacoes_antes,
+    }
+
+
+def medir_fila_notificacoes(runner, smtp, push, workers):
+    pendentes = contar(runner, "SELECT COUNT(*) FROM notificacoes WHERE status IN %s", (runner.STATUS_PENDENTES,))
+    emails_antes, pushes_antes = smtp.mensagens, push.chamadas
+
+    inicio = time.perf_counter()
+    enviadas = runner.processar_notificacoes(workers=workers)
+    duracao = time.perf_counter() - inicio
+    pushes = aguardar_estavel(lambda: push.chamadas) - pushes_antes
+    return {
+        'workers': workers,
+        'pendentes': pendentes,
+        'enviadas': enviadas,
+        'duracao_s': round(duracao, 4),
+        'notificacoes_por_s': round(enviadas / duracao, 1) if duracao else None,
+        'emails_recebidos': smtp.mensagens - emails_antes,
+        'pushes_recebidos': pushes,
+        'falhas': contar(runner, "SELECT COUNT(*) FROM notificacoes WHERE status = 'falha'"),
+        'pendentes_restantes': contar(runner, "SELECT COUNT(*) FROM notificacoes WHERE status IN %s",
+                                      (runner.STATUS_PENDENTES + ('PROCESSANDO',),)),
+    }
+
+
+def medir_analytics(backends, repeticoes):
+    from benchmarks import bench_analytics
+    referencia, resultado = bench_analytics.medir('completo', repeticoes)
+    resultados = [dict(resultado, paridade=True)]
+    for backend in backends:
+        if backend == 'completo':
+            continue
+        df, resultado = bench_analytics.medir(backend, repeticoes)
+        resultados.append(dict(resultado, paridade=bench_analytics.comparar(referencia, df)))
+    return resultados
+
+
+def metricas_planas(resultado):
+    # {tamanho/secao/chave: valor} só com os tempos e vazões, para comparar execuções
+    planas = {}
+    for bloco in resultado['resultados']:
+        prefixo = f"x{bloco['tamanho']}"
+        for secao in ('check_rules', 'escalonamento', 'notificacoes'):
+            for chave, valor in bloco[secao].items():
+                if chave.endswith('_s') or chave.endswith('_por_s'):
+                    planas[f"{prefixo}/{secao}/{chave}"] = valor
+        for item in bloco['analytics']:
+            planas[f"{prefixo}/analytics/{item['backend']}/tempo_mediano_s"] = item['tempo_mediano_s']
+            planas[f"{prefixo}/analytics/{item['backend']}/pico_memoria_mb"] = item['pico_memoria_mb']
+    return planas
+
+
+def comparar_com(anterior, atual):
+    antes, depois = metricas_planas(anterior), metricas_planas(atual)
+    print(f"\nComparação com {anterior.get('commit')} -> {atual.get('commit')}")
+    for chave in sorted(set(antes) & set(depois)):
+        a, d = antes[chave], depois[chave]
+        if not a or d is None:
+            continue
+        variacao = (d - a) / a * 100
+        # Para vazão, maior é melhor; para tempo e memória, menor
+        pior = variacao < -10 if chave.endswith('_por_s') else variacao > 10
+        print(f"  {chave:60s} {a:>10} -> {d:>10} ({variacao:+.1f}%){'  <-- regressão' if pior else ''}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--tamanhos', type=float, nargs='+', default=[1, 5])
+    parser.add_argument('--semente', type=int, default=42)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--repeticoes', type=int, default=3)
+    parser.add_argument('--backends', nargs='+', default=['completo', 'incremental_frio', 'streaming', 'sql'])
+    parser.add_argument('--latencia-smtp-ms', type=float, default=5)
+    parser.add_argument('--latencia-push-ms', type=float, default=5)
+    parser.add_argument('--saida', default='bench_resultados.json')
+    parser.add_argument('--comparar', help="JSON de uma execução anterior")
+    parser.add_argument('--forcar', action='store_true', help="permite banco cujo nome não contém 'bench'")
+    args = parser.parse_args()
+
+    banco = urlparse(os.getenv("DATABASE_URL", "")).path.lstrip('/')
+    if 'bench' not in banco and not args.forcar:
+        sys.exit(f"Recusando apagar o banco '{banco}'. Use um banco *_bench ou --forcar.")
+
+    smtp = servicos.iniciar(servicos.ServidorSMTPLocal(args.latencia_smtp_ms))
+    push = servicos.iniciar(servicos.ServidorPushLocal(args.latencia_push_ms))
+    # O runner lê a configuração no import. Sem janela de digest: a fila inteira (inclusive o que o
+    # escalonamento acabou de gerar) é drenada na medição, ainda agrupada por destinatário.
+    os.environ.update({
+        'PUSH_URL': push.url, 'EMAIL_HOST': '127.0.0.1', 'EMAIL_PORT': str(smtp.porta),
+        'EMAIL_USER': 'bench@bench.local', 'EMAIL_PASS': 'bench', 'EMAIL_STARTTLS': 'false',
+        'NOTIF_JANELA_S': '0',
+    })
+    import runner
+    import analytics
+    logging.getLogger().setLevel(logging.ERROR)
+    sys.stdout = open(os.devnull, 'w')  # o runner usa print no caminho quente
+    analytics.ANALYTICS_ESTADO = None
+
+    runner.garantir_schema()
+    analytics.garantir_schema()
+    resultado = {
+        'gerado_em': datetime.datetime.now().isoformat(timespec='seconds'),
+        'commit': commit_atual(),
+        'python': platform.python_version(),
+        'parametros': vars(args),
+        'resultados': [],
+    }
+    for tamanho in args.tamanhos:
+        with runner.conexao_db() as conn:
+            dados.limpar(conn)
+            linhas = dados.semear(conn, semente=args.semente, **dados.escala(tamanho))
+        bloco = {'tamanho': tamanho, 'linhas': linhas}
+        bloco['check_rules'] = medir_ciclo_regras(runner)
+        bloco['escalonamento'] = medir_escalonamento(runner)
+        bloco['notificacoes'] = medir_fila_notificacoes(runner, smtp, push, args.workers)
+        bloco['analytics'] = medir_analytics(args.backends, args.repeticoes)
+        resultado['resultados'].append(bloco)
+        print(f"tamanho {tamanho}: ok", file=sys.stderr)
+
+    sys.stdout = sys.__stdout__
+    with open(args.saida, 'w') as f:
+        json.dump(resultado, f, indent=2, default=str)
+    print(json.dumps(resultado, indent=2, default=str))
+    if args.comparar:
+        with open(args.comparar) as f:
+            comparar_com(json.load(f), resultado)
+
+    runner.despachante_push.fechar()
+    smtp.shutdown()
+    push.shutdown()
+
+
+if __name__ == '__main__':
+    main()
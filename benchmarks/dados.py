@@ -0,0 +1,124 @@
+# Gerador de dados sintéticos para os benchmarks. Tudo é semeado em SQL (generate_series + setseed),
+# então o mesmo tamanho e semente geram a mesma base. Só rode contra um banco descartável.
+from psycopg2.extras import RealDictCursor
+
+TABELAS = [
+    'notificacoes', 'eventos_incidente', 'ocorrencias_incidente', 'incidentes', 'execucoes_regras',
+    'escalas', 'usuarios_roles', 'usuarios', 'regras', 'metricas_diarias',
+]
+
+CANAIS = 10
+
+BASE = {
+    'regras': 20,
+    'usuarios': 30,
+    'escalas': 200,
+    'incidentes': 1000,
+    'execucoes': 20000,
+    'notificacoes': 2000,
+}
+
+
+def escala(fator):
+    return {tabela: max(1, int(qtd * fator)) for tabela, qtd in BASE.items()}
+
+
+def limpar(conn):
+    cur = conn.cursor()
+    cur.execute(f"TRUNCATE {', '.join(TABELAS)} RESTART IDENTITY CASCADE")
+    conn.commit()
+
+
+def semear(conn, regras, usuarios, escalas, incidentes, execucoes, notificacoes, semente=42):
+    cur = conn.cursor(cursor_factory=RealDictCursor)
+    cur.execute("SELECT setseed(%s)", (((semente % 1000) / 1000.0),))
+
+    cur.execute("""
+        INSERT INTO usuarios (nome, email, role, recebe_email, recebe_push, inicio_nao_perturbe, fim_nao_perturbe)
+        SELECT 'Usuário ' || g, 'usuario' || g || '@bench.local',
+               CASE WHEN g <= 2 THEN 'admin' ELSE 'operador' END,
+               random() > 0.1, random() > 0.1,
+               CASE WHEN random() < 0.2 THEN TIME '22:00' END,
+               CASE WHEN random() < 0.2 THEN TIME '23:59' END
+        FROM generate_series(1, %s) g
+    """, (usuarios,))
+
+    cur.execute("""
+        INSERT INTO regras (nome, sql, active, qtd_erro_max, prioridade, role_target)
+        SELECT 'bench_regra_' || g, 'SELECT 0', true, 1 + (random() * 40)::int, 1 + g %% 3, 'C' || (g %% %s)
+        FROM generate_series(1, %s) g
+    """, (CANAIS, regras))
+    # Regras consultam execucoes_regras como uma regra real faria (contagem de falhas no último dia)
+    cur.execute("""
+        UPDATE regras SET sql = 'SELECT COUNT(*) AS falhas FROM execucoes_regras WHERE id_regra = ' || id ||
+                                ' AND NOT sucesso AND data_inicio > NOW() - INTERVAL ''1 day'''
+    """)
+
+    # Execuções dos últimos 30 dias, terminando 1h atrás para todas as regras estarem vencidas
+    cur.execute("""
+        INSERT INTO execucoes_regras (id_regra, data_inicio, data_fim, sucesso, linhas_afetadas)
+        SELECT t.id_regra, t.inicio,
+               CASE WHEN random() > 0.02 THEN t.inicio + random() * INTERVAL '900 milliseconds' END,
+               random() > 0.1, (random() * 50)::int
+        FROM (
+            SELECT 1 + floor(random() * %s)::int AS id_regra,
+                   NOW() - INTERVAL '1 hour' - random() * INTERVAL '30 days' AS inicio
+            FROM generate_series(1, %s) g
+        ) t
+    """, (regras, execucoes))
+
+    # 10% das escalas começam nos próximos 5 minutos sem ACK (alimentam o job de no-show)
+    cur.execute("""
+        INSERT INTO escalas (id_usuario, canal, data_inicio, data_fim, status_confirmacao)
+        SELECT 1 + floor(random() * %s)::int, 'C' || (t.g %% %s), t.inicio, t.inicio + (4 + random() * 8) * INTERVAL '1 hour',
+               CASE WHEN t.proxima THEN NULL WHEN random() < 0.5 THEN 'ACK_OK' END
+        FROM (
+            SELECT g, g %% 10 = 0 AS proxima,
+                   CASE WHEN g %% 10 = 0 THEN NOW() + random() * INTERVAL '5 minutes'
+                        ELSE NOW() - INTERVAL '12 hours' + random() * INTERVAL '36 hours' END AS inicio
+            FROM generate_series(1, %s) g
+        ) t
+    """, (usuarios, CANAIS, escalas))
+
+    # 20% abertos (parte já vencida para o escalonamento), 10% em ACK, o resto fechado
+    cur.execute("""
+        INSERT INTO incidentes (id_regra, status, prioridade, detalhes, data_abertura, data_ultima_ocorrencia)
+        SELECT t.id_regra, t.status, 1 + floor(random() * 3)::int, 'Incidente sintético',
+               t.abertura, t.abertura + random() * INTERVAL '1 hour'
+        FROM (
+            SELECT 1 + floor(random() * %s)::int AS id_regra,
+                   CASE WHEN g %% 10 < 2 THEN 'OPEN' WHEN g %% 10 = 2 THEN 'ACK' ELSE 'CLOSED' END AS status,
+                   CASE WHEN g %% 10 < 2 THEN NOW() - random() * INTERVAL '4 hours'
+                        ELSE NOW() - random() * INTERVAL '30 days' END AS abertura
+            FROM generate_series(1, %s) g
+        ) t
+    """, (regras, incidentes))
+    cur.execute("""
+        INSERT INTO eventos_incidente (id_incidente, tipo, usuario, "timestamp")
+        SELECT i.id_incidente, e.tipo, 'usuario1@bench.local', i.data_abertura + e.atraso * random() * INTERVAL '1 hour'
+        FROM incidentes i
+        CROSS JOIN LATERAL (VALUES ('ACK', 1), ('CLOSE', 8)) e (tipo, atraso)
+        WHERE (e.tipo = 'ACK' AND i.status IN ('ACK', 'CLOSED')) OR (e.tipo = 'CLOSE' AND i.status = 'CLOSED')
+    """)
+
+    cur.execute("""
+        INSERT INTO notificacoes (id_usuario, canal, destinatario, titulo, mensagem, status, created_at)
+        SELECT u, CASE WHEN g %% 2 = 0 THEN 'EMAIL' ELSE 'PUSH' END, 'usuario' || u || '@bench.local',
+               'Benchmark', 'Mensagem sintética ' || g, 'PENDING', NOW() - random() * INTERVAL '1 hour'
+        FROM (SELECT g, 1 + floor(random() * %s)::int AS u FROM generate_series(1, %s) g) x
+    """, (usuarios, notificacoes))
+
+    cur.execute("""
+        INSERT INTO sistema_status (servico, status)
+        SELECT 'RUNNER_PYTHON', 'OFFLINE'
+        WHERE NOT EXISTS (SELECT 1 FROM sistema_status WHERE servico = 'RUNNER_PYTHON')
+    """)
+    conn.commit()
+    cur.execute("ANALYZE")
+
+    contagens = {}
+    for tabela in TABELAS:
+        cur.execute(f"SELECT COUNT(*) AS n FROM {tabela}")
+        contagens[tabela] = cur.fetchone()['n']
+    conn.commit()
+    return contagens
@@ -0,0 +1,90 @@
+# Substitutos locais do SMTP e do endpoint /notify/push da API, com latência configurável,
+# para medir o runner sem depender de Gmail/Firebase.
+import http.server
+import socketserver
+import threading
+import time
+
+
+class _HandlerSMTP(socketserver.StreamRequestHandler):
+    def _responder(self, linha):
+        self.wfile.write((linha + "\r\n").encode())
+
+    def handle(self):
+        servidor = self.server
+        self._responder("220 bench.local ESMTP")
+        while True:
+            linha = self.rfile.readline()
+            if not linha:
+                return
+            comando = linha.decode(errors='replace').strip().upper()
+            if comando.startswith(("EHLO", "HELO")):
+                self._responder("250-bench.local")
+                self._responder("250 8BITMIME")
+            elif comando == "DATA":
+                self._responder("354 fim com <CRLF>.<CRLF>")
+                while self.rfile.readline() not in (b".\r\n", b".\n", b""):
+                    pass
+                time.sleep(servidor.latencia_s)
+                with servidor.lock:
+                    servidor.mensagens += 1
+                self._responder("250 OK")
+            elif comando == "QUIT":
+                self._responder("221 tchau")
+                return
+            elif comando.startswith(("MAIL", "RCPT", "RSET", "NOOP")):
+                self._responder("250 OK")
+            else:
+                self._responder("502 não suportado")
+
+
+class ServidorSMTPLocal(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, latencia_ms=0):
+        super().__init__(("127.0.0.1", 0), _HandlerSMTP)
+        self.latencia_s = latencia_ms / 1000
+        self.lock = threading.Lock()
+        self.mensagens = 0
+
+    @property
+    def porta(self):
+        return self.server_address[1]
+
+
+class _HandlerPush(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        time.sleep(self.server.latencia_s)
+        with self.server.lock:
+            self.server.chamadas += 1
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", "2")
+        self.end_headers()
+        self.wfile.write(b"{}")
+
+    def log_message(self, *args):
+        pass
+
+
+class ServidorPushLocal(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, latencia_ms=0):
+        super().__init__(("127.0.0.1", 0), _HandlerPush)
+        self.latencia_s = latencia_ms / 1000
+        self.lock = threading.Lock()
+        self.chamadas = 0
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}/notify/push"
+
+
+def iniciar(servidor):
+    threading.Thread(target=servidor.serve_forever, daemon=True).start()
+    return servidor
@@ -1,23 +1,207 @@
 import time
 import datetime
-import schedule
+import signal
 import psycopg2
+import psycopg2.extensions
 import logging
 import os
 import smtplib
 from email.mime.text import MIMEText
 from dotenv import load_dotenv
-from psycopg2.extras import RealDictCursor
+from psycopg2.extras import RealDictCursor, execute_values
+from psycopg2 import pool as pg_pool
+from contextlib import contextmanager
 import firebase_admin
 from firebase_admin import credentials, messaging
 from email.mime.multipart import MIMEMultipart
 import json
 import requests
+import numpy as np
+import threading
+import heapq
+import random
+import atexit
+import socket
+import queue
+import select
+import bisect
+import hashlib
+import collections
+import sys
+import http.server
+from concurrent.futures import ThreadPoolExecutor
 
 load_dotenv()
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
 DB_URL = os.getenv("DATABASE_URL")
+RUNNER_WORKERS = int(os.getenv("RUNNER_WORKERS", 8))
+TIMEOUT_PADRAO_REGRA_MS = int(os.getenv("RUNNER_TIMEOUT_REGRA_MS", 20000))
+INTERVALO_PADRAO_REGRA_S = float(os.getenv("RUNNER_INTERVALO_PADRAO_S", 30))
+JITTER_REGRA = float(os.getenv("RUNNER_JITTER", 0.1))
+BACKOFF_MAX_S = float(os.getenv("RUNNER_BACKOFF_MAX_S", 3600))
+FATOR_DURACAO_REGRA = float(os.getenv("RUNNER_FATOR_DURACAO", 2))
+RECARGA_REGRAS_S = float(os.getenv("RUNNER_RECARGA_REGRAS_S", 30))
+TICK_REGRAS_S = int(os.getenv("RUNNER_TICK_S", 1))
+LOG_LOTE_MAX = int(os.getenv("RUNNER_LOG_LOTE_MAX", 500))
+LOG_INTERVALO_S = float(os.getenv("RUNNER_LOG_INTERVALO_S", 5))
+NOTIF_WORKERS = int(os.getenv("NOTIF_WORKERS", 4))
+NOTIF_LOTE = int(os.getenv("NOTIF_LOTE", 50))
+NOTIF_VISIBILIDADE_S = int(os.getenv("NOTIF_VISIBILIDADE_S", 120))
+NOTIF_MAX_TENTATIVAS = int(os.getenv("NOTIF_MAX_TENTATIVAS", 5))
+NOTIF_RETRY_BASE_S = int(os.getenv("NOTIF_RETRY_BASE_S", 30))
+NOTIF_VARREDURA_S = int(os.getenv("NOTIF_VARREDURA_S", 60))
+NOTIF_DIGEST = os.getenv("NOTIF_DIGEST", "true").lower() != "false"
+NOTIF_JANELA_S = float(os.getenv("NOTIF_JANELA_S", 30))
+NOTIF_PRIORIDADES_IMEDIATAS = [p.strip() for p in os.getenv("NOTIF_PRIORIDADES_IMEDIATAS", "critica,alta").split(",") if p.strip()]
+STATUS_PENDENTES = ('PENDING', 'pending', 'Pending', 'pendente')
+ID_INSTANCIA = f"{socket.gethostname()}:{os.getpid()}"
+EMAIL_SESSOES = int(os.getenv("EMAIL_SESSOES", 2))
+EMAIL_OCIOSO_S = float(os.getenv("EMAIL_OCIOSO_S", 60))
+EMAIL_STARTTLS = os.getenv("EMAIL_STARTTLS", "true").lower() != "false"
+PUSH_URL = os.getenv("PUSH_URL", "http://localhost:8000/notify/push")
+PUSH_CONCORRENCIA = int(os.getenv("PUSH_CONCORRENCIA", 8))
+PUSH_TENTATIVAS = int(os.getenv("PUSH_TENTATIVAS", 3))
+PUSH_TIMEOUT_S = float(os.getenv("PUSH_TIMEOUT_S", 2))
+PUSH_BACKOFF_S = float(os.getenv("PUSH_BACKOFF_S", 0.5))
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", 2))
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", RUNNER_WORKERS + 4))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", 10))
+DB_POOL_CHECK_SEGUNDOS = float(os.getenv("DB_POOL_CHECK_SEGUNDOS", 30))
+DB_REPLICA_URL = os.getenv("DATABASE_REPLICA_URL")
+REPLICA_POOL_MAX = int(os.getenv("REPLICA_POOL_MAX", RUNNER_WORKERS + 2))
+REPLICA_LAG_MAX_S = float(os.getenv("REPLICA_LAG_MAX_S", 30))
+REPLICA_LAG_CHECK_S = float(os.getenv("REPLICA_LAG_CHECK_S", 5))
+REPLICA_ACIMA_DO_LAG = os.getenv("REPLICA_ACIMA_DO_LAG", "primario").lower()  # 'primario' ou 'pular'
+INDICE_RESYNC_S = float(os.getenv("RUNNER_INDICE_RESYNC_S", 300))
+RECORRENCIA_INTERVALO_S = float(os.getenv("RUNNER_RECORRENCIA_INTERVALO_S", 60))
+CANAL_INCIDENTES = "incidentes_status"
+CANAL_NOTIFICACOES = "notificacoes_pendentes"
+CANAL_ESCALAS = "escalas_alteradas"
+CANAL_TOKENS = "tokens_alterados"
+TOKENS_TTL_S = float(os.getenv("RUNNER_TOKENS_TTL_S", 300))
+HISTORICO_CAPACIDADE = int(os.getenv("RUNNER_HISTORICO_CAPACIDADE", 120))
+HISTORICO_AQUECIMENTO_DIAS = int(os.getenv("RUNNER_HISTORICO_AQUECIMENTO_DIAS", 7))
+# Parâmetros padrão de cada modo de regras.modo_avaliacao; regras.parametros_avaliacao sobrescreve
+MODOS_AVALIACAO = {
+    'limite': {},
+    'taxa': {'janela': 10, 'min_amostras': 3, 'taxa_min': 1.0},
+    'media_movel': {'janela': 20, 'min_amostras': 5, 'desvio': 0.5},
+    'zscore': {'janela': 60, 'min_amostras': 10, 'z': 3.0},
+}
+FCM_LOTE_MAX = 500  # limite de tokens por multicast do FCM
+ESCALAS_TTL_S = float(os.getenv("RUNNER_ESCALAS_TTL_S", 60))
+ESCALAS_HORIZONTE_H = int(os.getenv("RUNNER_ESCALAS_HORIZONTE_H", 24))
+JOBS_TOLERANCIA_ATRASO_S = float(os.getenv("RUNNER_JOBS_TOLERANCIA_S", 1))
+DESLIGAMENTO_S = float(os.getenv("RUNNER_DESLIGAMENTO_S", 30))
+CLUSTER_ATIVO = os.getenv("RUNNER_CLUSTER", "false").lower() == "true"
+CLUSTER_SHARDS = int(os.getenv("RUNNER_CLUSTER_SHARDS", 64))
+CLUSTER_VNODES = int(os.getenv("RUNNER_CLUSTER_VNODES", 64))
+CLUSTER_MEMBRO_TTL_S = float(os.getenv("RUNNER_CLUSTER_MEMBRO_TTL_S", 3 * RECARGA_REGRAS_S))
+CLUSTER_RETENTATIVA_S = float(os.getenv("RUNNER_CLUSTER_RETENTATIVA_S", 5))
+CLASSE_LOCK_CLUSTER = 20557  # primeiro int dos advisory locks do cluster; shard N = (classe, N), líder = (classe, -1)
+METRICAS_HOST = os.getenv("RUNNER_METRICAS_HOST", "127.0.0.1")
+METRICAS_PORTA = int(os.getenv("RUNNER_METRICAS_PORTA", 9108))
+PROFILER_ATIVO = os.getenv("RUNNER_PROFILER", "false").lower() == "true"
+PROFILER_INTERVALO_S = float(os.getenv("RUNNER_PROFILER_INTERVALO_S", 0.01))
+BUCKETS_SEGUNDOS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# Política de escalonamento (README): sem ACK em 45 min sobe a prioridade e avisa os admins;
+# em 2h vai para a gerência. Pode ser trocada por JSON em RUNNER_POLITICA_ESCALONAMENTO.
+# Prioridade na escala do front (1=Alta, 2=Média, 3=Baixa): o nível só aproxima de 1, nunca rebaixa.
+# O nível já atingido fica em incidentes.nivel_escalonamento.
+PRIORIDADE_ALTA = 1
+POLITICA_ESCALONAMENTO = json.loads(os.getenv("RUNNER_POLITICA_ESCALONAMENTO") or "null") or [
+    {"nivel": 1, "minutos": 45, "prioridade": PRIORIDADE_ALTA, "roles": ["admin"], "emails": [], "push_role": "admin",
+     "titulo": "ESCALATION ALERT", "mensagem": "ESCALATION: Operador não deu ACK em 45 min!"},
+    {"nivel": 2, "minutos": 120, "prioridade": PRIORIDADE_ALTA, "roles": [], "emails": ["admin@empresa.com"], "push_role": None,
+     "titulo": "ESCALATION ALERT", "mensagem": "ESCALATION: Operador não respondeu em 2h!"},
+]
+
+SCHEMA_RUNNER = [
+    "ALTER TABLE sistema_status ADD COLUMN IF NOT EXISTS resumo jsonb",
+    "ALTER TABLE regras ADD COLUMN IF NOT EXISTS timeout_ms integer",
+    "ALTER TABLE regras ADD COLUMN IF NOT EXISTS replica_lag_max_s integer",
+    "ALTER TABLE regras ADD COLUMN IF NOT EXISTS modo_avaliacao text NOT NULL DEFAULT 'limite'",
+    "ALTER TABLE regras ADD COLUMN IF NOT EXISTS parametros_avaliacao jsonb",
+    "ALTER TABLE notificacoes ADD COLUMN IF NOT EXISTS tentativas integer NOT NULL DEFAULT 0",
+    "ALTER TABLE notificacoes ADD COLUMN IF NOT EXISTS reservado_ate timestamptz",
+    "ALTER TABLE notificacoes ADD COLUMN IF NOT EXISTS reservado_por text",
+    "ALTER TABLE notificacoes ADD COLUMN IF NOT EXISTS ultimo_erro text",
+    "ALTER TABLE notificacoes ADD COLUMN IF NOT EXISTS despachada_em timestamptz",
+    """CREATE INDEX IF NOT EXISTS idx_notificacoes_despacho ON notificacoes (destinatario, canal, despachada_em)
+       WHERE despachada_em IS NOT NULL""",
+    """CREATE INDEX IF NOT EXISTS idx_notificacoes_fila ON notificacoes (id)
+       WHERE status IN ('PENDING', 'pending', 'Pending', 'pendente', 'PROCESSANDO')""",
+    "ALTER TABLE incidentes ADD COLUMN IF NOT EXISTS ocorrencias integer NOT NULL DEFAULT 1",
+    "ALTER TABLE incidentes ADD COLUMN IF NOT EXISTS nivel_escalonamento integer NOT NULL DEFAULT 0",
+    """CREATE TABLE IF NOT EXISTS ocorrencias_incidente (
+        id bigserial PRIMARY KEY,
+        id_incidente integer NOT NULL,
+        primeira timestamp NOT NULL,
+        ultima timestamp NOT NULL,
+        ocorrencias integer NOT NULL,
+        linhas_max integer
+    )""",
+    "CREATE INDEX IF NOT EXISTS idx_ocorrencias_incidente ON ocorrencias_incidente (id_incidente, primeira)",
+    f"""CREATE OR REPLACE FUNCTION notificar_status_incidente() RETURNS trigger AS $$
+        DECLARE
+            linha incidentes%ROWTYPE;
+        BEGIN
+            IF TG_OP = 'DELETE' THEN linha := OLD; ELSE linha := NEW; END IF;
+            PERFORM pg_notify('{CANAL_INCIDENTES}', json_build_object(
+                'id_incidente', linha.id_incidente,
+                'id_regra', linha.id_regra,
+                'status', CASE WHEN TG_OP = 'DELETE' THEN 'DELETED' ELSE linha.status END
+            )::text);
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql""",
+    f"""CREATE OR REPLACE FUNCTION notificar_notificacao_pendente() RETURNS trigger AS $$
+        BEGIN
+            -- Payload fixo: o Postgres junta NOTIFYs iguais da mesma transação num só
+            PERFORM pg_notify('{CANAL_NOTIFICACOES}', '');
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql""",
+    "DROP TRIGGER IF EXISTS trg_notificacoes_pendentes ON notificacoes",
+    """CREATE TRIGGER trg_notificacoes_pendentes
+       AFTER INSERT ON notificacoes
+       FOR EACH ROW WHEN (NEW.status IN ('PENDING', 'pending', 'Pending', 'pendente'))
+       EXECUTE FUNCTION notificar_notificacao_pendente()""",
+    f"""CREATE OR REPLACE FUNCTION notificar_escalas_alteradas() RETURNS trigger AS $$
+        BEGIN
+            PERFORM pg_notify('{CANAL_ESCALAS}', TG_TABLE_NAME);
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql""",
+    "DROP TRIGGER IF EXISTS trg_escalas_alteradas ON escalas",
+    """CREATE TRIGGER trg_escalas_alteradas
+       AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON escalas
+       FOR EACH STATEMENT EXECUTE FUNCTION notificar_escalas_alteradas()""",
+    "DROP TRIGGER IF EXISTS trg_usuarios_escalas ON usuarios",
+    """CREATE TRIGGER trg_usuarios_escalas
+       AFTER INSERT OR UPDATE OR DELETE ON usuarios
+       FOR EACH STATEMENT EXECUTE FUNCTION notificar_escalas_alteradas()""",
+    f"""CREATE OR REPLACE FUNCTION notificar_tokens_alterados() RETURNS trigger AS $$
+        BEGIN
+            PERFORM pg_notify('{CANAL_TOKENS}', TG_TABLE_NAME);
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql""",
+    "DROP TRIGGER IF EXISTS trg_dispositivos_tokens ON dispositivos_usuarios",
+    """CREATE TRIGGER trg_dispositivos_tokens
+       AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON dispositivos_usuarios
+       FOR EACH STATEMENT EXECUTE FUNCTION notificar_tokens_alterados()""",
+    "DROP TRIGGER IF EXISTS trg_usuarios_roles_tokens ON usuarios_roles",
+    """CREATE TRIGGER trg_usuarios_roles_tokens
+       AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON usuarios_roles
+       FOR EACH STATEMENT EXECUTE FUNCTION notificar_tokens_alterados()""",
+    "DROP TRIGGER IF EXISTS trg_incidentes_status ON incidentes",
+    """CREATE TRIGGER trg_incidentes_status
+       AFTER INSERT OR DELETE OR UPDATE OF status ON incidentes
+       FOR EACH ROW EXECUTE FUNCTION notificar_status_incidente()""",
+]
 
 
 if not firebase_admin._apps:
@@ -32,63 +216,979 @@ if not firebase_admin._apps:
 def get_db_connection():
     return psycopg2.connect(DB_URL, cursor_factory=RealDictCursor)
 
+class Metricas:
+    # Registro mínimo no formato texto do Prometheus (contadores, histogramas e gauges com labels),
+    # para não depender de prometheus_client. Gauges são funções lidas na hora do scrape.
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._tipos = {}
+        self._buckets = {}
+        self._gauges = {}
+        self._valores = collections.defaultdict(float)
+        self._histogramas = {}
+
+    def contador(self, nome, ajuda):
+        self._tipos[nome] = ('counter', ajuda)
+
+    def histograma(self, nome, ajuda, buckets=BUCKETS_SEGUNDOS):
+        self._tipos[nome] = ('histogram', ajuda)
+        self._buckets[nome] = tuple(buckets)
+
+    def gauge(self, nome, ajuda, funcao):
+        # `funcao` retorna um número ou um dict {(('label', 'valor'), ...): número}
+        self._tipos[nome] = ('gauge', ajuda)
+        self._gauges[nome] = funcao
+
+    def incrementar(self, nome, valor=1, **labels):
+        with self._lock:
+            self._valores[(nome, tuple(sorted(labels.items())))] += valor
+
+    def observar(self, nome, valor, **labels):
+        chave = (nome, tuple(sorted(labels.items())))
+        buckets = self._buckets[nome]
+        with self._lock:
+            h = self._histogramas.get(chave)
+            if h is None:
+                h = self._histogramas[chave] = [0] * len(buckets) + [0.0, 0]
+            for i, limite in enumerate(buckets):
+                if valor <= limite:
+                    h[i] += 1
+            h[-2] += valor
+            h[-1] += 1
+
+    @staticmethod
+    def _labels(labels, extra=()):
+        itens = tuple(labels) + tuple(extra)
+        if not itens:
+            return ""
+        escapar = lambda v: str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        return "{" + ",".join(f'{k}="{escapar(v)}"' for k, v in itens) + "}"
+
+    def renderizar(self):
+        with self._lock:
+            valores = dict(self._valores)
+            histogramas = {k: list(v) for k, v in self._histogramas.items()}
+        linhas = []
+        for nome, (tipo, ajuda) in self._tipos.items():
+            linhas.append(f"# HELP {nome} {ajuda}")
+            linhas.append(f"# TYPE {nome} {tipo}")
+            if tipo == 'counter':
+                for (n, labels), valor in valores.items():
+                    if n == nome:
+                        linhas.append(f"{nome}{self._labels(labels)} {valor}")
+            elif tipo == 'histogram':
+                buckets = self._buckets[nome]
+                for (n, labels), h in histogramas.items():
+                    if n != nome:
+                        continue
+                    for limite, qtd in zip(buckets, h):
+                        linhas.append(f"{nome}_bucket{self._labels(labels, [('le', limite)])} {qtd}")
+                    linhas.append(f"{nome}_bucket{self._labels(labels, [('le', '+Inf')])} {h[-1]}")
+                    linhas.append(f"{nome}_sum{self._labels(labels)} {h[-2]}")
+                    linhas.append(f"{nome}_count{self._labels(labels)} {h[-1]}")
+            else:
+                try:
+                    valor = self._gauges[nome]()
+                except Exception as e:
+                    logging.warning(f"Falha ao ler gauge {nome}: {e}")
+                    continue
+                if isinstance(valor, dict):
+                    for labels, v in valor.items():
+                        if v is not None:
+                            linhas.append(f"{nome}{self._labels(labels)} {v}")
+                elif valor is not None:
+                    linhas.append(f"{nome} {valor}")
+        return "\n".join(linhas) + "\n"
+
+metricas = Metricas()
+metricas.histograma("runner_job_duracao_segundos", "Duração de cada execução de job do agendador")
+metricas.histograma("runner_regra_sql_segundos", "Tempo do SQL de cada regra")
+metricas.contador("runner_regra_execucoes_total", "Execuções de regras por resultado")
+metricas.contador("runner_regra_roteamento_total", "Regras por destino da consulta (replica, primario, pulada)")
+metricas.contador("runner_incidentes_total", "Incidentes abertos e recorrências registradas")
+metricas.contador("runner_notificacoes_total", "Notificações da fila por canal e resultado")
+metricas.contador("runner_notificacoes_envios_total", "Mensagens efetivamente enviadas (individual ou digest)")
+metricas.histograma("runner_smtp_envio_segundos", "Tempo de envio de cada e-mail (sessão + sendmail)")
+metricas.histograma("runner_push_segundos", "Latência de cada chamada HTTP de push")
+metricas.contador("runner_push_total", "Pushes por resultado")
+
+class ProfilerAmostragem:
+    # Profiler por amostragem: a cada `intervalo_s` lê a pilha de todas as threads
+    # (sys._current_frames) e conta as pilhas no formato "collapsed" do flamegraph.
+    def __init__(self, intervalo_s):
+        self.intervalo_s = intervalo_s
+        self._lock = threading.Lock()
+        self._amostras = collections.Counter()
+        self._parar = threading.Event()
+        self._thread = None
+        self.total = 0
+
+    @property
+    def ativo(self):
+        return bool(self._thread and self._thread.is_alive())
+
+    def iniciar(self):
+        if self.ativo:
+            return False
+        self._parar.clear()
+        self._thread = threading.Thread(target=self._loop, name="profiler", daemon=True)
+        self._thread.start()
+        logging.info(f"Profiler de amostragem ligado ({self.intervalo_s * 1000:.0f} ms).")
+        return True
+
+    def parar(self):
+        self._parar.set()
+        if self._thread:
+            self._thread.join()
+        logging.info(f"Profiler de amostragem desligado ({self.total} amostras).")
+
+    def _loop(self):
+        proprio = threading.get_ident()
+        while not self._parar.wait(self.intervalo_s):
+            nomes = {t.ident: t.name for t in threading.enumerate()}
+            pilhas = []
+            for ident, frame in sys._current_frames().items():
+                if ident == proprio:
+                    continue
+                pilha = []
+                while frame is not None and len(pilha) < 64:
+                    codigo = frame.f_code
+                    pilha.append(f"{codigo.co_name} ({os.path.basename(codigo.co_filename)}:{frame.f_lineno})")
+                    frame = frame.f_back
+                pilhas.append(";".join([nomes.get(ident, str(ident))] + pilha[::-1]))
+            with self._lock:
+                self._amostras.update(pilhas)
+                self.total += 1
+
+    def relatorio(self, limpar=False):
+        with self._lock:
+            linhas = [f"{pilha} {qtd}" for pilha, qtd in self._amostras.most_common()]
+            if limpar:
+                self._amostras.clear()
+                self.total = 0
+        return "\n".join(linhas) + "\n"
+
+profiler = ProfilerAmostragem(PROFILER_INTERVALO_S)
+
+class PoolConexoes:
+    # Pool único do processo: as conexões ficam abertas entre os ciclos e são testadas
+    # com SELECT 1 apenas quando ficaram ociosas por mais de DB_POOL_CHECK_SEGUNDOS.
+    def __init__(self, dsn, minconn, maxconn, somente_leitura=False):
+        self.dsn = dsn
+        self.maxconn = maxconn
+        self.somente_leitura = somente_leitura
+        self._vagas = threading.BoundedSemaphore(maxconn)
+        self._lock = threading.Lock()
+        self._ociosas = []
+        self._stats = {
+            'checkouts': 0, 'em_uso': 0, 'pico_em_uso': 0, 'abertas': 0, 'criadas': 0,
+            'descartadas': 0, 'health_checks': 0, 'esgotado': 0, 'espera_total_s': 0.0,
+        }
+        for _ in range(minconn):
+            self._ociosas.append((self._conectar(), time.monotonic()))
+
+    def _contar(self, chave, valor=1):
+        with self._lock:
+            self._stats[chave] += valor
+
+    def _conectar(self):
+        opcoes = {'options': '-c default_transaction_read_only=on'} if self.somente_leitura else {}
+        conn = psycopg2.connect(self.dsn, cursor_factory=RealDictCursor, **opcoes)
+        with self._lock:
+            self._stats['abertas'] += 1
+            self._stats['criadas'] += 1
+        return conn
+
+    def _fechar(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+        with self._lock:
+            self._stats['abertas'] -= 1
+            self._stats['descartadas'] += 1
+
+    def _conexao_saudavel(self, conn, ultimo_uso):
+        if conn.closed:
+            return False
+        if time.monotonic() - ultimo_uso < DB_POOL_CHECK_SEGUNDOS:
+            return True
+        self._contar('health_checks')
+        try:
+            cur = conn.cursor()
+            cur.execute("SELECT 1")
+            cur.close()
+            conn.rollback()
+            return True
+        except psycopg2.Error as e:
+            logging.warning(f"Conexão do pool inválida, descartando: {e}")
+            return False
+
+    def _retirar(self):
+        while True:
+            with self._lock:
+                item = self._ociosas.pop() if self._ociosas else None
+            if item is None:
+                return self._conectar()
+            conn, ultimo_uso = item
+            if self._conexao_saudavel(conn, ultimo_uso):
+                return conn
+            self._fechar(conn)
+
+    def obter(self):
+        inicio = time.monotonic()
+        if not self._vagas.acquire(timeout=DB_POOL_TIMEOUT):
+            self._contar('esgotado')
+            raise pg_pool.PoolError(f"Pool de conexões esgotado ({self.maxconn} em uso)")
+        try:
+            conn = self._retirar()
+        except Exception:
+            self._vagas.release()
+            raise
+
+        with self._lock:
+            self._stats['checkouts'] += 1
+            self._stats['em_uso'] += 1
+            self._stats['pico_em_uso'] = max(self._stats['pico_em_uso'], self._stats['em_uso'])
+            self._stats['espera_total_s'] += time.monotonic() - inicio
+        return conn
+
+    def devolver(self, conn, descartar=False):
+        try:
+            if not descartar and not conn.closed:
+                status = conn.info.transaction_status
+                if status == psycopg2.extensions.TRANSACTION_STATUS_UNKNOWN:
+                    descartar = True
+                elif status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+
+            if descartar or conn.closed:
+                self._fechar(conn)
+            else:
+                with self._lock:
+                    self._ociosas.append((conn, time.monotonic()))
+        except psycopg2.Error:
+            self._fechar(conn)
+        finally:
+            self._contar('em_uso', -1)
+            self._vagas.release()
+
+    @contextmanager
+    def conexao(self):
+        conn = self.obter()
+        descartar = False
+        try:
+            yield conn
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            descartar = True
+            raise
+        finally:
+            self.devolver(conn, descartar)
+
+    def estatisticas(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['ociosas'] = len(self._ociosas)
+        stats['maximo'] = self.maxconn
+        return stats
+
+    def fechar(self):
+        with self._lock:
+            ociosas, self._ociosas = self._ociosas, []
+        for conn, _ in ociosas:
+            self._fechar(conn)
+
+_pool_db = None
+_pool_db_lock = threading.Lock()
+
+def get_pool():
+    global _pool_db
+    if _pool_db is None:
+        with _pool_db_lock:
+            if _pool_db is None:
+                _pool_db = PoolConexoes(DB_URL, DB_POOL_MIN, DB_POOL_MAX)
+    return _pool_db
+
+def conexao_db():
+    return get_pool().conexao()
+
+class RoteadorReplica:
+    # O SQL das regras roda numa réplica somente leitura (DATABASE_REPLICA_URL); incidentes e
+    # execucoes_regras continuam no primário. O lag é medido a cada REPLICA_LAG_CHECK_S e comparado
+    # com regras.replica_lag_max_s (ou REPLICA_LAG_MAX_S): acima do limite a regra vai para o
+    # primário ou é pulada, conforme REPLICA_ACIMA_DO_LAG.
+    def __init__(self, dsn, maxconn, lag_max_s, intervalo_s, acima_do_lag):
+        self.pool = PoolConexoes(dsn, 0, maxconn, somente_leitura=True)
+        self.lag_max_s = lag_max_s
+        self.intervalo_s = intervalo_s
+        self.acima_do_lag = acima_do_lag
+        self._lock = threading.Lock()
+        self._lag = None
+        self._medicao = threading.Lock()
+        self._medido_em = 0
+        self._stats = {'replica': 0, 'primario': 0, 'pulada': 0, 'erros_lag': 0}
+
+    def _medir(self):
+        # Sem WAL pendente de replay a réplica está em dia, mesmo que o primário esteja ocioso
+        try:
+            with self.pool.conexao() as conn:
+                cur = conn.cursor()
+                cur.execute("""
+                    SELECT CASE
+                        WHEN NOT pg_is_in_recovery() THEN 0
+                        WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+                        ELSE COALESCE(EXTRACT(EPOCH FROM clock_timestamp() - pg_last_xact_replay_timestamp()), 0)
+                    END AS lag
+                """)
+                lag = float(cur.fetchone()['lag'])
+                conn.rollback()
+                return lag
+        except Exception as e:
+            logging.warning(f"Não foi possível medir o lag da réplica: {e}")
+            with self._lock:
+                self._stats['erros_lag'] += 1
+            return float('inf')
+
+    def _lag_recente(self):
+        with self._lock:
+            if self._lag is not None and time.monotonic() - self._medido_em < self.intervalo_s:
+                return self._lag
+        return None
+
+    def lag(self):
+        lag = self._lag_recente()
+        if lag is not None:
+            return lag
+        # Uma thread mede; as outras esperam o valor em vez de ler a medição ainda em andamento
+        with self._medicao:
+            lag = self._lag_recente()
+            if lag is not None:
+                return lag
+            lag = self._medir()
+            with self._lock:
+                self._lag = lag
+                self._medido_em = time.monotonic()
+        return lag
+
+    def destino(self, r):
+        tolerancia = r.get('replica_lag_max_s')
+        tolerancia = self.lag_max_s if tolerancia is None else tolerancia
+        lag = self.lag()
+        if lag is not None and lag <= tolerancia:
+            destino = 'replica'
+        else:
+            destino = 'pulada' if self.acima_do_lag == 'pular' else 'primario'
+            logging.warning(f"Réplica com lag de {lag:.1f}s (tolerância da regra {r['nome']}: {tolerancia}s). Destino: {destino}.")
+        with self._lock:
+            self._stats[destino] += 1
+        metricas.incrementar("runner_regra_roteamento_total", destino=destino)
+        return destino
+
+    def estatisticas(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['lag_s'] = self._lag
+        stats['pool'] = self.pool.estatisticas()
+        return stats
+
+roteador_replica = RoteadorReplica(DB_REPLICA_URL, REPLICA_POOL_MAX, REPLICA_LAG_MAX_S, REPLICA_LAG_CHECK_S,
+                                   REPLICA_ACIMA_DO_LAG) if DB_REPLICA_URL else None
+
+def garantir_schema():
+    with conexao_db() as conn:
+        try:
+            cur = conn.cursor()
+            for ddl in SCHEMA_RUNNER:
+                cur.execute(ddl)
+            conn.commit()
+        except Exception as e:
+            logging.error(f"Erro ao preparar schema do runner: {e}")
+            conn.rollback()
+
+class RegistroTokens:
+    # Push tokens em memória por usuário e por role, no lugar do JOIN usuarios/usuarios_roles/
+    # dispositivos_usuarios a cada envio. Recarregado por TTL ou pelo NOTIFY de tokens_alterados
+    # (dispositivos, roles) e escalas_alteradas (usuarios). A janela start_time/end_time é
+    # avaliada na consulta com o relógio do banco, como o current_time da query original.
+    def __init__(self, ttl_s):
+        self.ttl_s = ttl_s
+        self._lock = threading.Lock()
+        self._geracao = 0
+        self._carregado_em = None
+        self._relogio_db = None
+        self._usuarios = {}
+        self._por_role = {}
+        self._admins = set()
+        self._stats = {'acertos': 0, 'recargas': 0, 'invalidacoes': 0, 'tokens_removidos': 0}
+
+    def invalidar(self, _=None):
+        with self._lock:
+            self._geracao += 1
+            self._carregado_em = None
+            self._stats['invalidacoes'] += 1
+
+    def _garantir_carregado(self):
+        with self._lock:
+            if self._carregado_em is not None and time.monotonic() - self._carregado_em < self.ttl_s:
+                self._stats['acertos'] += 1
+                return
+            geracao = self._geracao
+        with conexao_db() as conn:
+            cur = conn.cursor()
+            cur.execute("SELECT LOCALTIMESTAMP AS agora")
+            agora_db = cur.fetchone()['agora']
+            inicio_mono = time.monotonic()
+            cur.execute("""
+                SELECT u.id, u.role, u.enable_push, u.start_time, u.end_time,
+                       ARRAY(SELECT DISTINCT d.push_token FROM dispositivos_usuarios d
+                             WHERE d.id_usuario = u.id AND d.push_token IS NOT NULL) AS tokens,
+                       ARRAY(SELECT ur.role_name FROM usuarios_roles ur WHERE ur.id_usuario = u.id) AS roles
+                FROM usuarios u
+                WHERE EXISTS (SELECT 1 FROM dispositivos_usuarios d WHERE d.id_usuario = u.id)
+            """)
+            linhas = cur.fetchall()
+            conn.rollback()
+        usuarios, por_role, admins = {}, {}, set()
+        for linha in linhas:
+            usuarios[linha['id']] = linha
+            for role in linha['roles']:
+                por_role.setdefault(role, set()).add(linha['id'])
+            if linha['role'] == 'admin':
+                admins.add(linha['id'])
+        with self._lock:
+            self._usuarios, self._por_role, self._admins = usuarios, por_role, admins
+            self._relogio_db = (agora_db, inicio_mono)
+            self._stats['recargas'] += 1
+            # Se chegou invalidação durante a carga, a próxima consulta recarrega de novo
+            self._carregado_em = inicio_mono if geracao == self._geracao else None
+
+    def tokens_da_role(self, role):
+        self._garantir_carregado()
+        with self._lock:
+            agora_db, inicio_mono = self._relogio_db
+            hora = (agora_db + datetime.timedelta(seconds=time.monotonic() - inicio_mono)).time()
+            tokens = set()
+            for id_usuario in self._por_role.get(role, ()):
+                u = self._usuarios[id_usuario]
+                # Mesma semântica do SQL: enable_push/janela nulos excluem o usuário
+                if u['enable_push'] and u['start_time'] is not None and u['end_time'] is not None \
+                        and u['start_time'] <= hora <= u['end_time']:
+                    tokens.update(u['tokens'])
+            return list(tokens)
+
+    def tokens_dos_usuarios(self, ids, incluir_admins=False):
+        self._garantir_carregado()
+        with self._lock:
+            ids = set(ids) | (self._admins if incluir_admins else set())
+            return list({t for i in ids if i in self._usuarios for t in self._usuarios[i]['tokens']})
+
+    def remover(self, tokens):
+        # Tokens que o FCM deu como não registrados saem do banco num único DELETE
+        with conexao_db() as conn:
+            cur = conn.cursor()
+            cur.execute("DELETE FROM dispositivos_usuarios WHERE push_token = ANY(%s)", (list(tokens),))
+            removidos = cur.rowcount
+            conn.commit()
+        mortos = set(tokens)
+        with self._lock:
+            for u in self._usuarios.values():
+                if mortos.intersection(u['tokens']):
+                    u['tokens'] = [t for t in u['tokens'] if t not in mortos]
+            self._stats['tokens_removidos'] += removidos
+        logging.info(f"Push: {removidos} tokens não registrados removidos de dispositivos_usuarios.")
+        return removidos
+
+    def estatisticas(self):
+        with self._lock:
+            return dict(self._stats, usuarios=len(self._usuarios), tokens=sum(len(u['tokens']) for u in self._usuarios.values()))
+
+registro_tokens = RegistroTokens(TOKENS_TTL_S)
+
+class TransporteFCM:
+    # Ponto de troca do envio (testes usam um transporte falso com a mesma interface)
+    def enviar_multicast(self, mensagem):
+        return messaging.send_each_for_multicast(mensagem)
+
+transporte_push = TransporteFCM()
+ERROS_TOKEN_MORTO = (messaging.UnregisteredError, messaging.SenderIdMismatchError)
+
 def get_destinatarios_tokens(role_target):
     if not role_target:
         return []
-    
-    conn = get_db_connection()
-    cur = conn.cursor()
-    
-    query = """
-        SELECT DISTINCT d.push_token 
-        FROM public.usuarios u
-        JOIN public.usuarios_roles ur ON u.id = ur.id_usuario
-        JOIN public.dispositivos_usuarios d ON u.id = d.id_usuario
-        WHERE ur.role_name = %s
-        AND u.enable_push = true
-        AND (current_time BETWEEN u.start_time AND u.end_time)
-    """
-    
-    cur.execute(query, (role_target,))
-    tokens = [row['push_token'] for row in cur.fetchall()]
-    
-    cur.close()
-    conn.close()
-    return tokens
+    return registro_tokens.tokens_da_role(role_target)
 
 def send_push_notification(tokens, title, body, data_payload=None):
-    try:
-        if not tokens:
-            logging.info(f"Nenhum destinatário elegível para: {title}")
+    if not tokens:
+        logging.info(f"Nenhum destinatário elegível para: {title}")
+        return 0
+
+    sucessos, mortos = 0, []
+    for i in range(0, len(tokens), FCM_LOTE_MAX):
+        lote = tokens[i:i + FCM_LOTE_MAX]
+        try:
+            response = transporte_push.enviar_multicast(messaging.MulticastMessage(
+                notification=messaging.Notification(title=title, body=body),
+                data=data_payload,
+                tokens=lote,
+            ))
+        except Exception as e:
+            logging.error(f"Erro ao enviar Push ({len(lote)} devices): {e}")
+            continue
+        sucessos += response.success_count
+        mortos.extend(t for t, r in zip(lote, response.responses)
+                      if not r.success and isinstance(r.exception, ERROS_TOKEN_MORTO))
+    logging.info(f"Push enviado para {len(tokens)} devices. Sucessos: {sucessos}")
+
+    if mortos:
+        try:
+            registro_tokens.remover(mortos)
+        except Exception as e:
+            logging.error(f"Erro ao remover tokens mortos: {e}")
+    return sucessos
+
+class DespachantePush:
+    # Envia os pushes para a API em background, com no máximo `concorrencia` requisições
+    # simultâneas sobre uma sessão HTTP keep-alive. Erros 5xx e de rede são repetidos com backoff.
+    def __init__(self, url, concorrencia, tentativas, timeout_s, backoff_s):
+        self.url = url
+        self.tentativas = tentativas
+        self.timeout_s = timeout_s
+        self.backoff_s = backoff_s
+        self._sessao = requests.Session()
+        adaptador = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=concorrencia)
+        self._sessao.mount('http://', adaptador)
+        self._sessao.mount('https://', adaptador)
+        self._executor = ThreadPoolExecutor(max_workers=concorrencia, thread_name_prefix="push")
+        self._lock = threading.Lock()
+        self._latencias = collections.deque(maxlen=1000)
+        self._stats = {'enviados': 0, 'falhas': 0, 'retentativas': 0, 'latencia_total_s': 0.0, 'latencia_max_s': 0.0}
+
+    def enviar(self, payload, descricao=""):
+        return self._executor.submit(self._enviar, payload, descricao)
+
+    def _registrar_latencia(self, latencia):
+        metricas.observar("runner_push_segundos", latencia)
+        with self._lock:
+            self._latencias.append(latencia)
+            self._stats['latencia_total_s'] += latencia
+            self._stats['latencia_max_s'] = max(self._stats['latencia_max_s'], latencia)
+
+    def _contar(self, chave):
+        metricas.incrementar("runner_push_total", resultado=chave)
+        with self._lock:
+            self._stats[chave] += 1
+
+    def _enviar(self, payload, descricao):
+        erro = None
+        for tentativa in range(1, self.tentativas + 1):
+            inicio = time.monotonic()
+            try:
+                resp = self._sessao.post(self.url, json=payload, timeout=self.timeout_s)
+                self._registrar_latencia(time.monotonic() - inicio)
+                if resp.ok:
+                    self._contar('enviados')
+                    return True
+                erro = f"HTTP {resp.status_code}"
+                if resp.status_code < 500:
+                    break
+            except requests.RequestException as e:
+                self._registrar_latencia(time.monotonic() - inicio)
+                erro = str(e)
+
+            if tentativa < self.tentativas:
+                self._contar('retentativas')
+                time.sleep(self.backoff_s * 2 ** (tentativa - 1))
+
+        self._contar('falhas')
+        logging.warning(f"Push falhou ({descricao or payload.get('titulo')}): {erro}")
+        return False
+
+    def estatisticas(self):
+        with self._lock:
+            stats = dict(self._stats)
+            latencias = sorted(self._latencias)
+        chamadas = stats['enviados'] + stats['falhas']
+        stats['latencia_media_ms'] = round(stats['latencia_total_s'] / len(latencias) * 1000, 1) if latencias else None
+        stats['latencia_p95_ms'] = round(latencias[min(len(latencias) - 1, int(len(latencias) * 0.95))] * 1000, 1) if latencias else None
+        stats['taxa_falha'] = round(stats['falhas'] / chamadas, 3) if chamadas else 0
+        return stats
+
+    def fechar(self, aguardar=True):
+        self._executor.shutdown(wait=aguardar)
+        self._sessao.close()
+
+despachante_push = DespachantePush(PUSH_URL, PUSH_CONCORRENCIA, PUSH_TENTATIVAS, PUSH_TIMEOUT_S, PUSH_BACKOFF_S)
+
+class OuvinteNotify:
+    # Thread com uma conexão dedicada (fora do pool) em LISTEN nos canais registrados.
+    # Se a conexão cair, reconecta e avisa via `ao_reconectar`, pois notificações se perdem nesse intervalo.
+    def __init__(self, canais, ao_reconectar=None):
+        self.canais = canais
+        self.ao_reconectar = ao_reconectar
+        self._parar = threading.Event()
+        self._thread = None
+        self._stats = {'notificacoes': 0, 'reconexoes': 0, 'erros': 0}
+
+    def iniciar(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._loop, name="listen", daemon=True)
+            self._thread.start()
+
+    def parar(self):
+        self._parar.set()
+
+    def _conectar(self):
+        conn = get_db_connection()
+        conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+        cur = conn.cursor()
+        for canal in self.canais:
+            cur.execute(f"LISTEN {canal}")
+        cur.close()
+        return conn
+
+    def _loop(self):
+        espera = 1
+        while not self._parar.is_set():
+            conn = None
+            try:
+                conn = self._conectar()
+                if self._stats['reconexoes'] and self.ao_reconectar:
+                    self.ao_reconectar()
+                self._stats['reconexoes'] += 1
+                espera = 1
+                while not self._parar.is_set():
+                    if select.select([conn], [], [], 5) == ([], [], []):
+                        continue
+                    conn.poll()
+                    while conn.notifies:
+                        n = conn.notifies.pop(0)
+                        self._stats['notificacoes'] += 1
+                        try:
+                            self.canais[n.channel](n.payload)
+                        except Exception as e:
+                            logging.error(f"Erro ao tratar NOTIFY {n.channel}: {e}")
+            except Exception as e:
+                self._stats['erros'] += 1
+                logging.warning(f"LISTEN desconectado ({e}). Reconectando em {espera}s.")
+                self._parar.wait(espera)
+                espera = min(espera * 2, 60)
+            finally:
+                if conn is not None:
+                    try:
+                        conn.close()
+                    except Exception:
+                        pass
+
+    def estatisticas(self):
+        return dict(self._stats, ativo=bool(self._thread and self._thread.is_alive()))
+
+class IndiceIncidentes:
+    # Mapa id_regra -> id_incidente aberto (OPEN/ACK), mantido por NOTIFY e ressincronizado
+    # periodicamente. É só uma dica: o UPDATE de recorrência confere o status no banco.
+    def __init__(self, resync_s):
+        self.resync_s = resync_s
+        self._lock = threading.Lock()
+        self._abertos = {}
+        self._ultimo_resync = 0
+        self._stats = {'acertos': 0, 'faltas': 0, 'obsoletos': 0, 'notificacoes': 0, 'resyncs': 0}
+
+    def precisa_resync(self, agora=None):
+        return (agora or time.time()) - self._ultimo_resync >= self.resync_s
+
+    def invalidar(self):
+        self._ultimo_resync = 0
+
+    def carregar(self, cur):
+        cur.execute("""
+            SELECT DISTINCT ON (id_regra) id_regra, id_incidente
+            FROM incidentes
+            WHERE status IN ('OPEN', 'ACK') AND id_regra IS NOT NULL
+            ORDER BY id_regra, id_incidente DESC
+        """)
+        abertos = {l['id_regra']: l['id_incidente'] for l in cur.fetchall()}
+        with self._lock:
+            self._abertos = abertos
+            self._stats['resyncs'] += 1
+        self._ultimo_resync = time.time()
+
+    def aplicar_notificacao(self, payload):
+        dados = json.loads(payload)
+        id_regra = dados.get('id_regra')
+        if id_regra is None:
             return
+        with self._lock:
+            self._stats['notificacoes'] += 1
+            if dados.get('status') in ('OPEN', 'ACK'):
+                self._abertos[id_regra] = dados['id_incidente']
+            elif self._abertos.get(id_regra) == dados['id_incidente']:
+                del self._abertos[id_regra]
 
-        message = messaging.MulticastMessage(
-            notification=messaging.Notification(title=title, body=body),
-            data=data_payload,
-            tokens=tokens,
-        )
-        response = messaging.send_multicast(message)
-        logging.info(f"Push enviado para {len(tokens)} devices. Sucessos: {response.success_count}")
-    except Exception as e:
-        logging.error(f"Erro ao enviar Push: {e}")
+    def obter(self, id_regra):
+        with self._lock:
+            id_incidente = self._abertos.get(id_regra)
+            self._stats['acertos' if id_incidente else 'faltas'] += 1
+            return id_incidente
+
+    def registrar(self, id_regra, id_incidente):
+        with self._lock:
+            self._abertos[id_regra] = id_incidente
+
+    def descartar(self, id_regra, id_incidente):
+        with self._lock:
+            self._stats['obsoletos'] += 1
+            if self._abertos.get(id_regra) == id_incidente:
+                del self._abertos[id_regra]
+
+    def estatisticas(self):
+        with self._lock:
+            return dict(self._stats, abertos=len(self._abertos))
+
+indice_incidentes = IndiceIncidentes(INDICE_RESYNC_S)
+
+class BufferRecorrencias:
+    # Recorrências de incidentes abertos ficam em memória e vão para o banco a cada
+    # RECORRENCIA_INTERVALO_S num único UPDATE, somando em incidentes.ocorrencias.
+    # Cada flush grava também uma linha por incidente atualizado em ocorrencias_incidente (série compacta).
+    def __init__(self, intervalo_s):
+        self.intervalo_s = intervalo_s
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._pendentes = {}
+        self._ultimo_flush = time.monotonic()
+
+    def adicionar(self, id_regra, id_incidente, linhas_afetadas):
+        agora = time.monotonic()
+        with self._lock:
+            item = self._pendentes.get(id_incidente)
+            if item is None:
+                self._pendentes[id_incidente] = {
+                    'id_regra': id_regra, 'primeira': agora, 'ultima': agora,
+                    'ocorrencias': 1, 'linhas_max': linhas_afetadas, 'linhas': linhas_afetadas,
+                }
+            else:
+                item['ultima'] = agora
+                item['ocorrencias'] += 1
+                item['linhas'] = linhas_afetadas
+                item['linhas_max'] = max(item['linhas_max'], linhas_afetadas)
+
+    def vencido(self):
+        with self._lock:
+            return bool(self._pendentes) and time.monotonic() - self._ultimo_flush >= self.intervalo_s
+
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                lote, self._pendentes = self._pendentes, {}
+                self._ultimo_flush = time.monotonic()
+            if not lote:
+                return 0
+
+            # Os horários vão como "segundos atrás" para usar o relógio do banco, como o NOW() de antes
+            agora = time.monotonic()
+            valores = [
+                (id_incidente, i['ocorrencias'], agora - i['primeira'], agora - i['ultima'], i['linhas_max'],
+                 f"Recorrência em {datetime.datetime.now()}: {i['linhas']} itens.")
+                for id_incidente, i in lote.items()
+            ]
+            try:
+                with conexao_db() as conn:
+                    cur = conn.cursor()
+                    atualizados = execute_values(cur, """
+                        WITH v (id_incidente, ocorrencias, atras_primeira_s, atras_ultima_s, linhas_max, detalhes) AS (VALUES %s),
+                        atualizados AS (
+                            UPDATE incidentes i
+                            SET ocorrencias = i.ocorrencias + v.ocorrencias,
+                                data_ultima_ocorrencia = GREATEST(i.data_ultima_ocorrencia, NOW() - make_interval(secs => v.atras_ultima_s)),
+                                detalhes = v.detalhes
+                            FROM v
+                            WHERE i.id_incidente = v.id_incidente AND i.status IN ('OPEN', 'ACK')
+                            RETURNING i.id_incidente
+                        ), serie AS (
+                            -- Só os incidentes que somaram no contador entram na série
+                            INSERT INTO ocorrencias_incidente (id_incidente, primeira, ultima, ocorrencias, linhas_max)
+                            SELECT v.id_incidente, NOW() - make_interval(secs => v.atras_primeira_s),
+                                   NOW() - make_interval(secs => v.atras_ultima_s), v.ocorrencias, v.linhas_max
+                            FROM v JOIN atualizados a ON a.id_incidente = v.id_incidente
+                        )
+                        SELECT id_incidente FROM atualizados
+                    """, valores, template="(%s::integer, %s::integer, %s::float8, %s::float8, %s::integer, %s::text)",
+                        page_size=len(valores), fetch=True)
+                    conn.commit()
+                    cur.close()
+            except Exception as e:
+                logging.error(f"Erro ao gravar recorrências ({len(lote)} incidentes): {e}")
+                with self._lock:
+                    for id_incidente, i in lote.items():
+                        atual = self._pendentes.get(id_incidente)
+                        if atual is None:
+                            self._pendentes[id_incidente] = i
+                        else:
+                            atual['primeira'] = i['primeira']
+                            atual['ocorrencias'] += i['ocorrencias']
+                            atual['linhas_max'] = max(atual['linhas_max'], i['linhas_max'])
+                return 0
+
+            # Incidentes fechados entre a recorrência e o flush saem do índice;
+            # a próxima recorrência da regra abre um incidente novo.
+            fechados = set(lote) - {linha['id_incidente'] for linha in atualizados}
+            for id_incidente in fechados:
+                indice_incidentes.descartar(lote[id_incidente]['id_regra'], id_incidente)
+            if fechados:
+                logging.info(f"Recorrências descartadas de incidentes já fechados: {sorted(fechados)}")
+            logging.info(f"Recorrências gravadas: {len(lote) - len(fechados)} incidentes, "
+                         f"{sum(i['ocorrencias'] for i in lote.values())} ocorrências.")
+            return len(lote) - len(fechados)
+
+buffer_recorrencias = BufferRecorrencias(RECORRENCIA_INTERVALO_S)
+atexit.register(buffer_recorrencias.flush)
+class IndiceEscalas:
+    # Escalas das próximas ESCALAS_HORIZONTE_H horas em memória, por canal, ordenadas pelo início.
+    # Responde "quem está de plantão no canal X agora" com bisect + máximo acumulado dos fins,
+    # reproduzindo a query de buscar_destinatario_ativo. Invalidado por NOTIFY em escalas/usuarios
+    # e recarregado a cada ESCALAS_TTL_S; fora disso (ou desatualizado) vale a query SQL.
+    def __init__(self, ttl_s, horizonte_h):
+        self.ttl_s = ttl_s
+        self.horizonte_h = horizonte_h
+        self._lock = threading.Lock()
+        self._canais = {}
+        self._admin = None
+        self._carregado_em = None
+        self._relogio_db = None
+        self._valido_ate = None
+        self._stats = {'acertos': 0, 'fallback_sql': 0, 'recargas': 0, 'invalidacoes': 0}
+
+    def precisa_recarregar(self):
+        return self._carregado_em is None or time.monotonic() - self._carregado_em >= self.ttl_s
+
+    def invalidar(self, _=None):
+        with self._lock:
+            self._carregado_em = None
+            self._stats['invalidacoes'] += 1
+
+    def carregar(self, cur):
+        # Lê o relógio do banco: as escalas são timestamp sem fuso e a query original usa CURRENT_TIMESTAMP
+        cur.execute("SELECT LOCALTIMESTAMP AS agora")
+        agora_db = cur.fetchone()['agora']
+        inicio_mono = time.monotonic()
+        valido_ate = agora_db + datetime.timedelta(hours=self.horizonte_h)
+        cur.execute("""
+            SELECT UPPER(e.canal) AS canal, e.data_inicio, e.data_fim,
+                   u.id, u.email, u.nome, u.inicio_nao_perturbe, u.fim_nao_perturbe,
+                   COALESCE(u.recebe_email, true) as recebe_email,
+                   COALESCE(u.recebe_push, true) as recebe_push
+            FROM escalas e
+            JOIN usuarios u ON e.id_usuario = u.id
+            WHERE e.data_fim >= %s AND e.data_inicio <= %s AND e.canal IS NOT NULL
+            ORDER BY UPPER(e.canal), e.data_inicio, e.id
+        """, (agora_db, valido_ate))
+        canais = {}
+        for linha in cur.fetchall():
+            inicios, fins_max, turnos = canais.setdefault(linha['canal'], ([], [], []))
+            inicios.append(linha['data_inicio'])
+            fins_max.append(max(fins_max[-1], linha['data_fim']) if fins_max else linha['data_fim'])
+            turnos.append(linha)
+        cur.execute("""
+            SELECT id, email, nome, 
+                   COALESCE(recebe_email, true) as recebe_email,
+                   COALESCE(recebe_push, true) as recebe_push
+            FROM usuarios WHERE role = 'admin' LIMIT 1
+        """)
+        admin = cur.fetchone()
+        with self._lock:
+            self._canais = canais
+            self._admin = admin
+            self._relogio_db = (agora_db, inicio_mono)
+            self._valido_ate = valido_ate
+            self._carregado_em = inicio_mono
+            self._stats['recargas'] += 1
+
+    @staticmethod
+    def _em_nao_perturbe(turno, hora):
+        inicio, fim = turno['inicio_nao_perturbe'], turno['fim_nao_perturbe']
+        if inicio is None:
+            return False
+        if fim is None:
+            # Lógica de três valores do SQL: com fim nulo, o NOT BETWEEN só é verdadeiro antes do início
+            return hora >= inicio
+        return inicio <= hora <= fim
+
+    def consultar(self, canal, quando=None):
+        # Retorna (encontrado, usuario); encontrado=False manda o chamador para o SQL
+        with self._lock:
+            if self._carregado_em is None or time.monotonic() - self._carregado_em >= self.ttl_s:
+                self._stats['fallback_sql'] += 1
+                return False, None
+            agora_db, inicio_mono = self._relogio_db
+            quando = quando or agora_db + datetime.timedelta(seconds=time.monotonic() - inicio_mono)
+            if quando > self._valido_ate:
+                self._stats['fallback_sql'] += 1
+                return False, None
+            self._stats['acertos'] += 1
+
+            hora = quando.time()
+            inicios, fins_max, turnos = self._canais.get(canal.upper(), ((), (), ()))
+            i = bisect.bisect_right(inicios, quando) - 1
+            # Do início mais recente para trás; para quando nenhum turno anterior termina depois de `quando`
+            while i >= 0 and fins_max[i] >= quando:
+                turno = turnos[i]
+                if turno['data_fim'] >= quando and not self._em_nao_perturbe(turno, hora):
+                    return True, {k: turno[k] for k in ('id', 'email', 'nome', 'recebe_email', 'recebe_push')}
+                i -= 1
+            return True, None
+
+    def admin(self):
+        with self._lock:
+            return dict(self._admin) if self._admin else None
+
+    def estatisticas(self):
+        with self._lock:
+            return dict(self._stats, canais=len(self._canais), turnos=sum(len(c[2]) for c in self._canais.values()))
+
+indice_escalas = IndiceEscalas(ESCALAS_TTL_S, ESCALAS_HORIZONTE_H)
+evento_notificacoes = threading.Event()
+
+def _escalas_alteradas(tabela):
+    indice_escalas.invalidar()
+    if tabela == 'usuarios':
+        registro_tokens.invalidar()
+
+def _reconectou_listen():
+    indice_incidentes.invalidar()
+    indice_escalas.invalidar()
+    registro_tokens.invalidar()
+    # Pode ter chegado notificação enquanto o LISTEN estava fora
+    evento_notificacoes.set()
+
+ouvinte_notify = OuvinteNotify({
+    CANAL_INCIDENTES: indice_incidentes.aplicar_notificacao,
+    CANAL_NOTIFICACOES: lambda _: evento_notificacoes.set(),
+    CANAL_ESCALAS: _escalas_alteradas,
+    CANAL_TOKENS: registro_tokens.invalidar,
+}, _reconectou_listen)
 
 def create_incident(cur, regra, linhas_afetadas):
     logging.warning(f"Regra '{regra['nome']}' acionada linhas: {linhas_afetadas}")
-    cur.execute("SELECT id_incidente FROM incidentes WHERE id_regra = %s AND status IN ('OPEN', 'ACK')", (regra['id'],))
-    existing = cur.fetchone()
+    id_aberto = indice_incidentes.obter(regra['id'])
+    if id_aberto is None:
+        # Índice não conhece incidente aberto: confirma no banco antes de abrir outro
+        cur.execute("SELECT id_incidente FROM incidentes WHERE id_regra = %s AND status IN ('OPEN', 'ACK')", (regra['id'],))
+        existing = cur.fetchone()
+        id_aberto = existing['id_incidente'] if existing else None
+
+    if id_aberto:
+        metricas.incrementar("runner_incidentes_total", tipo="recorrencia")
+        logging.info(f"Recorrência: Incidente {id_aberto} (gravação agrupada).")
+        indice_incidentes.registrar(regra['id'], id_aberto)
+        buffer_recorrencias.adicionar(regra['id'], id_aberto, linhas_afetadas)
+        return
 
-    if existing:
-     
-        logging.info(f"Recorrência: Incidente {existing['id_incidente']} atualizado.")
-        cur.execute("UPDATE incidentes SET data_ultima_ocorrencia = NOW(), detalhes = %s WHERE id_incidente = %s", 
-                    (f"Recorrência em {datetime.datetime.now()}: {linhas_afetadas} itens.", existing['id_incidente']))
-        return  
     cur.execute("""
         INSERT INTO incidentes (id_regra, status, prioridade, detalhes, data_ultima_ocorrencia)
         VALUES (%s, 'OPEN', %s, %s, NOW()) RETURNING id_incidente
     """, (regra['id'], regra['prioridade'], f"Regra {regra['nome']} detectou {linhas_afetadas} registros."))
     
     incidente_id = cur.fetchone()['id_incidente']
+    metricas.incrementar("runner_incidentes_total", tipo="aberto")
     canal_para_busca = regra.get('role_target') or regra.get('roles')
     plantonista = buscar_destinatario_ativo(cur, canal_para_busca)
 
@@ -112,28 +1212,22 @@ def create_incident(cur, regra, linhas_afetadas):
             print(f"   Usuário {nome_operador} desativou E-mails. Ignorando envio.")
 
         if quer_push:
-            try:
-                requests.post("http://localhost:8000/notify/push", json={
-                    "titulo": f" AÇÃO NECESSÁRIA #{incidente_id}",
-                    "mensagem": f"Você está de plantão! Falha em: {regra.get('nome')}",
-                    "email_alvo": email_operador 
-                }, timeout=1)
-                print(f"   [Push] Direct Message para {nome_operador}")
-            except:
-                pass
+            despachante_push.enviar({
+                "titulo": f" AÇÃO NECESSÁRIA #{incidente_id}",
+                "mensagem": f"Você está de plantão! Falha em: {regra.get('nome')}",
+                "email_alvo": email_operador 
+            })
+            print(f"   [Push] Direct Message para {nome_operador}")
         else:
             print(f"   Usuário {nome_operador} desativou Push. Ignorando envio.")
     else:
         print(f"   Sem plantonista ativo para {canal_para_busca}")
-    try:
-        print("   [Push] Disparando Broadcast para Admins...")
-        requests.post("http://localhost:8000/notify/push", json={
-            "titulo": f"Novo Incidente #{incidente_id}",
-            "mensagem": f"Regra: {regra.get('nome')} | Operador: {plantonista['nome'] if plantonista else 'Ninguém'}",
-            "target_role": "admin"
-        }, timeout=1)
-    except Exception as e:
-        print(f"   Erro ao notificar Admins: {e}")
+    print("   [Push] Disparando Broadcast para Admins...")
+    despachante_push.enviar({
+        "titulo": f"Novo Incidente #{incidente_id}",
+        "mensagem": f"Regra: {regra.get('nome')} | Operador: {plantonista['nome'] if plantonista else 'Ninguém'}",
+        "target_role": "admin"
+    }, "broadcast admins")
     email_extra = regra.get('email_notificacao')
     if email_extra and '@' in email_extra:
         print(f"   [Extra] Regra tem destinatário fixo: {email_extra}")
@@ -147,6 +1241,7 @@ def create_incident(cur, regra, linhas_afetadas):
             INSERT INTO notificacoes (id_usuario, id_incidente, canal, destinatario, titulo, mensagem, status)
             VALUES (NULL, %s, 'EMAIL', %s, 'Alerta Fixo', 'Envio configurado na regra', 'enviado')
         """, (incidente_id, email_extra))
+    return incidente_id
 
 
 
@@ -170,8 +1265,10 @@ def buscar_destinatario_ativo(cursor, canal_regra):
         LIMIT 1
     """
     
-    cursor.execute(query, (canal_alvo,))
-    plantonista = cursor.fetchone()
+    encontrado, plantonista = indice_escalas.consultar(canal_alvo)
+    if not encontrado:
+        cursor.execute(query, (canal_alvo,))
+        plantonista = cursor.fetchone()
     
     if plantonista:
         print(f"   Plantonista: {plantonista['nome']} | Email={plantonista['recebe_email']}, Push={plantonista['recebe_push']}")
@@ -179,13 +1276,16 @@ def buscar_destinatario_ativo(cursor, canal_regra):
     
     print(f"   Ninguém de plantão para '{canal_alvo}'. Procurando admin .")
     
-    cursor.execute("""
-        SELECT id, email, nome, 
-               COALESCE(recebe_email, true) as recebe_email,
-               COALESCE(recebe_push, true) as recebe_push
-        FROM usuarios WHERE role = 'admin' LIMIT 1
-    """)
-    admin_fallback = cursor.fetchone()
+    if encontrado:
+        admin_fallback = indice_escalas.admin()
+    else:
+        cursor.execute("""
+            SELECT id, email, nome, 
+                   COALESCE(recebe_email, true) as recebe_email,
+                   COALESCE(recebe_push, true) as recebe_push
+            FROM usuarios WHERE role = 'admin' LIMIT 1
+        """)
+        admin_fallback = cursor.fetchone()
     
     if admin_fallback:
          print(f"   Fallback Admin: {admin_fallback['nome']}")
@@ -193,122 +1293,460 @@ def buscar_destinatario_ativo(cursor, canal_regra):
     
     return {'id': None, 'email': os.getenv("EMAIL_USER"), 'recebe_email': True, 'recebe_push': True, 'nome': 'Admin System'}
 
+def resumo_heartbeat():
+    return {
+        'instancia': ID_INSTANCIA,
+        'ultimo_ciclo': agendador_regras.ultimo_ciclo,
+        'agenda': agendador_regras.resumo(),
+        'jobs': agendador_jobs.estatisticas(),
+        'pool': get_pool().estatisticas(),
+        'push': despachante_push.estatisticas(),
+        'tokens': registro_tokens.estatisticas(),
+        'historico_valores': historico_valores.estatisticas(),
+        'replica': roteador_replica.estatisticas() if roteador_replica is not None else None,
+        'cluster': cluster.resumo() if cluster is not None else None,
+    }
+
 def atualizar_heartbeat(conn):
     try:
         cursor = conn.cursor()
-        cursor.execute("UPDATE sistema_status SET ultimo_batimento = NOW(), status = 'ONLINE' WHERE servico = 'RUNNER_PYTHON'")
+        cursor.execute("UPDATE sistema_status SET ultimo_batimento = NOW(), status = 'ONLINE', resumo = %s WHERE servico = 'RUNNER_PYTHON'",
+                       (json.dumps(resumo_heartbeat(), default=str),))
         conn.commit()
     except Exception as e:
         print(f"Erro Heartbeat: {e}")
 
 def job_escalonamento():
-    conn = get_db_connection()
-    if not conn: return
-    
+    with conexao_db() as conn:
+        _escalonar(conn)
+
+def _escalonar(conn):
+    # Um comando por nível, do mais alto para o mais baixo: incidente muito atrasado vai
+    # direto ao último nível, e cada um só é escalado uma vez por execução.
     try:
         cursor = conn.cursor()
-        
-        query = """
-            SELECT i.id_incidente, r.nome as nome_regra
-            FROM incidentes i
-            JOIN regras r ON i.id_regra = r.id
-            WHERE i.status = 'OPEN' 
-              AND i.data_abertura < NOW() - INTERVAL '2 HOURS'
-              AND i.prioridade < 1
-        """
-        cursor.execute(query)
-        atrasados = cursor.fetchall()
-        
-        for inc in atrasados:
-            print(f"   ESCALANDO Incidente #{inc['id_incidente']}")
-            
-            cursor.execute("UPDATE incidentes SET prioridade = 1 WHERE id_incidente = %s", (inc['id_incidente'],))
-            
+        for nivel in sorted(POLITICA_ESCALONAMENTO, key=lambda n: n['nivel'], reverse=True):
             cursor.execute("""
-                INSERT INTO notificacoes (id_incidente, canal, destinatario, mensagem, status, titulo, metadados)
-                VALUES (%s, 'EMAIL', 'admin@empresa.com', 'ESCALATION: Operador não respondeu em 2h!', 'PENDING', 'ESCALATION ALERT', %s)
-            """, (inc['id_incidente'], json.dumps({"rota": f"/admin/incidentes/{inc['id_incidente']}", "prioridade": "critica"})))
-            
-        conn.commit()
+                WITH escalados AS (
+                    UPDATE incidentes i
+                    SET nivel_escalonamento = %(nivel)s,
+                        prioridade = LEAST(COALESCE(i.prioridade, %(prioridade)s), %(prioridade)s)
+                    FROM regras r
+                    WHERE i.id_regra = r.id
+                      AND i.status = 'OPEN'
+                      AND i.data_abertura < NOW() - make_interval(mins => %(minutos)s)
+                      AND i.nivel_escalonamento < %(nivel)s
+                    RETURNING i.id_incidente, r.nome AS nome_regra
+                ), destinos AS (
+                    SELECT id AS id_usuario, email FROM usuarios
+                    WHERE role = ANY(%(roles)s::text[]) AND email IS NOT NULL
+                    UNION ALL
+                    SELECT NULL, unnest(%(emails)s::text[])
+                ), avisos AS (
+                    INSERT INTO notificacoes (id_usuario, id_incidente, canal, destinatario, mensagem, status, titulo, metadados)
+                    SELECT d.id_usuario, e.id_incidente, 'EMAIL', d.email, %(mensagem)s, 'PENDING', %(titulo)s,
+                           jsonb_build_object('rota', '/admin/incidentes/' || e.id_incidente, 'prioridade', 'critica')
+                    FROM escalados e CROSS JOIN destinos d
+                )
+                SELECT id_incidente, nome_regra FROM escalados
+            """, {'prioridade': PRIORIDADE_ALTA, **nivel,
+                  'roles': list(nivel.get('roles') or []), 'emails': list(nivel.get('emails') or [])})
+            escalados = cursor.fetchall()
+            conn.commit()
+
+            for inc in escalados:
+                print(f"   ESCALANDO Incidente #{inc['id_incidente']} (nível {nivel['nivel']}, {nivel['minutos']} min)")
+                if nivel.get('push_role'):
+                    despachante_push.enviar({
+                        "titulo": f"{nivel['titulo']} #{inc['id_incidente']}",
+                        "mensagem": f"{nivel['mensagem']} Regra: {inc['nome_regra']}",
+                        "target_role": nivel['push_role']
+                    }, "escalonamento")
     except Exception as e:
         print(f"Erro no escalonamento: {e}")
         conn.rollback()
-    finally:
-        conn.close()
 
-def processar_notificacoes(conn):
-    try:
-        cursor = conn.cursor()
-        cursor.execute("SELECT * FROM notificacoes WHERE status ILIKE 'pending' OR status = 'pendente'")
-        notificacoes = cursor.fetchall()
-
-        for notif in notificacoes:
-            destinatario = notif['destinatario']
-            id_inc = notif['id_incidente']
-            
-            titulo_db = notif.get('titulo')
-            assunto = titulo_db if titulo_db else (f"Plantão Monitor: Incidente #{id_inc}" if id_inc else "Plantão Monitor: Novo Aviso")
-            titulo_push = titulo_db if titulo_db else (f"Incidente #{id_inc}" if id_inc else "Novo Aviso")
-
-            if notif['canal'] == 'EMAIL':
-                print(f"   Enviando e-mail para {destinatario}...")
-                enviar_email_smtp(destinatario, assunto, notif['mensagem'])
-            
+def reservar_notificacoes(conn, id_worker, limite=NOTIF_LOTE):
+    # Lease do lote: as linhas ficam em PROCESSANDO até reservado_ate e outros workers
+    # (threads ou outros runners) pulam as que estão travadas.
+    # Com NOTIF_DIGEST, a primeira linha de um destinatário/canal sai na hora; as que chegam até
+    # NOTIF_JANELA_S depois do último despacho para ele ficam retidas e saem juntas (ordenadas pelo
+    # grupo) para virar um digest. Prioridades imediatas e avisos sem incidente nunca esperam.
+    cur = conn.cursor()
+    cur.execute("""
+        WITH elegiveis AS (
+            SELECT id, destinatario, canal,
+                   NOT %(agrupar)s OR id_incidente IS NULL
+                       OR COALESCE(metadados->>'prioridade', '') = ANY(%(imediatas)s::text[]) AS imediata
+            FROM notificacoes
+            WHERE (status IN %(pendentes)s AND (reservado_ate IS NULL OR reservado_ate <= NOW()))
+               OR (status = 'PROCESSANDO' AND reservado_ate < NOW() AND tentativas < %(max_tentativas)s)
+        ), grupos AS (
+            SELECT g.destinatario, g.canal, g.primeiro
+            FROM (
+                SELECT destinatario, canal, MIN(id) AS primeiro
+                FROM elegiveis
+                WHERE NOT imediata
+                GROUP BY destinatario, canal
+            ) g
+            WHERE NOT EXISTS (
+                SELECT 1 FROM notificacoes x
+                WHERE x.destinatario = g.destinatario AND x.canal = g.canal
+                  AND x.status IN ('enviado', 'PROCESSANDO')
+                  AND x.despachada_em > NOW() - make_interval(secs => %(janela)s)
+            )
+        ), maduras AS (
+            SELECT id, id AS ordem FROM elegiveis WHERE imediata
+            UNION ALL
+            SELECT e.id, g.primeiro
+            FROM elegiveis e
+            JOIN grupos g ON g.destinatario IS NOT DISTINCT FROM e.destinatario AND g.canal IS NOT DISTINCT FROM e.canal
+            WHERE NOT e.imediata
+        )
+        UPDATE notificacoes n
+        SET status = 'PROCESSANDO',
+            tentativas = n.tentativas + 1,
+            reservado_ate = NOW() + make_interval(secs => %(visibilidade)s),
+            reservado_por = %(worker)s,
+            despachada_em = NOW()
+        WHERE n.id IN (
+            SELECT f.id FROM notificacoes f
+            JOIN maduras m ON m.id = f.id
+            WHERE (f.status IN %(pendentes)s AND (f.reservado_ate IS NULL OR f.reservado_ate <= NOW()))
+               OR (f.status = 'PROCESSANDO' AND f.reservado_ate < NOW() AND f.tentativas < %(max_tentativas)s)
+            ORDER BY m.ordem, f.id
+            LIMIT %(limite)s
+            FOR UPDATE OF f SKIP LOCKED
+        )
+        RETURNING n.*
+    """, {'agrupar': NOTIF_DIGEST, 'imediatas': NOTIF_PRIORIDADES_IMEDIATAS, 'pendentes': STATUS_PENDENTES,
+          'max_tentativas': NOTIF_MAX_TENTATIVAS, 'janela': NOTIF_JANELA_S, 'visibilidade': NOTIF_VISIBILIDADE_S,
+          'worker': id_worker, 'limite': limite})
+    lote = cur.fetchall()
+    conn.commit()
+    cur.close()
+    return lote
+
+def proxima_janela_digest(conn):
+    # Segundos até o próximo grupo retido completar a janela (None se não há nada retido)
+    if not NOTIF_DIGEST:
+        return None
+    cur = conn.cursor()
+    cur.execute("""
+        SELECT EXTRACT(EPOCH FROM MIN(u.ultimo) + make_interval(secs => %s) - NOW()) AS espera
+        FROM (
+            SELECT DISTINCT destinatario, canal
+            FROM notificacoes
+            WHERE status IN %s AND (reservado_ate IS NULL OR reservado_ate <= NOW())
+              AND id_incidente IS NOT NULL
+              AND NOT COALESCE(metadados->>'prioridade', '') = ANY(%s::text[])
+        ) p
+        CROSS JOIN LATERAL (
+            SELECT MAX(despachada_em) AS ultimo FROM notificacoes x
+            WHERE x.destinatario = p.destinatario AND x.canal = p.canal AND x.status IN ('enviado', 'PROCESSANDO')
+        ) u
+    """, (NOTIF_JANELA_S, STATUS_PENDENTES, NOTIF_PRIORIDADES_IMEDIATAS))
+    espera = cur.fetchone()['espera']
+    conn.commit()
+    cur.close()
+    return None if espera is None else max(float(espera), 0.0)
+
+def finalizar_notificacoes(conn, id_worker, enviadas, falhas):
+    cur = conn.cursor()
+    if enviadas:
+        cur.execute("""
+            UPDATE notificacoes
+            SET status = 'enviado', reservado_ate = NULL, reservado_por = NULL, ultimo_erro = NULL
+            WHERE id = ANY(%s) AND reservado_por = %s
+        """, (enviadas, id_worker))
+    if falhas:
+        cur.execute("""
+            UPDATE notificacoes n
+            SET status = CASE WHEN n.tentativas >= %s THEN 'falha' ELSE 'PENDING' END,
+                reservado_ate = NOW() + make_interval(secs => %s * power(2, n.tentativas - 1)),
+                reservado_por = NULL,
+                ultimo_erro = v.erro
+            FROM unnest(%s::bigint[], %s::text[]) AS v(id, erro)
+            WHERE n.id = v.id AND n.reservado_por = %s
+        """, (NOTIF_MAX_TENTATIVAS, NOTIF_RETRY_BASE_S, [f[0] for f in falhas], [f[1] for f in falhas], id_worker))
+    conn.commit()
+    cur.close()
+
+def _enviar_notificacao(notif):
+    destinatario = notif['destinatario']
+    id_inc = notif['id_incidente']
+
+    titulo_db = notif.get('titulo')
+    assunto = titulo_db if titulo_db else (f"Plantão Monitor: Incidente #{id_inc}" if id_inc else "Plantão Monitor: Novo Aviso")
+    titulo_push = titulo_db if titulo_db else (f"Incidente #{id_inc}" if id_inc else "Novo Aviso")
+
+    if notif['canal'] == 'EMAIL':
+        print(f"   Enviando e-mail para {destinatario}...")
+        if not enviar_email_smtp(destinatario, assunto, notif.get('mensagem_email', notif['mensagem'])):
+            return False, "Falha no envio de e-mail"
+
+    despachante_push.enviar({
+        "titulo": titulo_push,
+        "mensagem": notif['mensagem'],
+        "email_alvo": destinatario
+    })
+    return True, None
+
+def _notificacao_imediata(notif):
+    return (not NOTIF_DIGEST or notif.get('id_incidente') is None
+            or (notif.get('metadados') or {}).get('prioridade') in NOTIF_PRIORIDADES_IMEDIATAS)
+
+def agrupar_notificacoes(lote):
+    # Imediatas seguem sozinhas; o resto vira uma mensagem por destinatário e canal
+    grupos = {}
+    for notif in lote:
+        chave = ('imediata', notif['id']) if _notificacao_imediata(notif) else (notif['destinatario'], notif['canal'])
+        grupos.setdefault(chave, []).append(notif)
+    return list(grupos.values())
+
+def montar_digest(grupo):
+    if len(grupo) == 1:
+        return grupo[0]
+    linhas = []
+    for notif in grupo:
+        titulo = notif.get('titulo') or (f"Incidente #{notif['id_incidente']}" if notif.get('id_incidente') else "Aviso")
+        linhas.append(f"- {titulo}: {notif['mensagem'] or ''}")
+    incidentes = {n['id_incidente'] for n in grupo if n.get('id_incidente')}
+    resumo = f"{len(grupo)} avisos" + (f" ({len(incidentes)} incidentes)" if incidentes else "")
+    return {
+        'destinatario': grupo[0]['destinatario'],
+        'canal': grupo[0]['canal'],
+        'id_incidente': None,
+        'titulo': f"Plantão Monitor: {resumo}",
+        'mensagem': "\n".join(linhas),
+        'mensagem_email': "<br>".join(linhas),
+    }
+
+def _drenar_fila(_=None):
+    id_worker = f"{ID_INSTANCIA}:{threading.get_ident()}"
+    total = 0
+    while True:
+        with conexao_db() as conn:
+            lote = reservar_notificacoes(conn, id_worker)
+        if not lote:
+            return total
+
+        enviadas, falhas = [], []
+        for grupo in agrupar_notificacoes(lote):
             try:
-          
-                payload = {
-                    "titulo": titulo_push,
-                    "mensagem": notif['mensagem'],
-                    "email_alvo": destinatario
-                }
-                import requests
-                requests.post("http://localhost:8000/notify/push", json=payload, timeout=2)
-            except:
-                pass
+                ok, erro = _enviar_notificacao(montar_digest(grupo))
+            except Exception as e:
+                ok, erro = False, str(e)
+            metricas.incrementar("runner_notificacoes_envios_total", tipo="digest" if len(grupo) > 1 else "individual")
+            for notif in grupo:
+                metricas.incrementar("runner_notificacoes_total", canal=notif['canal'], resultado="enviada" if ok else "falha")
+                if ok:
+                    enviadas.append(notif['id'])
+                else:
+                    falhas.append((notif['id'], erro))
 
-            cursor.execute("UPDATE notificacoes SET status = 'enviado' WHERE id = %s", (notif['id'],))
-        
-        conn.commit()
+        with conexao_db() as conn:
+            finalizar_notificacoes(conn, id_worker, enviadas, falhas)
+        total += len(enviadas)
+        if len(lote) < NOTIF_LOTE:
+            return total
+
+def processar_notificacoes(workers=NOTIF_WORKERS):
+    try:
+        with conexao_db() as conn:
+            cur = conn.cursor()
+            cur.execute("""
+                UPDATE notificacoes SET status = 'falha', reservado_por = NULL, ultimo_erro = 'Lease expirado'
+                WHERE status = 'PROCESSANDO' AND reservado_ate < NOW() AND tentativas >= %s
+            """, (NOTIF_MAX_TENTATIVAS,))
+            conn.commit()
+            cur.close()
 
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="notif") as executor:
+            enviadas = sum(executor.map(_drenar_fila, range(workers)))
+        if enviadas:
+            logging.info(f"Notificações enviadas: {enviadas}")
+        return enviadas
     except Exception as e:
         print(f"Erro notificações: {e}")
-        conn.rollback()
+        return 0
 
+def _loop_notificacoes():
+    # Acordado pelo NOTIFY de notificacoes_pendentes; a varredura de NOTIF_VARREDURA_S
+    # em job_notificacoes cobre o que escapar (LISTEN fora do ar, retentativas com backoff).
+    # Com grupos retidos para digest, acorda sozinho quando a janela do mais antigo fecha.
+    espera = None
+    while True:
+        evento_notificacoes.wait(espera)
+        evento_notificacoes.clear()
+        try:
+            if _drenar_fila() >= NOTIF_LOTE:
+                processar_notificacoes()
+            with conexao_db() as conn:
+                espera = proxima_janela_digest(conn)
+            if espera is not None:
+                espera = min(max(espera, 0.2), NOTIF_VARREDURA_S)
+        except Exception as e:
+            espera = None
+            logging.error(f"Erro ao despachar notificações: {e}")
+
+def iniciar_despacho_notificacoes():
+    threading.Thread(target=_loop_notificacoes, name="notif-despacho", daemon=True).start()
+    evento_notificacoes.set()
 
 def get_tokens_for_notification(regra):
-    conn = get_db_connection()
-    cur = conn.cursor()
     owner_id = regra.get('usuario_id')
-    query = "SELECT DISTINCT d.push_token FROM dispositivos_usuarios d JOIN usuarios u ON d.id_usuario = u.id WHERE u.role = 'admin' OR u.id = %s"
-    cur.execute(query, (owner_id,))
-    tokens = [row['push_token'] for row in cur.fetchall()]
-    cur.close()
-    conn.close()
-    return tokens
+    return registro_tokens.tokens_dos_usuarios([owner_id] if owner_id is not None else [], incluir_admins=True)
 
 def get_emails_for_notification(regra):
-    conn = get_db_connection()
-    cur = conn.cursor()
     owner_id = regra.get('usuario_id')
     query = "SELECT DISTINCT u.email FROM usuarios u WHERE (u.role = 'admin' OR u.id = %s) AND u.enable_email = true"
-    cur.execute(query, (owner_id,))
-    emails = [r['email'] for r in cur.fetchall()]
+    with conexao_db() as conn:
+        cur = conn.cursor()
+        cur.execute(query, (owner_id,))
+        emails = [r['email'] for r in cur.fetchall()]
+        cur.close()
+        conn.rollback()
     specific = regra.get('email_notificacao')
     if specific and specific not in emails: emails.append(specific)
-    cur.close()
-    conn.close()
     return emails
 
-def enviar_email_smtp(destinatarios, regra_nome, erro_detalhe):
-    
-    smtp_server = os.getenv("EMAIL_HOST", "smtp.gmail.com")
-    smtp_port = int(os.getenv("EMAIL_PORT", 587))
+class PoolSMTP:
+    # Sessões SMTP autenticadas reaproveitadas entre envios. Uma sessão ociosa por mais de
+    # EMAIL_OCIOSO_S é fechada; uma sessão derrubada pelo servidor é refeita uma vez.
+    def __init__(self, host, porta, usuario, senha, sessoes=1, ocioso_s=60, starttls=True):
+        self.host = host
+        self.porta = porta
+        self.usuario = usuario
+        self.senha = senha
+        self.ocioso_s = ocioso_s
+        self.starttls = starttls
+        self._vagas = threading.BoundedSemaphore(sessoes)
+        self._livres = queue.LifoQueue()
+        self._stats_lock = threading.Lock()
+        self._stats = {'conexoes': 0, 'reconexoes': 0, 'enviados': 0, 'falhas': 0}
+
+    def _contar(self, chave):
+        with self._stats_lock:
+            self._stats[chave] += 1
+
+    def _conectar(self):
+        server = smtplib.SMTP(self.host, self.porta, timeout=30)
+        if self.starttls:
+            server.starttls()
+        if self.usuario and self.senha and server.has_extn('auth'):
+            server.login(self.usuario, self.senha)
+        self._contar('conexoes')
+        return server
+
+    def _encerrar(self, server):
+        try:
+            server.quit()
+        except Exception:
+            try:
+                server.close()
+            except Exception:
+                pass
+
+    def _retirar(self):
+        while True:
+            try:
+                server, ultimo_uso = self._livres.get_nowait()
+            except queue.Empty:
+                return self._conectar()
+            if time.monotonic() - ultimo_uso < self.ocioso_s:
+                return server
+            self._encerrar(server)
+
+    @contextmanager
+    def sessao(self):
+        if not self._vagas.acquire(timeout=60):
+            raise smtplib.SMTPException("Nenhuma sessão SMTP livre")
+        server = None
+        try:
+            server = self._retirar()
+            yield server
+            self._livres.put((server, time.monotonic()))
+        except Exception:
+            if server is not None:
+                self._encerrar(server)
+            raise
+        finally:
+            self._vagas.release()
+
+    def enviar(self, remetente, destinatario, mensagem):
+        for tentativa in (1, 2):
+            try:
+                inicio = time.monotonic()
+                with self.sessao() as server:
+                    server.sendmail(remetente, destinatario, mensagem)
+                metricas.observar("runner_smtp_envio_segundos", time.monotonic() - inicio)
+                self._contar('enviados')
+                return
+            except (smtplib.SMTPServerDisconnected, ConnectionError) as e:
+                if tentativa == 2:
+                    self._contar('falhas')
+                    raise
+                # Se uma sessão caiu, as outras ociosas provavelmente caíram junto
+                logging.warning(f"Sessão SMTP caiu ({e}). Reconectando.")
+                self._contar('reconexoes')
+                self.fechar()
+            except Exception:
+                self._contar('falhas')
+                raise
+
+    def fechar_ociosas(self):
+        ativas = []
+        while True:
+            try:
+                server, ultimo_uso = self._livres.get_nowait()
+            except queue.Empty:
+                break
+            if time.monotonic() - ultimo_uso >= self.ocioso_s:
+                self._encerrar(server)
+            else:
+                ativas.append((server, ultimo_uso))
+        for item in ativas:
+            self._livres.put(item)
+
+    def fechar(self):
+        while True:
+            try:
+                server, _ = self._livres.get_nowait()
+            except queue.Empty:
+                return
+            self._encerrar(server)
+
+    def estatisticas(self):
+        with self._stats_lock:
+            stats = dict(self._stats)
+        stats['ociosas'] = self._livres.qsize()
+        return stats
+
+_pool_smtp = None
+_pool_smtp_lock = threading.Lock()
+
+def get_pool_smtp():
+    global _pool_smtp
     smtp_user = os.getenv("EMAIL_USER")
     smtp_password = os.getenv("EMAIL_PASS")
-    
     if not smtp_user or not smtp_password:
+        return None
+    if _pool_smtp is None:
+        with _pool_smtp_lock:
+            if _pool_smtp is None:
+                _pool_smtp = PoolSMTP(
+                    os.getenv("EMAIL_HOST", "smtp.gmail.com"), int(os.getenv("EMAIL_PORT", 587)),
+                    smtp_user, smtp_password, EMAIL_SESSOES, EMAIL_OCIOSO_S, EMAIL_STARTTLS,
+                )
+                atexit.register(_pool_smtp.fechar)
+    return _pool_smtp
+
+def enviar_email_smtp(destinatarios, regra_nome, erro_detalhe):
+    pool_smtp = get_pool_smtp()
+    if pool_smtp is None:
         logging.warning("Email não configurado.")
-        return
+        return False
 
     if isinstance(destinatarios, str):
         destinatarios = [destinatarios]
@@ -323,195 +1761,940 @@ def enviar_email_smtp(destinatarios, regra_nome, erro_detalhe):
     </body></html>
     """
     try:
-        server = smtplib.SMTP(smtp_server, smtp_port)
-        server.starttls()
-        server.login(smtp_user, smtp_password)
         for email_destino in destinatarios:
             msg = MIMEMultipart()
-            msg['From'] = smtp_user
+            msg['From'] = pool_smtp.usuario
             msg['To'] = email_destino
             msg['Subject'] = assunto
             msg.attach(MIMEText(corpo_html, 'html'))
-            server.sendmail(smtp_user, email_destino, msg.as_string())
+            pool_smtp.enviar(pool_smtp.usuario, email_destino, msg.as_string())
             logging.info(f"Enviado para: {email_destino}")
-        server.quit()
+        return True
     except Exception as e:
         logging.error(f"Erro Email: {e}")
+        return False
+
+class BufferExecucoes:
+    # Acumula os registros de execucoes_regras e grava em lote a cada LOG_INTERVALO_S ou quando
+    # passa de LOG_LOTE_MAX registros. O flush roda só no tick de check_rules: os workers das
+    # regras ainda seguram a conexão do pool e não devem pegar uma segunda.
+    def __init__(self, max_registros, intervalo_s):
+        self.max_registros = max_registros
+        self.intervalo_s = intervalo_s
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._registros = []
+        self._ultimo_flush = time.monotonic()
+
+    def adicionar(self, registro):
+        with self._lock:
+            self._registros.append(registro)
+
+    def vencido(self):
+        with self._lock:
+            return bool(self._registros) and (len(self._registros) >= self.max_registros
+                                              or time.monotonic() - self._ultimo_flush >= self.intervalo_s)
+
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                lote, self._registros = self._registros, []
+                self._ultimo_flush = time.monotonic()
+            if not lote:
+                return 0
+
+            try:
+                with conexao_db() as conn:
+                    cur = conn.cursor()
+                    execute_values(cur, """
+                        INSERT INTO execucoes_regras (id_regra, data_inicio, data_fim, sucesso, linhas_afetadas, erro_mensagem)
+                        VALUES %s
+                    """, lote, page_size=len(lote))
+                    conn.commit()
+                    cur.close()
+                return len(lote)
+            except Exception as e:
+                logging.error(f"Erro ao salvar log de execução ({len(lote)} registros): {e}")
+                with self._lock:
+                    # Devolve o lote para a próxima tentativa, sem crescer sem limite se o banco cair
+                    self._registros[:0] = lote
+                    excesso = len(self._registros) - 10 * self.max_registros
+                    if excesso > 0:
+                        del self._registros[:excesso]
+                        logging.error(f"Buffer de execuções cheio: {excesso} registros descartados.")
+                return 0
+
+buffer_execucoes = BufferExecucoes(LOG_LOTE_MAX, LOG_INTERVALO_S)
+atexit.register(buffer_execucoes.flush)
+
+executor_regras = ThreadPoolExecutor(max_workers=RUNNER_WORKERS, thread_name_prefix="regra")
+
+def regra_silenciada(r):
+    silenciado_ate = r.get('silenciado_ate')
+    if not silenciado_ate:
+        return False
+    agora = datetime.datetime.now()
+
+    if hasattr(silenciado_ate, 'replace'):
+        silenciado_ate = silenciado_ate.replace(tzinfo=None)
+
+    if silenciado_ate > agora:
+        logging.info(f" Regra '{r['nome']}' silenciada até {silenciado_ate}. Pulando.")
+        return True
+    return False
+
+class HistoricoValores:
+    # Últimos HISTORICO_CAPACIDADE valores (e instantes) de cada regra com modo_avaliacao diferente
+    # de 'limite', num ring buffer NumPy 2 x N de float64: memória fixa de 16 bytes por posição.
+    # Aquecido a partir de execucoes_regras.linhas_afetadas na primeira vez que a regra aparece;
+    # depois só é alimentado pelas execuções, sem consultas extras.
+    def __init__(self, capacidade):
+        self.capacidade = capacidade
+        self._lock = threading.Lock()
+        self._buffers = {}
+        self._stats = {'avaliacoes': 0, 'suprimidos': 0, 'sem_historico': 0, 'aquecidas': 0}
+
+    def _buffer(self, id_regra):
+        buf = self._buffers.get(id_regra)
+        if buf is None:
+            buf = self._buffers[id_regra] = [np.zeros((2, self.capacidade)), 0, 0]  # dados, posição, tamanho
+        return buf
+
+    def adicionar(self, id_regra, valor, quando=None):
+        with self._lock:
+            buf = self._buffer(id_regra)
+            dados, pos, n = buf
+            dados[0, pos] = valor
+            dados[1, pos] = quando if quando is not None else time.time()
+            buf[1] = (pos + 1) % self.capacidade
+            buf[2] = min(n + 1, self.capacidade)
+
+    def janela(self, id_regra, k):
+        # (valores, instantes) das últimas k execuções, da mais antiga para a mais recente
+        with self._lock:
+            buf = self._buffers.get(id_regra)
+            if buf is None:
+                return np.empty(0), np.empty(0)
+            dados, pos, n = buf
+            k = min(k, n)
+            idx = (pos - k + np.arange(k)) % self.capacidade
+            return dados[0, idx].copy(), dados[1, idx].copy()
+
+    def sincronizar(self, regras):
+        # Cria/aquece buffers das regras com modo de tendência e descarta os das que saíram
+        com_historico = {r['id'] for r in regras if (r.get('modo_avaliacao') or 'limite') != 'limite'}
+        with self._lock:
+            for id_regra in set(self._buffers) - com_historico:
+                del self._buffers[id_regra]
+            novas = sorted(com_historico - set(self._buffers))
+        if not novas:
+            return
+        try:
+            linhas = self._ler_execucoes(novas)
+        except psycopg2.Error as e:
+            # Sem aquecimento as regras avaliam pelo limite até juntar amostras; tenta de novo na próxima recarga
+            logging.error(f"Erro ao aquecer histórico de valores: {e}")
+            return
+        with self._lock:
+            for id_regra in novas:
+                self._buffer(id_regra)
+            self._stats['aquecidas'] += len(novas)
+        # data_inicio é horário local sem fuso, como o datetime.now() que o gravou
+        for linha in linhas:
+            self.adicionar(linha['id_regra'], linha['linhas_afetadas'], linha['data_inicio'].timestamp())
+        logging.info(f"Histórico de valores aquecido para {len(novas)} regras ({len(linhas)} execuções).")
+
+    def _ler_execucoes(self, ids):
+        with conexao_db() as conn:
+            cur = conn.cursor()
+            cur.execute("""
+                SELECT id_regra, data_inicio, linhas_afetadas
+                FROM (
+                    SELECT id_regra, data_inicio, linhas_afetadas,
+                           ROW_NUMBER() OVER (PARTITION BY id_regra ORDER BY data_inicio DESC) AS rn
+                    FROM execucoes_regras
+                    WHERE id_regra = ANY(%s) AND sucesso AND linhas_afetadas IS NOT NULL
+                      AND data_inicio >= NOW() - make_interval(days => %s)
+                ) x
+                WHERE rn <= %s
+                ORDER BY id_regra, data_inicio
+            """, (ids, HISTORICO_AQUECIMENTO_DIAS, self.capacidade))
+            linhas = cur.fetchall()
+            conn.rollback()
+            return linhas
+
+    def avaliar(self, r, valor, agora=None):
+        # Retorna (abre_incidente, motivo). qtd_erro_max continua sendo o piso absoluto em todos os modos.
+        acima_do_limite = valor >= r['qtd_erro_max']
+        modo = r.get('modo_avaliacao') or 'limite'
+        if modo == 'limite':
+            return acima_do_limite, None
+        if modo not in MODOS_AVALIACAO:
+            logging.warning(f"Regra {r['nome']}: modo_avaliacao '{modo}' desconhecido, usando limite.")
+            return acima_do_limite, None
+
+        # SUM/numeric chegam como Decimal, que não se mistura com os float64 do buffer
+        valor = float(valor)
+        p = dict(MODOS_AVALIACAO[modo], **(r.get('parametros_avaliacao') or {}))
+        valores, instantes = self.janela(r['id'], int(p['janela']))
+        with self._lock:
+            self._stats['avaliacoes'] += 1
+            if len(valores) < max(int(p['min_amostras']), 2):
+                self._stats['sem_historico'] += 1
+                return acima_do_limite, f"{modo}: histórico insuficiente ({len(valores)} amostras)"
+
+        if modo == 'taxa':
+            # Inclinação por mínimos quadrados (valor por minuto) incluindo a leitura atual
+            x = np.append(instantes, agora if agora is not None else time.time()) / 60.0
+            y = np.append(valores, valor)
+            x = x - x.mean()
+            taxa = float((x * (y - y.mean())).sum() / (x * x).sum()) if (x * x).sum() > 0 else 0.0
+            dispara, motivo = taxa >= float(p['taxa_min']), f"taxa {taxa:.2f}/min (mín. {p['taxa_min']})"
+        elif modo == 'media_movel':
+            media = float(valores.mean())
+            dispara = valor > media * (1 + float(p['desvio']))
+            motivo = f"valor {valor} vs média móvel {media:.2f} (+{float(p['desvio']):.0%})"
+        else:
+            media, desvio = float(valores.mean()), float(valores.std())
+            z = (valor - media) / desvio if desvio > 0 else (float('inf') if valor > media else 0.0)
+            dispara, motivo = z >= float(p['z']), f"z-score {z:.2f} (mín. {p['z']})"
+
+        if acima_do_limite and not dispara:
+            with self._lock:
+                self._stats['suprimidos'] += 1
+        return acima_do_limite and dispara, motivo
+
+    def estatisticas(self):
+        with self._lock:
+            return dict(self._stats, regras=len(self._buffers),
+                        bytes=sum(b[0].nbytes for b in self._buffers.values()))
+
+historico_valores = HistoricoValores(HISTORICO_CAPACIDADE)
+
+def executar_regra(r):
+    # Cada regra usa a sua própria conexão do pool: uma regra lenta ou com erro não trava as outras
+    destino = roteador_replica.destino(r) if roteador_replica is not None else 'primario'
+    if destino == 'pulada':
+        logging.info(f"Regra {r['nome']} pulada: réplica acima da tolerância de lag.")
+        return None, None
+    if destino == 'replica':
+        with roteador_replica.pool.conexao() as conn_leitura, conexao_db() as conn:
+            return _executar_regra(conn, r, conn_leitura)
+    with conexao_db() as conn:
+        return _executar_regra(conn, r)
+
+def _executar_regra(conn, r, conn_leitura=None):
+    logging.info(f"Executando: {r['nome']}")
+    cur = conn.cursor()
+    cur_leitura = conn_leitura.cursor() if conn_leitura is not None else cur
+
+    start_time = datetime.datetime.now()
+    erro_msg = None
+    sucesso = True
+    valor = 0
 
-def check_rules():
-    logging.info("--- Ciclo de Monitoramento ---")
     try:
-        conn = get_db_connection()
-        if not conn: return
-        
-        atualizar_heartbeat(conn) 
-        
-        cur = conn.cursor()
-        cur.execute("SELECT * FROM regras WHERE active = true")
-        regras = cur.fetchall()
-        
-        for r in regras:
-            silenciado_ate = r.get('silenciado_ate')
-            if silenciado_ate:
-                agora = datetime.datetime.now()
-               
-                if hasattr(silenciado_ate, 'replace'):
-                    silenciado_ate = silenciado_ate.replace(tzinfo=None)
-
-                
-                if silenciado_ate > agora:
-                    logging.info(f" Regra '{r['nome']}' silenciada até {silenciado_ate}. Pulando.")
+        timeout_ms = int(r.get('timeout_ms') or TIMEOUT_PADRAO_REGRA_MS)
+        cur_leitura.execute("SET LOCAL statement_timeout = %s", (timeout_ms,))
+        inicio_sql = time.monotonic()
+        try:
+            cur_leitura.execute(r['sql'])
+            result = cur_leitura.fetchone()
+        finally:
+            metricas.observar("runner_regra_sql_segundos", time.monotonic() - inicio_sql, regra=r['id'])
+        valor = list(result.values())[0] if result else 0
+        if conn_leitura is not None:
+            conn_leitura.rollback()
+
+        abre_incidente, motivo = historico_valores.avaliar(r, valor)
+        if motivo:
+            logging.info(f"Regra {r['nome']}: {motivo}")
+        if (r.get('modo_avaliacao') or 'limite') != 'limite':
+            historico_valores.adicionar(r['id'], float(valor))
+        incidente_novo = create_incident(cur, r, valor) if abre_incidente else None
+
+        conn.commit()
+        # Só entra no índice depois do commit: num rollback o incidente nunca existiu
+        if incidente_novo is not None:
+            indice_incidentes.registrar(r['id'], incidente_novo)
+    except Exception as execution_err:
+        sucesso = False
+        erro_msg = str(execution_err)
+        logging.error(f"Erro na regra {r['nome']}: {execution_err}")
+        for c in (conn, conn_leitura):
+            try:
+                if c is not None:
+                    c.rollback()
+            except Exception:
+                pass
+    finally:
+        end_time = datetime.datetime.now()
+        buffer_execucoes.adicionar((r['id'], start_time, end_time, sucesso, valor, erro_msg))
+        metricas.incrementar("runner_regra_execucoes_total", resultado="sucesso" if sucesso else "erro")
+        cur.close()
+        if cur_leitura is not cur:
+            cur_leitura.close()
+
+    return sucesso, (end_time - start_time).total_seconds()
+
+class AgendadorRegras:
+    # Min-heap de (próxima execução, id_regra, versão). Entradas com versão antiga ou de
+    # regras removidas são descartadas ao sair do heap. A versão vem de uma sequência global,
+    # então uma regra removida e readicionada não reaproveita a versão de uma entrada antiga.
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._heap = []
+        self._versao = {}
+        self._sequencia = 0
+        self._regras = {}
+        self._falhas = {}
+        self._duracao = {}
+        self._em_execucao = set()
+        self._ultima_recarga = None
+        self._ciclo = None
+        self.ultimo_ciclo = None
+
+    def precisa_recarregar(self, agora):
+        return self._ultima_recarga is None or agora - self._ultima_recarga >= RECARGA_REGRAS_S
+
+    def carregado(self):
+        return self._ultima_recarga is not None
+
+    def intervalo(self, r):
+        minutos = r.get('minuto_atualizacao')
+        return float(minutos) * 60 if minutos else INTERVALO_PADRAO_REGRA_S
+
+    def _atraso(self, id_regra):
+        r = self._regras[id_regra]
+        base = max(self.intervalo(r), FATOR_DURACAO_REGRA * self._duracao.get(id_regra, 0))
+        falhas = self._falhas.get(id_regra, 0)
+        if falhas:
+            base = min(base * 2 ** min(falhas, 16), max(BACKOFF_MAX_S, base))
+        return base + random.uniform(0, base * JITTER_REGRA)
+
+    def _agendar(self, id_regra, quando):
+        self._sequencia += 1
+        self._versao[id_regra] = self._sequencia
+        heapq.heappush(self._heap, (quando, id_regra, self._sequencia))
+
+    def sincronizar(self, regras, historico, agora):
+        with self._lock:
+            anteriores = self._regras
+            self._regras = {r['id']: r for r in regras}
+
+            for id_regra, r in self._regras.items():
+                anterior = anteriores.get(id_regra)
+                if anterior is None:
+                    h = historico.get(id_regra)
+                    if h:
+                        self._falhas[id_regra] = h['falhas_consecutivas'] or 0
+                        self._duracao[id_regra] = float(h['duracao_media_s'] or 0)
+                    inicio = h['ultima_execucao'].timestamp() + self._atraso(id_regra) if h else agora
+                    if inicio <= agora:
+                        # Regras atrasadas ou novas são espalhadas para não dispararem todas juntas
+                        inicio = agora + random.uniform(0, self.intervalo(r) * JITTER_REGRA)
+                    self._agendar(id_regra, inicio)
+                elif self.intervalo(anterior) != self.intervalo(r) and id_regra not in self._em_execucao:
+                    self._agendar(id_regra, agora + self._atraso(id_regra))
+
+            for id_regra in set(anteriores) - set(self._regras):
+                self._versao.pop(id_regra, None)
+                self._falhas.pop(id_regra, None)
+                self._duracao.pop(id_regra, None)
+            self._ultima_recarga = agora
+
+    def retirar_vencidas(self, agora):
+        vencidas = []
+        with self._lock:
+            while self._heap and self._heap[0][0] <= agora:
+                _, id_regra, versao = heapq.heappop(self._heap)
+                if self._versao.get(id_regra) != versao or id_regra in self._em_execucao:
                     continue
+                self._em_execucao.add(id_regra)
+                vencidas.append(self._regras[id_regra])
+            if vencidas:
+                if self._ciclo is None:
+                    self._ciclo = {'inicio': datetime.datetime.now().isoformat(timespec='seconds'), '_t0': time.monotonic(),
+                                   'regras': 0, 'sucessos': 0, 'falhas': 0, 'puladas': 0, 'duracao_max_s': 0.0}
+                self._ciclo['regras'] += len(vencidas)
+        return vencidas
+
+    def concluir(self, id_regra, sucesso, duracao_s=None):
+        # Retorna True quando não sobrou nenhuma regra em execução (fim do ciclo)
+        with self._lock:
+            self._em_execucao.discard(id_regra)
+            self._fechar_ciclo(sucesso, duracao_s)
+            if id_regra not in self._regras:
+                return not self._em_execucao
+            if sucesso is False:
+                self._falhas[id_regra] = self._falhas.get(id_regra, 0) + 1
+                if self._falhas[id_regra] > 1:
+                    logging.warning(f"Regra {id_regra} falhou {self._falhas[id_regra]}x seguidas. Aplicando backoff.")
+            elif sucesso:
+                self._falhas.pop(id_regra, None)
+            if duracao_s is not None:
+                anterior = self._duracao.get(id_regra, duracao_s)
+                self._duracao[id_regra] = 0.7 * anterior + 0.3 * duracao_s
+            self._agendar(id_regra, time.time() + self._atraso(id_regra))
+            return not self._em_execucao
+
+    def _fechar_ciclo(self, sucesso, duracao_s):
+        ciclo = self._ciclo
+        if ciclo is None:
+            return
+        ciclo['sucessos' if sucesso else 'falhas' if sucesso is False else 'puladas'] += 1
+        if duracao_s:
+            ciclo['duracao_max_s'] = round(max(ciclo['duracao_max_s'], duracao_s), 3)
+        if not self._em_execucao:
+            ciclo['duracao_s'] = round(time.monotonic() - ciclo.pop('_t0'), 3)
+            self.ultimo_ciclo = ciclo
+            self._ciclo = None
+
+    def em_execucao(self):
+        with self._lock:
+            return set(self._em_execucao)
+
+    def resumo(self):
+        with self._lock:
+            proxima = min((t for t, id_regra, v in self._heap if self._versao.get(id_regra) == v), default=None)
+            return {
+                'regras': len(self._regras),
+                'em_execucao': len(self._em_execucao),
+                'em_backoff': sum(1 for f in self._falhas.values() if f),
+                'proxima_em_s': round(proxima - time.time(), 1) if proxima else None,
+            }
+
+agendador_regras = AgendadorRegras()
+
+def _hash_estavel(texto):
+    # hash() do Python muda a cada processo; o anel precisa ser igual em todos os membros
+    return int.from_bytes(hashlib.md5(texto.encode()).digest()[:8], 'big')
+
+def shard_da_regra(id_regra, shards=CLUSTER_SHARDS):
+    return _hash_estavel(f"regra:{id_regra}") % shards
+
+class AnelConsistente:
+    def __init__(self, membros, vnodes):
+        self._pontos = sorted((_hash_estavel(f"{m}#{v}"), m) for m in membros for v in range(vnodes))
+        self._chaves = [p[0] for p in self._pontos]
+
+    def dono(self, chave):
+        if not self._pontos:
+            return None
+        i = bisect.bisect(self._chaves, _hash_estavel(chave)) % len(self._pontos)
+        return self._pontos[i][1]
+
+class ClusterRunner:
+    # Modo cluster (RUNNER_CLUSTER=true): cada processo se registra em sistema_status como
+    # 'RUNNER_PYTHON:<instância>'. Os shards de regras são divididos por hashing consistente entre
+    # os membros com heartbeat recente, e um shard só roda em quem segura o advisory lock dele.
+    # Os locks são de sessão numa conexão dedicada, então o lease cai junto com o processo.
+    def __init__(self, id_instancia, shards, vnodes, membro_ttl_s):
+        self.servico = f"RUNNER_PYTHON:{id_instancia}"
+        self.total_shards = shards
+        self.vnodes = vnodes
+        self.membro_ttl_s = membro_ttl_s
+        self._lock = threading.Lock()
+        self._conn = None
+        self.shards = set()
+        self.aguardando = set()
+        self.lider = False
+        self.membros = []
+        self._ultima_tentativa = 0
 
+    def _conexao(self):
+        if self._conn is None or self._conn.closed:
+            if self.shards or self.lider:
+                logging.warning("Conexão dos leases do cluster caiu: shards e liderança perdidos.")
+            self.shards, self.lider = set(), False
+            self._conn = get_db_connection()
+            self._conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+        return self._conn
+
+    def _descartar_conexao(self):
+        try:
+            self._conn.close()
+        except Exception:
+            pass
+        self._conn = None
+        self.shards, self.lider = set(), False
+
+    def aguardando_lease(self, agora=None):
+        return bool(self.aguardando) and (agora or time.time()) - self._ultima_tentativa >= CLUSTER_RETENTATIVA_S
+
+    def rebalancear(self, em_execucao=()):
+        with self._lock:
+            self._ultima_tentativa = time.time()
             try:
-                logging.info(f"Executando: {r['nome']}")
-                
-                start_time = datetime.datetime.now()
-                erro_msg = None
-                sucesso = True
-                valor = 0
+                return self._rebalancear({shard_da_regra(i, self.total_shards) for i in em_execucao})
+            except psycopg2.Error as e:
+                logging.error(f"Erro ao rebalancear cluster: {e}")
+                self._descartar_conexao()
+                return True
 
-                try:
-                    cur.execute(r['sql'])
-                    result = cur.fetchone()
-                    valor = list(result.values())[0] if result else 0
-                    
-                    if valor >= r['qtd_erro_max']:
-                        create_incident(cur, r, valor)
-                    
-                    conn.commit()
-                except Exception as execution_err:
-                    sucesso = False
-                    erro_msg = str(execution_err)
-                    raise execution_err
-                finally:
-                    end_time = datetime.datetime.now()
-                    
-                    if not sucesso:
-                        try:
-                            conn.rollback()
-                        except:
-                            pass
+    def _rebalancear(self, shards_ocupados):
+        cur = self._conexao().cursor()
+        cur.execute("UPDATE sistema_status SET ultimo_batimento = NOW(), status = 'ONLINE' WHERE servico = %s", (self.servico,))
+        if cur.rowcount == 0:
+            cur.execute("INSERT INTO sistema_status (servico, ultimo_batimento, status) VALUES (%s, NOW(), 'ONLINE')", (self.servico,))
+        cur.execute("""
+            SELECT servico FROM sistema_status
+            WHERE servico LIKE 'RUNNER\\_PYTHON:%%' AND status = 'ONLINE'
+              AND ultimo_batimento > NOW() - make_interval(secs => %s)
+        """, (self.membro_ttl_s,))
+        membros = sorted(l['servico'] for l in cur.fetchall())
+        anel = AnelConsistente(membros, self.vnodes)
+        desejados = {s for s in range(self.total_shards) if anel.dono(f"shard:{s}") == self.servico}
 
-                    try:
-                        cur.execute("""
-                            INSERT INTO execucoes_regras (id_regra, data_inicio, data_fim, sucesso, linhas_afetadas, erro_mensagem)
-                            VALUES (%s, %s, %s, %s, %s, %s)
-                        """, (r['id'], start_time, end_time, sucesso, valor, erro_msg))
-                        conn.commit()
-                    except Exception as log_err:
-                        logging.error(f"Erro ao salvar log de execução: {log_err}")
+        anteriores = set(self.shards)
+        # Shard que mudou de dono só é solto quando nenhuma regra dele está rodando aqui
+        for shard in sorted(self.shards - desejados - shards_ocupados):
+            cur.execute("SELECT pg_advisory_unlock(%s, %s)", (CLASSE_LOCK_CLUSTER, shard))
+            self.shards.discard(shard)
+        novos = sorted(desejados - self.shards)
+        if novos:
+            cur.execute("SELECT s FROM unnest(%s::int[]) s WHERE pg_try_advisory_lock(%s, s)", (novos, CLASSE_LOCK_CLUSTER))
+            self.shards |= {l['s'] for l in cur.fetchall()}
+        # O dono anterior ainda segura o lock até o próximo rebalanceamento dele
+        self.aguardando = desejados - self.shards
 
-            except Exception as e:
-                logging.error(f"Erro na regra {r['nome']}: {e}")
-                conn.rollback()
-        cur.close()
-        conn.close()
+        self._tentar_lideranca(cur)
+        if self.lider:
+            cur.execute("""
+                DELETE FROM sistema_status
+                WHERE servico LIKE 'RUNNER\\_PYTHON:%%' AND ultimo_batimento < NOW() - make_interval(secs => %s)
+            """, (self.membro_ttl_s * 10,))
+
+        mudou = self.shards != anteriores or membros != self.membros
+        if mudou:
+            logging.info(f"Cluster: {len(membros)} membros, {len(self.shards)}/{self.total_shards} shards aqui"
+                         f"{f', aguardando {len(self.aguardando)}' if self.aguardando else ''}"
+                         f"{' (líder)' if self.lider else ''}")
+        self.membros = membros
+        return mudou
+
+    def _tentar_lideranca(self, cur):
+        if not self.lider:
+            cur.execute("SELECT pg_try_advisory_lock(%s, -1) AS ok", (CLASSE_LOCK_CLUSTER,))
+            self.lider = cur.fetchone()['ok']
+            if self.lider:
+                logging.info(f"Cluster: {self.servico} eleito líder.")
+
+    def sou_lider(self):
+        with self._lock:
+            try:
+                self._tentar_lideranca(self._conexao().cursor())
+            except psycopg2.Error as e:
+                logging.error(f"Erro na eleição de líder: {e}")
+                self._descartar_conexao()
+            return self.lider
+
+    def possui(self, id_regra):
+        return shard_da_regra(id_regra, self.total_shards) in self.shards
+
+    def filtrar(self, regras):
+        return [r for r in regras if self.possui(r['id'])]
+
+    def sair(self):
+        with self._lock:
+            if self._conn is None or self._conn.closed:
+                return
+            try:
+                cur = self._conn.cursor()
+                cur.execute("UPDATE sistema_status SET status = 'OFFLINE' WHERE servico = %s", (self.servico,))
+            except psycopg2.Error:
+                pass
+            self._descartar_conexao()
+
+    def resumo(self):
+        return {'membros': len(self.membros), 'shards': len(self.shards), 'aguardando': len(self.aguardando), 'lider': self.lider}
+
+cluster = ClusterRunner(ID_INSTANCIA, CLUSTER_SHARDS, CLUSTER_VNODES, CLUSTER_MEMBRO_TTL_S) if CLUSTER_ATIVO else None
+
+def somente_lider(job):
+    # Jobs singleton (escalonamento, no-show) só rodam no líder quando em cluster
+    def executar():
+        if cluster is None or cluster.sou_lider():
+            job()
+    return executar
+
+def carregar_historico_regras(cur):
+    cur.execute("""
+        WITH recentes AS (
+            SELECT id_regra, data_inicio, data_fim, sucesso
+            FROM execucoes_regras
+            WHERE data_inicio >= NOW() - INTERVAL '1 day'
+        ), ultimo_sucesso AS (
+            SELECT id_regra, MAX(data_inicio) AS data FROM recentes WHERE sucesso GROUP BY id_regra
+        )
+        SELECT e.id_regra,
+               MAX(e.data_inicio) AS ultima_execucao,
+               AVG(EXTRACT(EPOCH FROM (e.data_fim - e.data_inicio))) AS duracao_media_s,
+               COUNT(*) FILTER (WHERE NOT e.sucesso AND (u.data IS NULL OR e.data_inicio > u.data)) AS falhas_consecutivas
+        FROM recentes e
+        LEFT JOIN ultimo_sucesso u USING (id_regra)
+        GROUP BY e.id_regra
+    """)
+    return {h['id_regra']: h for h in cur.fetchall()}
+
+def _executar_agendada(r):
+    sucesso, duracao = None, None
+    try:
+        if cluster is not None and not cluster.possui(r['id']):
+            logging.info(f"Regra {r['nome']} não pertence mais a este membro do cluster. Pulando.")
+        elif not regra_silenciada(r):
+            sucesso, duracao = executar_regra(r)
+    except Exception as e:
+        sucesso = False
+        logging.error(f"Erro na regra {r['nome']}: {e}")
+    finally:
+        agendador_regras.concluir(r['id'], sucesso, duracao)
+
+def check_rules():
+    try:
+        if buffer_execucoes.vencido():
+            buffer_execucoes.flush()
+        if buffer_recorrencias.vencido():
+            buffer_recorrencias.flush()
+
+        agora = time.time()
+        if indice_incidentes.precisa_resync(agora):
+            with conexao_db() as conn:
+                indice_incidentes.carregar(conn.cursor())
+                conn.commit()
+            logging.info(f"Índice de incidentes: {indice_incidentes.estatisticas()} | LISTEN: {ouvinte_notify.estatisticas()} | Escalas: {indice_escalas.estatisticas()} | Jobs: {agendador_jobs.estatisticas()}")
+
+        if indice_escalas.precisa_recarregar():
+            with conexao_db() as conn:
+                indice_escalas.carregar(conn.cursor())
+                conn.commit()
+
+        if agendador_regras.precisa_recarregar(agora) or (cluster is not None and cluster.aguardando_lease(agora)):
+            if cluster is not None:
+                cluster.rebalancear(agendador_regras.em_execucao())
+            with conexao_db() as conn:
+                atualizar_heartbeat(conn)
+
+                cur = conn.cursor()
+                cur.execute("SELECT * FROM regras WHERE active = true")
+                regras = cur.fetchall()
+                historico = {} if agendador_regras.carregado() else carregar_historico_regras(cur)
+                cur.close()
+                conn.commit()
+            if cluster is not None:
+                regras = cluster.filtrar(regras)
+            historico_valores.sincronizar(regras)
+            agendador_regras.sincronizar(regras, historico, agora)
+            logging.info(f"Agenda de regras: {agendador_regras.resumo()} | Pool: {get_pool().estatisticas()}")
+
+        vencidas = agendador_regras.retirar_vencidas(agora)
+        if not vencidas:
+            return
+
+        logging.info(f"--- Ciclo de Monitoramento: {len(vencidas)} regras ---")
+        for r in vencidas:
+            executor_regras.submit(_executar_agendada, r)
     except Exception as e:
         logging.error(f"Erro Geral no Runner: {e}")
 
 
 def job_notificacoes():
-    logging.info("Processando Notificações Fila")
-    conn = get_db_connection()
-    if conn:
-        processar_notificacoes(conn)
-        conn.close()
+    logging.info("Varredura da fila de notificações")
+    processar_notificacoes()
+    logging.info(f"Push: {despachante_push.estatisticas()}")
+    pool_smtp = get_pool_smtp()
+    if pool_smtp:
+        pool_smtp.fechar_ociosas()
 
 def job_verificar_acks_escalas():
     logging.info("Verificando confirmações de presença...")
-    conn = get_db_connection()
-    if not conn: return
+    with conexao_db() as conn:
+        _verificar_acks_escalas(conn)
 
+def _verificar_acks_escalas(conn):
+    # Plantões que começam em até 5 min sem ACK passam para o próximo da fila do canal
+    # (ou para um admin), com aviso aos dois usuários, tudo num único comando.
     try:
         cursor = conn.cursor(cursor_factory=RealDictCursor)
-
-        query_criticos = """
-            SELECT e.id, e.id_usuario, e.data_inicio, e.canal, u.nome, u.email
-            FROM escalas e
-            JOIN usuarios u ON e.id_usuario = u.id
-            WHERE (e.status_confirmacao = 'PENDING' OR e.status_confirmacao IS NULL)
-              AND e.data_inicio BETWEEN NOW() AND (NOW() + INTERVAL '5 MINUTES')
-        """
-        cursor.execute(query_criticos)
+        cursor.execute("""
+            WITH sem_ack AS (
+                SELECT e.id, e.id_usuario, e.data_inicio, e.canal, u.nome, u.email
+                FROM escalas e
+                JOIN usuarios u ON e.id_usuario = u.id
+                WHERE (e.status_confirmacao = 'PENDING' OR e.status_confirmacao IS NULL)
+                  AND e.data_inicio BETWEEN NOW() AND (NOW() + INTERVAL '5 MINUTES')
+            ), destino AS (
+                SELECT s.*, COALESCE(p.id_usuario, a.id) AS novo_id_usuario, p.id_usuario IS NOT NULL AS da_fila
+                FROM sem_ack s
+                LEFT JOIN LATERAL (
+                    SELECT id_usuario FROM escalas x
+                    WHERE x.canal = s.canal AND x.data_inicio > s.data_inicio
+                    ORDER BY x.data_inicio ASC
+                    LIMIT 1
+                ) p ON true
+                LEFT JOIN (SELECT id FROM usuarios WHERE role = 'admin' LIMIT 1) a ON true
+            ), reatribuidas AS (
+                UPDATE escalas e
+                SET id_usuario = d.novo_id_usuario,
+                    id_usuario_original = d.id_usuario,
+                    status_confirmacao = 'PENDING'
+                FROM destino d
+                WHERE e.id = d.id AND d.novo_id_usuario IS NOT NULL
+                RETURNING e.id
+            ), novos AS (
+                SELECT d.id, u.email AS novo_email,
+                       'URGENTE: Você assumiu o plantão de ' || d.data_inicio || ' pois ' || d.nome || ' não confirmou.' AS msg_novo
+                FROM destino d
+                JOIN reatribuidas r ON r.id = d.id
+                JOIN usuarios u ON u.id = d.novo_id_usuario
+            ), aviso_novos AS (
+                INSERT INTO notificacoes (id_usuario, destinatario, canal, mensagem, status, titulo)
+                SELECT d.novo_id_usuario, n.novo_email, 'EMAIL', n.msg_novo, 'PENDING', 'Plantão Transferido'
+                FROM novos n JOIN destino d ON d.id = n.id
+            ), aviso_antigos AS (
+                INSERT INTO notificacoes (id_usuario, destinatario, canal, mensagem, status, titulo, id_incidente)
+                SELECT d.id_usuario, d.email, 'EMAIL',
+                       'Você perdeu o plantão de ' || d.data_inicio || ' por falta de ACK.', 'PENDING', 'Plantão Cancelado (No-Show)', NULL
+                FROM destino d JOIN reatribuidas r ON r.id = d.id
+            )
+            SELECT d.nome, d.data_inicio, d.novo_id_usuario, d.da_fila, n.novo_email, n.msg_novo
+            FROM destino d LEFT JOIN novos n ON n.id = d.id
+        """)
         escalas_sem_ack = cursor.fetchall()
+        conn.commit()
 
         for escala in escalas_sem_ack:
             logging.warning(f"   ALERTA: {escala['nome']} não confirmou plantão de {escala['data_inicio']}!")
-
-            query_proximo = """
-                SELECT id_usuario, data_inicio 
-                FROM escalas 
-                WHERE canal = %s 
-                  AND data_inicio > %s 
-                ORDER BY data_inicio ASC 
-                LIMIT 1
-            """
-            cursor.execute(query_proximo, (escala['canal'], escala['data_inicio']))
-            proximo = cursor.fetchone()
-
-            novo_id_usuario = None
-            
-            if proximo:
-                novo_id_usuario = proximo['id_usuario']
-                logging.info(f"   Redirecionando para o próximo da fila: ID {novo_id_usuario}")
-            else:
+            if escala['da_fila']:
+                logging.info(f"   Redirecionando para o próximo da fila: ID {escala['novo_id_usuario']}")
+            elif escala['novo_id_usuario']:
                 logging.warning("   Ninguém na fila. Escalando Admin.")
-                cursor.execute("SELECT id, email, nome FROM usuarios WHERE role='admin' LIMIT 1")
-                admin = cursor.fetchone()
-                if admin: novo_id_usuario = admin['id']
-
-            if novo_id_usuario:
-                update_query = """
-                    UPDATE escalas 
-                    SET id_usuario = %s, 
-                        id_usuario_original = %s,
-                        status_confirmacao = 'PENDING' 
-                    WHERE id = %s
-                """
-                cursor.execute(update_query, (novo_id_usuario, escala['id_usuario'], escala['id']))
-
-                cursor.execute("SELECT email, nome FROM usuarios WHERE id = %s", (novo_id_usuario,))
-                dados_novo = cursor.fetchone()
-                
-                if dados_novo:
-                    msg_novo = f"URGENTE: Você assumiu o plantão de {escala['data_inicio']} pois {escala['nome']} não confirmou."
-                    
-     
-                    try:
-                        requests.post("http://localhost:8000/notify/push", json={
-                            "titulo": "PLANTÃO REAGENDADO PARA VOCÊ",
-                            "mensagem": msg_novo,
-                            "email_alvo": dados_novo['email']
-                        }, timeout=2)
-                    except: pass
-         
-                    cursor.execute("""
-                        INSERT INTO notificacoes (id_usuario, destinatario, canal, mensagem, status, titulo)
-                        VALUES (%s, %s, 'EMAIL', %s, 'PENDING', 'Plantão Transferido')
-                    """, (novo_id_usuario, dados_novo['email'], msg_novo))
-
-                msg_antigo = f"Você perdeu o plantão de {escala['data_inicio']} por falta de ACK."
-                cursor.execute("""
-                    INSERT INTO notificacoes (id_usuario, destinatario, canal, mensagem, status, titulo, id_incidente)
-                    VALUES (%s, %s, 'EMAIL', %s, 'PENDING', 'Plantão Cancelado (No-Show)', NULL)
-                """, (escala['id_usuario'], escala['email'], msg_antigo))
+            else:
+                logging.warning("   Ninguém na fila e nenhum admin cadastrado. Plantão mantido.")
 
-        conn.commit()
+            if escala['novo_email']:
+                despachante_push.enviar({
+                    "titulo": "PLANTÃO REAGENDADO PARA VOCÊ",
+                    "mensagem": escala['msg_novo'],
+                    "email_alvo": escala['novo_email']
+                })
     except Exception as e:
         logging.error(f"Erro ao verificar ACKs: {e}")
         conn.rollback()
-    finally:
-        conn.close()
 
-schedule.every(30).seconds.do(check_rules)
-schedule.every(5).minutes.do(job_verificar_acks_escalas) 
-schedule.every(15).seconds.do(job_notificacoes)
-schedule.every(5).minutes.do(job_escalonamento)
+class AgendadorJobs:
+    # Cada job roda na sua própria lane (uma thread), então um check_rules lento ou um SMTP
+    # travado não atrasa os outros. Tick que chega com a execução anterior ainda rodando não
+    # enfileira: é pulado ou vira uma única reexecução logo após o término (mesclar=True).
+    def __init__(self):
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self._parar = threading.Event()
+
+    def registrar(self, nome, intervalo_s, funcao, prazo_s=None, mesclar=True):
+        self._jobs[nome] = {
+            'nome': nome, 'intervalo_s': intervalo_s, 'funcao': funcao,
+            'prazo_s': prazo_s or intervalo_s, 'mesclar': mesclar,
+            'lane': ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"job-{nome}"),
+            'proximo': time.monotonic() + intervalo_s,
+            'rodando_desde': None, 'estourou': False, 'reexecutar': None,
+            'stats': {'execucoes': 0, 'atrasados': 0, 'perdidos': 0, 'pulados': 0, 'mesclados': 0,
+                      'estouros_prazo': 0, 'erros': 0, 'ultima_duracao_s': None, 'max_duracao_s': 0.0},
+        }
+
+    def _executar(self, job, previsto):
+        while True:
+            inicio = time.monotonic()
+            with self._lock:
+                job['rodando_desde'] = inicio
+                job['estourou'] = False
+                if inicio - previsto > JOBS_TOLERANCIA_ATRASO_S:
+                    job['stats']['atrasados'] += 1
+            try:
+                job['funcao']()
+            except Exception as e:
+                logging.error(f"Erro no job {job['nome']}: {e}")
+                with self._lock:
+                    job['stats']['erros'] += 1
+            finally:
+                duracao = time.monotonic() - inicio
+                metricas.observar("runner_job_duracao_segundos", duracao, job=job['nome'])
+                with self._lock:
+                    job['rodando_desde'] = None
+                    job['stats']['execucoes'] += 1
+                    job['stats']['ultima_duracao_s'] = round(duracao, 3)
+                    job['stats']['max_duracao_s'] = round(max(job['stats']['max_duracao_s'], duracao), 3)
+                    previsto, job['reexecutar'] = job['reexecutar'], None
+            if previsto is None or self._parar.is_set():
+                return
+
+    def _disparar(self, job, agora):
+        previsto = job['proximo']
+        atraso = agora - previsto
+        perdidos = int(atraso // job['intervalo_s']) if atraso > 0 else 0
+        # Sem rajada de recuperação: segue a cadência a partir do próximo tick futuro
+        job['proximo'] = previsto + (perdidos + 1) * job['intervalo_s']
+        with self._lock:
+            if perdidos:
+                job['stats']['perdidos'] += perdidos
+                logging.warning(f"Job {job['nome']}: {perdidos} ticks perdidos.")
+            if job['rodando_desde'] is not None:
+                if not job['mesclar']:
+                    job['stats']['pulados'] += 1
+                    return
+                job['stats']['mesclados'] += 1
+                if job['reexecutar'] is None:
+                    job['reexecutar'] = previsto
+                return
+            job['rodando_desde'] = agora
+        job['lane'].submit(self._executar, job, previsto)
+
+    def _verificar_prazos(self, agora):
+        with self._lock:
+            for job in self._jobs.values():
+                desde = job['rodando_desde']
+                if desde is not None and not job['estourou'] and agora - desde > job['prazo_s']:
+                    job['estourou'] = True
+                    job['stats']['estouros_prazo'] += 1
+                    logging.warning(f"Job {job['nome']} passou do prazo de {job['prazo_s']}s "
+                                    f"(rodando há {agora - desde:.1f}s). Ticks seguintes serão mesclados/pulados.")
+
+    def rodar(self):
+        while not self._parar.is_set():
+            agora = time.monotonic()
+            for job in self._jobs.values():
+                if agora >= job['proximo']:
+                    self._disparar(job, agora)
+            self._verificar_prazos(agora)
+            proximo = min(job['proximo'] for job in self._jobs.values())
+            self._parar.wait(min(max(proximo - time.monotonic(), 0), 1))
+        self._desligar()
+
+    def parar(self, *_):
+        if not self._parar.is_set():
+            logging.info("Sinal de parada recebido. Encerrando jobs...")
+        self._parar.set()
+
+    def instalar_sinais(self):
+        signal.signal(signal.SIGTERM, self.parar)
+        signal.signal(signal.SIGINT, self.parar)
+
+    def _desligar(self):
+        for job in self._jobs.values():
+            job['lane'].shutdown(wait=False)
+        limite = time.monotonic() + DESLIGAMENTO_S
+        while time.monotonic() < limite:
+            with self._lock:
+                rodando = [j['nome'] for j in self._jobs.values() if j['rodando_desde'] is not None]
+            if not rodando:
+                break
+            time.sleep(0.1)
+        else:
+            logging.warning(f"Jobs ainda rodando após {DESLIGAMENTO_S}s: {rodando}")
+        logging.info(f"Jobs encerrados: {self.estatisticas()}")
+
+    def estatisticas(self):
+        with self._lock:
+            return {nome: dict(job['stats']) for nome, job in self._jobs.items()}
+
+agendador_jobs = AgendadorJobs()
+
+def _fila_notificacoes():
+    with conexao_db() as conn:
+        cur = conn.cursor()
+        cur.execute("""
+            SELECT status, COUNT(*) AS n FROM notificacoes
+            WHERE status IN ('PENDING', 'pending', 'Pending', 'pendente', 'PROCESSANDO')
+            GROUP BY status
+        """)
+        linhas = cur.fetchall()
+        conn.rollback()
+    return {(('status', l['status']),): l['n'] for l in linhas}
+
+def _pool_conexoes():
+    stats = get_pool().estatisticas()
+    return {(('estado', e),): stats[e] for e in ('em_uso', 'ociosas', 'abertas', 'maximo')}
+
+metricas.gauge("runner_fila_notificacoes", "Notificações pendentes ou em processamento", _fila_notificacoes)
+metricas.gauge("runner_pool_conexoes", "Conexões do pool por estado", _pool_conexoes)
+metricas.gauge("runner_regras_em_execucao", "Regras rodando agora", lambda: agendador_regras.resumo()['em_execucao'])
+metricas.gauge("runner_regras_em_backoff", "Regras com falhas consecutivas", lambda: agendador_regras.resumo()['em_backoff'])
+metricas.gauge("runner_recorrencias_pendentes", "Incidentes com recorrências aguardando flush", lambda: len(buffer_recorrencias._pendentes))
+metricas.gauge("runner_incidentes_abertos_indice", "Incidentes abertos no índice em memória", lambda: indice_incidentes.estatisticas()['abertos'])
+metricas.gauge("runner_ultimo_ciclo_segundos", "Duração do último ciclo completo de regras",
+               lambda: (agendador_regras.ultimo_ciclo or {}).get('duracao_s'))
+metricas.gauge("runner_historico_valores_bytes", "Memória dos ring buffers de valores das regras",
+               lambda: historico_valores.estatisticas()['bytes'])
+metricas.gauge("runner_replica_lag_segundos", "Último lag medido da réplica de leitura",
+               lambda: roteador_replica.estatisticas()['lag_s'] if roteador_replica is not None else None)
+metricas.gauge("runner_cluster_shards", "Shards de regras com lease neste processo",
+               lambda: len(cluster.shards) if cluster is not None else None)
+metricas.gauge("runner_cluster_lider", "1 se este processo é o líder do cluster",
+               lambda: int(cluster.lider) if cluster is not None else None)
+metricas.gauge("runner_profiler_ativo", "1 se o profiler de amostragem está ligado", lambda: int(profiler.ativo))
+
+class HandlerMetricas(http.server.BaseHTTPRequestHandler):
+    # GET /metrics (Prometheus), GET /profiler (pilhas collapsed),
+    # POST /profiler/iniciar | /profiler/parar | /profiler/limpar
+    def _responder(self, status, corpo, tipo="text/plain; charset=utf-8"):
+        dados = corpo.encode()
+        self.send_response(status)
+        self.send_header("Content-Type", tipo)
+        self.send_header("Content-Length", str(len(dados)))
+        self.end_headers()
+        self.wfile.write(dados)
+
+    def do_GET(self):
+        if self.path == "/metrics":
+            self._responder(200, metricas.renderizar(), "text/plain; version=0.0.4; charset=utf-8")
+        elif self.path == "/profiler":
+            self._responder(200, profiler.relatorio())
+        else:
+            self._responder(404, "not found\n")
+
+    def do_POST(self):
+        if self.path == "/profiler/iniciar":
+            self._responder(200, "ligado\n" if profiler.iniciar() else "já estava ligado\n")
+        elif self.path == "/profiler/parar":
+            profiler.parar()
+            self._responder(200, "desligado\n")
+        elif self.path == "/profiler/limpar":
+            profiler.relatorio(limpar=True)
+            self._responder(200, "limpo\n")
+        else:
+            self._responder(404, "not found\n")
+
+    def log_message(self, *args):
+        pass
+
+def iniciar_servidor_metricas():
+    if not METRICAS_PORTA:
+        return None
+    servidor = http.server.ThreadingHTTPServer((METRICAS_HOST, METRICAS_PORTA), HandlerMetricas)
+    servidor.daemon_threads = True
+    threading.Thread(target=servidor.serve_forever, name="metricas", daemon=True).start()
+    logging.info(f"Métricas em http://{METRICAS_HOST}:{METRICAS_PORTA}/metrics")
+    return servidor
+agendador_jobs.registrar("regras", TICK_REGRAS_S, check_rules, prazo_s=10, mesclar=False)
+agendador_jobs.registrar("acks_escalas", 300, somente_lider(job_verificar_acks_escalas))
+agendador_jobs.registrar("notificacoes", NOTIF_VARREDURA_S, job_notificacoes)
+agendador_jobs.registrar("escalonamento", 300, somente_lider(job_escalonamento))
 
 if __name__ == "__main__":
     print("Runner rodandoo")
-    while True:
-        schedule.run_pending()
-        time.sleep(1)
+    garantir_schema()
+    ouvinte_notify.iniciar()
+    iniciar_despacho_notificacoes()
+    servidor_metricas = iniciar_servidor_metricas()
+    if PROFILER_ATIVO:
+        profiler.iniciar()
+    agendador_jobs.instalar_sinais()
+    agendador_jobs.rodar()
 
+    ouvinte_notify.parar()
+    if cluster is not None:
+        cluster.sair()
+    if servidor_metricas:
+        servidor_metricas.shutdown()
+    executor_regras.shutdown(wait=True, cancel_futures=True)
+    despachante_push.fechar()
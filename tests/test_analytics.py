@@ -0,0 +1,117 @@
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# O analytics cria o engine no import; nada aqui conecta no banco. A URL falsa não pode
+# vazar para outros testes, que decidem pelo DATABASE_URL se há banco disponível.
+_sem_banco = "DATABASE_URL" not in os.environ
+os.environ.setdefault("DATABASE_URL", "postgresql://localhost/plantao_teste")
+import analytics
+if _sem_banco:
+    del os.environ["DATABASE_URL"]
+
+COLUNAS = [c for c in analytics.COLUNAS_METRICAS if c != 'incidentes_abertos']
+
+
+def dados_sinteticos(semente=7, execucoes=400, incidentes=60, regras=5):
+    rng = np.random.default_rng(semente)
+    base = pd.Timestamp('2026-09-01')
+    inicio = base + pd.to_timedelta(rng.uniform(0, 20 * 86400, execucoes), unit='s')
+    fim = inicio + pd.to_timedelta(rng.uniform(0, 900, execucoes), unit='ms')
+    df_exec = pd.DataFrame({
+        'id_execucao': np.arange(1, execucoes + 1),
+        'id_regra': rng.integers(1, regras + 1, execucoes),
+        'data_inicio': inicio,
+        'data_fim': fim.where(rng.random(execucoes) > 0.05),
+        'sucesso': rng.random(execucoes) > 0.1,
+    })
+
+    abertura = base + pd.to_timedelta(rng.uniform(0, 20 * 86400, incidentes), unit='s')
+    df_inc = pd.DataFrame({
+        'id_incidente': np.arange(1, incidentes + 1),
+        'id_regra': rng.integers(1, regras + 1, incidentes),
+        'data_abertura': abertura,
+        'status': rng.choice(['OPEN', 'ACK', 'CLOSED'], incidentes),
+    })
+    eventos = []
+    for inc in df_inc.itertuples(index=False):
+        for tipo, atraso_h in (('ACK', 1), ('CLOSE', 8)):
+            if rng.random() < 0.8:
+                eventos.append((inc.id_incidente, tipo, inc.data_abertura + pd.Timedelta(hours=atraso_h * rng.random())))
+    df_evt = pd.DataFrame(eventos, columns=['id_incidente', 'tipo', 'timestamp'])
+    df_evt.insert(0, 'id', np.arange(1, len(df_evt) + 1))
+    return df_exec, df_inc, df_evt
+
+
+def em_partes(df, n):
+    tamanho = -(-len(df) // n)
+    return [df.iloc[i:i + tamanho] for i in range(0, len(df), tamanho)]
+
+
+def test_incremental_confere_com_recalculo_completo():
+    df_exec, df_inc, df_evt = dados_sinteticos()
+    completo = analytics.agregar_metricas(df_exec.copy(), df_inc, df_evt).sort_values('id_regra').reset_index(drop=True)
+
+    # Mesmo formato que metricas_incrementais lê: eventos já com id_regra/data_abertura do incidente
+    eventos = df_evt.merge(df_inc[['id_incidente', 'id_regra', 'data_abertura']], on='id_incidente')
+    estado = analytics.EstadoIncremental()
+    for parte in em_partes(df_exec, 3):
+        estado.somar_execucoes(parte)
+    for parte in em_partes(eventos, 4):
+        estado.somar_eventos(parte)
+    incremental = estado.para_dataframe()
+
+    assert list(incremental['id_regra']) == list(completo['id_regra'])
+    assert np.allclose(completo[COLUNAS].astype(float).to_numpy(), incremental[COLUNAS].astype(float).to_numpy(),
+                       rtol=1e-9, atol=1e-9, equal_nan=True)
+
+
+def test_incremental_expira_dias_fora_da_janela():
+    df_exec, df_inc, df_evt = dados_sinteticos()
+    corte = '2026-09-11'
+    recentes = df_exec[df_exec['data_inicio'] >= corte]
+    inc_recentes = df_inc[df_inc['data_abertura'] >= corte]
+    completo = analytics.agregar_metricas(recentes.copy(), inc_recentes, df_evt).sort_values('id_regra').reset_index(drop=True)
+
+    estado = analytics.EstadoIncremental()
+    estado.somar_execucoes(df_exec)
+    estado.somar_eventos(df_evt.merge(df_inc[['id_incidente', 'id_regra', 'data_abertura']], on='id_incidente'))
+    estado.expirar(corte)
+    incremental = estado.para_dataframe()
+
+    assert list(incremental['id_regra']) == list(completo['id_regra'])
+    assert np.allclose(completo[COLUNAS].astype(float).to_numpy(), incremental[COLUNAS].astype(float).to_numpy(),
+                       rtol=1e-9, atol=1e-9, equal_nan=True)
+
+
+@pytest.mark.parametrize('precisao', [0.01, 0.05])
+def test_sketch_quantis_dentro_da_precisao(precisao):
+    rng = np.random.default_rng(3)
+    valores = np.concatenate([rng.lognormal(3, 1.5, 20000), np.zeros(500)])
+    rng.shuffle(valores)
+
+    inteiro = analytics.SketchQuantis(precisao)
+    inteiro.adicionar(valores)
+    partes = [analytics.SketchQuantis(precisao) for _ in range(4)]
+    for sketch, bloco in zip(partes, np.array_split(valores, 4)):
+        sketch.adicionar(bloco)
+    mesclado = partes[0]
+    for sketch in partes[1:]:
+        mesclado.mesclar(sketch)
+
+    assert mesclado.n == inteiro.n == len(valores)
+    for q in (0.01, 0.25, 0.5, 0.9, 0.99, 1.0):
+        esperado = np.quantile(valores, q, method='lower')
+        assert mesclado.quantil(q) == inteiro.quantil(q)
+        assert abs(inteiro.quantil(q) - esperado) <= precisao * esperado + 1e-12
+
+
+def test_sketch_vazio_e_nan():
+    sketch = analytics.SketchQuantis()
+    assert np.isnan(sketch.quantil(0.5))
+    sketch.adicionar([np.nan, np.nan])
+    assert sketch.n == 0 and np.isnan(sketch.quantil(0.5))
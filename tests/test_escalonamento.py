@@ -0,0 +1,82 @@
+import os
+import sys
+import uuid
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import runner
+
+pytestmark = pytest.mark.skipif(not runner.DB_URL, reason="precisa de DATABASE_URL")
+
+
+@pytest.fixture
+def conn():
+    # Tabelas mínimas num schema próprio, para não tocar nos dados do banco apontado
+    import psycopg2
+    from psycopg2.extras import RealDictCursor
+
+    schema = f"teste_escalonamento_{uuid.uuid4().hex[:8]}"
+    admin = psycopg2.connect(runner.DB_URL)
+    admin.autocommit = True
+    admin.cursor().execute(f"CREATE SCHEMA {schema}")
+    conn = psycopg2.connect(runner.DB_URL, cursor_factory=RealDictCursor, options=f"-c search_path={schema}")
+    cur = conn.cursor()
+    cur.execute("""
+        CREATE TABLE regras (id serial PRIMARY KEY, nome text);
+        CREATE TABLE usuarios (id serial PRIMARY KEY, role text, email text);
+        CREATE TABLE incidentes (
+            id_incidente serial PRIMARY KEY, id_regra integer, status text, prioridade integer,
+            data_abertura timestamp, nivel_escalonamento integer NOT NULL DEFAULT 0
+        );
+        CREATE TABLE notificacoes (
+            id serial PRIMARY KEY, id_usuario integer, id_incidente integer, canal text, destinatario text,
+            mensagem text, status text, titulo text, metadados jsonb
+        );
+        INSERT INTO regras (nome) VALUES ('regra_teste');
+        INSERT INTO usuarios (role, email) VALUES ('admin', 'admin@teste.local'), ('operador', 'op@teste.local');
+    """)
+    conn.commit()
+    try:
+        yield conn
+    finally:
+        conn.close()
+        admin.cursor().execute(f"DROP SCHEMA {schema} CASCADE")
+        admin.close()
+
+
+def abrir(cur, prioridade, minutos, status='OPEN'):
+    cur.execute("""
+        INSERT INTO incidentes (id_regra, status, prioridade, data_abertura)
+        VALUES (1, %s, %s, NOW() - make_interval(mins => %s)) RETURNING id_incidente
+    """, (status, prioridade, minutos))
+    return cur.fetchone()['id_incidente']
+
+
+def test_escalonar_sobe_para_alta_sem_rebaixar(conn, monkeypatch):
+    pushes = []
+    monkeypatch.setattr(runner.despachante_push, 'enviar', lambda payload, origem: pushes.append(payload))
+    cur = conn.cursor()
+    recentes = {p: abrir(cur, p, 10) for p in (1, 2, 3)}
+    sla = {p: abrir(cur, p, 50) for p in (1, 2, 3)}
+    gerencia = {p: abrir(cur, p, 130) for p in (1, 2, 3)}
+    fechado = abrir(cur, 3, 130, status='CLOSED')
+    conn.commit()
+
+    runner._escalonar(conn)
+    runner._escalonar(conn)
+
+    cur.execute("SELECT id_incidente, prioridade, nivel_escalonamento FROM incidentes")
+    estado = {r['id_incidente']: (r['prioridade'], r['nivel_escalonamento']) for r in cur.fetchall()}
+    for p in (1, 2, 3):
+        assert estado[recentes[p]] == (p, 0)
+        assert estado[sla[p]] == (1, 1)
+        assert estado[gerencia[p]] == (1, 2)
+    assert estado[fechado] == (3, 0)
+
+    cur.execute("SELECT id_incidente, destinatario FROM notificacoes")
+    avisos = sorted((r['id_incidente'], r['destinatario']) for r in cur.fetchall())
+    assert avisos == sorted([(sla[p], 'admin@teste.local') for p in (1, 2, 3)] +
+                            [(gerencia[p], 'admin@empresa.com') for p in (1, 2, 3)])
+    assert len(pushes) == 3
@@ -0,0 +1,32 @@
+import os
+import sys
+import time
+from decimal import Decimal
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import runner
+
+
+def regra(modo, **parametros):
+    return {'id': 1, 'nome': 'teste', 'qtd_erro_max': 0, 'modo_avaliacao': modo, 'parametros_avaliacao': parametros}
+
+
+@pytest.mark.parametrize('modo, parametros, alto', [
+    ('taxa', {'janela': 5, 'taxa_min': 1}, Decimal('500.5')),
+    ('media_movel', {'janela': 5, 'desvio': 0.5}, Decimal('500.5')),
+    ('zscore', {'janela': 5, 'min_amostras': 5, 'z': 3}, Decimal('500.5')),
+])
+def test_avaliar_aceita_decimal(modo, parametros, alto):
+    historico = runner.HistoricoValores(10)
+    agora = time.time()
+    for i, v in enumerate((100, 101, 99, 100, 102)):
+        historico.adicionar(1, float(Decimal(v)), agora - (5 - i) * 60)
+
+    r = regra(modo, **parametros)
+    dispara, motivo = historico.avaliar(r, alto, agora)
+    assert dispara, motivo
+    dispara, motivo = historico.avaliar(r, Decimal('100.5'), agora)
+    assert not dispara, motivo
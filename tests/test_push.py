@@ -0,0 +1,74 @@
+import os
+import sys
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import runner
+from firebase_admin import messaging
+
+
+class TransporteFalso:
+    # Mesma interface do TransporteFCM; o erro de cada token vem do seu prefixo
+    ERROS = {
+        'morto': lambda: messaging.UnregisteredError("não registrado"),
+        'outro_app': lambda: messaging.SenderIdMismatchError("sender id diferente"),
+        'cota': lambda: messaging.QuotaExceededError("cota excedida"),
+    }
+
+    def __init__(self, falhar_lote=None):
+        self.lotes = []
+        self.falhar_lote = falhar_lote
+
+    def enviar_multicast(self, mensagem):
+        self.lotes.append(list(mensagem.tokens))
+        if len(self.lotes) == self.falhar_lote:
+            raise RuntimeError("FCM fora do ar")
+        respostas = []
+        for token in mensagem.tokens:
+            erro = self.ERROS.get(token.split(':')[0])
+            respostas.append(SimpleNamespace(success=erro is None, exception=erro() if erro else None))
+        return SimpleNamespace(success_count=sum(r.success for r in respostas), responses=respostas)
+
+
+def tokens_de_teste():
+    prefixos = ['ok', 'ok', 'ok', 'morto', 'ok', 'outro_app', 'cota']
+    return [f"{prefixos[i % len(prefixos)]}:{i}" for i in range(1203)]
+
+
+def test_send_push_divide_em_lotes_e_remove_so_tokens_mortos(monkeypatch):
+    transporte = TransporteFalso()
+    removidos = []
+    monkeypatch.setattr(runner, 'transporte_push', transporte)
+    monkeypatch.setattr(runner.registro_tokens, 'remover', lambda tokens: removidos.extend(tokens))
+    tokens = tokens_de_teste()
+
+    sucessos = runner.send_push_notification(tokens, "Título", "Corpo", {'rota': '/x'})
+
+    assert [len(l) for l in transporte.lotes] == [500, 500, 203]
+    assert all(len(l) <= runner.FCM_LOTE_MAX for l in transporte.lotes)
+    assert [t for l in transporte.lotes for t in l] == tokens
+    assert sucessos == sum(t.startswith('ok:') for t in tokens)
+    assert sorted(removidos) == sorted(t for t in tokens if t.split(':')[0] in ('morto', 'outro_app'))
+
+
+def test_send_push_segue_quando_um_lote_falha(monkeypatch):
+    transporte = TransporteFalso(falhar_lote=2)
+    removidos = []
+    monkeypatch.setattr(runner, 'transporte_push', transporte)
+    monkeypatch.setattr(runner.registro_tokens, 'remover', lambda tokens: removidos.extend(tokens))
+    tokens = tokens_de_teste()
+
+    sucessos = runner.send_push_notification(tokens, "Título", "Corpo")
+
+    assert len(transporte.lotes) == 3
+    entregues = transporte.lotes[0] + transporte.lotes[2]
+    assert sucessos == sum(t.startswith('ok:') for t in entregues)
+    assert sorted(removidos) == sorted(t for t in entregues if t.split(':')[0] in ('morto', 'outro_app'))
+
+
+def test_send_push_sem_tokens_nao_chama_transporte(monkeypatch):
+    transporte = TransporteFalso()
+    monkeypatch.setattr(runner, 'transporte_push', transporte)
+    assert runner.send_push_notification([], "Título", "Corpo") == 0
+    assert transporte.lotes == []